@@ -0,0 +1,673 @@
+"""Benchmarks for PhotoCrawler components.
+
+    python Benchmark.py walk [--depth 3] [--fanout 6] [--files 20] [--latency-ms 2] [--workers 1,4,8,16]
+    python Benchmark.py exif [--files 10000] [--size 1024x768]
+    python Benchmark.py hash [--files 200] [--sizes-mb 0.1,5,25]
+    python Benchmark.py db [--rows 10000,100000,1000000] [--lookups 10000]
+    python Benchmark.py phash [--files 50] [--size 4000x3000] [--hashes 10000,100000,1000000]
+    python Benchmark.py crawl [--photos 2000] [--latency-ms 0] [--configs "--hash-workers 0;--hash-workers 4"]
+    python Benchmark.py syscalls [--photos 2000] [--libraries 1] [--config "--hash-workers 4"]
+
+Every benchmark takes --json-out FILE to also write its results as JSON, so runs can be compared.
+
+walk: compares the recursive directory walk the crawler used before Walker.py with
+Walker.WalkFolder at several worker counts, on a synthetic tree. Every os.scandir, os.stat,
+os.lstat and open call is delayed by --latency-ms to imitate a network filesystem.
+
+exif: per-file latency of the EXIF date lookup with Pillow (Image.open + _getexif), with
+GetEarliestDateCreatedFromExif and with FileProbe, on JPEG, PNG, WebP, TIFF, CR2, NEF, MOV,
+MP4 and HEIC files carrying capture dates.
+
+hash: per-file latency of ComputeQuickFileHash, ComputeFileHash and FileProbe (quick hash
+alone and quick hash plus EXIF date) at several file sizes. Files are read from the page cache.
+
+db: lookup latency of DataBase.GetPhotoAttributesByHash and HasSourcePath (hits and misses)
+in a photos table of each size, from SQLite and with the preloaded PhotoIndex.
+
+phash: per-file latency of PerceptualHash.ComputeDHash (JPEG draft-mode decode) against a
+full decode followed by the same downscale, and query latency of PerceptualHash.MultiIndexHash
+against a linear scan over random 64-bit hashes at each index size.
+
+crawl: end-to-end PhotoCrawler runs (Crawl.AnalyzeFolder plus pipeline, copies and database)
+on a tree from SyntheticTree.py, once on an empty output and once more incrementally, for
+each set of crawler arguments in --configs. Each run is a separate process.
+
+syscalls: counts the filesystem calls (scandir, stat, lstat, open, listdir, mkdir and the
+stat of each DirEntry) of the recursive walk, of Walker.WalkFolder and of a cold and an
+incremental crawler run on a tree from SyntheticTree.py, per directory and per file.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import builtins
+import platform
+import tempfile
+import threading
+import contextlib
+import statistics
+import subprocess
+from datetime import datetime
+import settings
+import Utils
+import Walker
+import IPhotoLibrary
+import SyntheticTree
+import PerceptualHash
+from Utils import IsValidSubDirectory
+
+# Calls the latency shim can delay
+LATENCY_CALLS = ('scandir', 'stat', 'lstat', 'open')
+
+# Calls the syscall counting shim counts (see CountCalls)
+COUNTED_CALLS = ('scandir', 'stat', 'lstat', 'open', 'listdir', 'mkdir')
+
+
+def BuildTree(root, depth, fanout, files_per_dir):
+    """Create a directory tree of empty .jpg files. Returns (directories, files) created."""
+    directories = 0
+    files = 0
+    frontier = [(root, 0)]
+    while frontier:
+        path, level = frontier.pop()
+        os.makedirs(path, exist_ok=True)
+        directories += 1
+        for i in range(files_per_dir):
+            open(os.path.join(path, f"IMG_{i:04d}.jpg"), 'wb').close()
+            files += 1
+        if level < depth:
+            for i in range(fanout):
+                frontier.append((os.path.join(path, f"dir{i:02d}"), level + 1))
+    return directories, files
+
+
+@contextlib.contextmanager
+def _PatchCalls(calls, wrap):
+    """Replace the given os functions (and the builtin open for 'open') by wrap(name, func)."""
+    patched = []
+    for name in calls:
+        if name == 'open':
+            patched += [(builtins, 'open', builtins.open), (io, 'open', io.open)]
+        else:
+            patched.append((os, name, getattr(os, name)))
+    for module, name, func in patched:
+        setattr(module, name, wrap(name, func))
+    try:
+        yield
+    finally:
+        for module, name, func in patched:
+            setattr(module, name, func)
+
+
+@contextlib.contextmanager
+def InjectLatency(latency_s, calls=LATENCY_CALLS):
+    """Delay every call to the given functions by latency_s seconds.
+
+    calls names os.scandir, os.stat, os.lstat and the builtin open (io.open). Calls made
+    from C, such as DirEntry.stat() or SQLite's own file access, are not delayed.
+    """
+    if latency_s <= 0:
+        yield
+        return
+
+    def slow(name, func):
+        def wrapper(*args, **kwargs):
+            time.sleep(latency_s)
+            return func(*args, **kwargs)
+        return wrapper
+
+    with _PatchCalls(calls, slow):
+        yield
+
+
+class _CountingEntry:
+    """os.DirEntry stand-in counting the stat its first stat() call makes."""
+
+    def __init__(self, entry, counts, lock):
+        self._entry = entry
+        self._counts = counts
+        self._lock = lock
+        self._stated = set()
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, *, follow_symlinks=True):
+        if follow_symlinks not in self._stated:
+            self._stated.add(follow_symlinks)
+            with self._lock:
+                self._counts['DirEntry.stat'] = self._counts.get('DirEntry.stat', 0) + 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def is_dir(self, *, follow_symlinks=True):
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, *, follow_symlinks=True):
+        return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+    def inode(self):
+        return self._entry.inode()
+
+    def __fspath__(self):
+        return self.path
+
+
+class _CountingScandir:
+    def __init__(self, iterator, counts, lock):
+        self._iterator = iterator
+        self._counts = counts
+        self._lock = lock
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountingEntry(next(self._iterator), self._counts, self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._iterator.close()
+        return False
+
+
+@contextlib.contextmanager
+def CountCalls(calls=COUNTED_CALLS):
+    """Count the calls to the given os functions and the builtin open, and DirEntry.stat().
+
+    Yields a dict of call name to count, filled in as calls are made. os.path.isdir, exists
+    and getsize go through os.stat and are counted as stat. DirEntry.stat() counts once per
+    entry, as it caches its result. Calls made from C, such as SQLite's own file access, are
+    not seen.
+    """
+    counts = {}
+    lock = threading.Lock()
+
+    def counting(name, func):
+        def wrapper(*args, **kwargs):
+            with lock:
+                counts[name] = counts.get(name, 0) + 1
+            result = func(*args, **kwargs)
+            return _CountingScandir(result, counts, lock) if name == 'scandir' else result
+        return wrapper
+
+    with _PatchCalls(calls, counting):
+        yield counts
+
+
+def LegacyWalk(path):
+    """The recursive walk of Crawl.AnalyzeFolder before Walker.py, counting files only."""
+    count = 0
+    for entry in os.scandir(path):
+        if entry.is_dir():
+            if IPhotoLibrary.IsPhotosLibraryPackage(entry.path) == IPhotoLibrary.IPhotoLibraryVersion.MODERN:
+                continue
+            if IsValidSubDirectory(entry.path):
+                count += LegacyWalk(entry.path)
+        else:
+            count += 1
+    return count
+
+
+def ConcurrentWalk(path, workers):
+    count = 0
+    for listing in Walker.WalkFolder(path, workers, track_manifests=False):
+        count += len(listing.files)
+    return count
+
+
+def TimeIt(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def Summarize(latencies):
+    """Mean, median and p95 of a list of per-call latencies in microseconds."""
+    latencies = sorted(latencies)
+    return dict(count=len(latencies), mean_us=statistics.mean(latencies), median_us=statistics.median(latencies),
+                p95_us=latencies[int(len(latencies) * 0.95)], total_s=sum(latencies) / 1e6)
+
+
+def FormatSummary(summary):
+    return (f"mean {summary['mean_us']:8.1f}  median {summary['median_us']:8.1f}  "
+            f"p95 {summary['p95_us']:8.1f}  total {summary['total_s']:6.2f} s")
+
+
+def BenchmarkWalk(args):
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    results = []
+    try:
+        directories, files = BuildTree(os.path.join(root, 'tree'), args.depth, args.fanout, args.files)
+        tree = os.path.join(root, 'tree')
+        print(f"Tree: {directories} directories, {files} files, {args.latency_ms} ms latency per call")
+        with InjectLatency(args.latency_ms / 1000.0):
+            count, seconds = TimeIt(LegacyWalk, tree)
+            print(f"  {'recursive':<14} {seconds:8.3f} s  {count} files")
+            results.append(dict(walk='recursive', workers=1, seconds=seconds, files=count))
+            baseline = seconds
+            for workers in args.workers:
+                count, seconds = TimeIt(ConcurrentWalk, tree, workers)
+                print(f"  {f'walker x{workers}':<14} {seconds:8.3f} s  {count} files  {baseline / seconds:5.1f}x")
+                results.append(dict(walk='walker', workers=workers, seconds=seconds, files=count))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(directories=directories, files=files, runs=results)
+
+
+def BuildExifFiles(root, count, size):
+    """Write count images with EXIF dates, cycling through JPEG, PNG and WebP. Returns their paths."""
+    from PIL import Image
+    exif = Image.Exif()
+    exif[Utils.EXIF_TAG_DATETIME] = "2020:01:02 03:04:05"
+    exif.get_ifd(Utils.EXIF_IFD_POINTER_TAG)[Utils.EXIF_TAG_DATETIME_ORIGINAL] = "2019:05:06 07:08:09"
+    templates = []
+    for image_format, extension in (('JPEG', 'jpg'), ('PNG', 'png'), ('WEBP', 'webp')):
+        template = os.path.join(root, f"template.{extension}")
+        Image.effect_noise(size, 64).convert('RGB').save(template, image_format, exif=exif.tobytes())
+        with open(template, 'rb') as f:
+            templates.append((extension, f.read()))
+    paths = []
+    for i in range(count):
+        extension, data = templates[i % len(templates)]
+        path = os.path.join(root, f"IMG_{i:05d}.{extension}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def BuildMediaFiles(root, count, seed=1):
+    """Write count TIFF/CR2/NEF/MOV/MP4/HEIC files with capture dates (SyntheticTree builders)."""
+    rng = random.Random(seed)
+    kinds = SyntheticTree.RAW_KINDS + SyntheticTree.VIDEO_KINDS
+    timestamp = datetime(2019, 5, 6, 7, 8, 9).timestamp()
+    paths = []
+    for i in range(count):
+        extension, builder = kinds[i % len(kinds)]
+        path = os.path.join(root, f"MEDIA_{i:05d}.{extension}")
+        with open(path, 'wb') as f:
+            f.write(builder(rng, timestamp))
+        paths.append(path)
+    return paths
+
+
+def PillowExifDate(path):
+    """The EXIF lookup GetEarliestDateCreatedFromExif used before the header-only parser."""
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            return Utils._GetEarliestDateFromPillowImage(image)
+    except Exception:
+        # Pillow cannot open RAW and video files at all
+        return None
+
+
+def ProbeExifDate(path):
+    """The EXIF lookup of CheckPhoto: FileProbe with the quick hash buffers."""
+    probe = Utils.FileProbe(path, os.path.getsize(path), Utils.EXIF_PREFIX_SIZE)
+    return probe.ExifTimestamp()[1]
+
+
+def TimePerFile(func, paths):
+    """Return the per-file latencies of func in microseconds and the set of its results."""
+    latencies = []
+    results = set()
+    for path in paths:
+        start = time.perf_counter()
+        results.add(func(path))
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return latencies, results
+
+
+def BenchmarkExif(args):
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    results = []
+    try:
+        width, height = (int(n) for n in args.size.split('x'))
+        paths = BuildExifFiles(root, args.files, (width, height))
+        paths += BuildMediaFiles(root, args.files)
+        print(f"{len(paths)} files ({width}x{height} JPEG/PNG/WebP, TIFF/CR2/NEF/MOV/MP4/HEIC with dates), per-file latency in microseconds")
+        readers = (('pillow', PillowExifDate), ('exif', Utils.GetEarliestDateCreatedFromExif), ('probe', ProbeExifDate))
+        for extension in ('jpg', 'png', 'webp', 'tif', 'cr2', 'nef', 'mov', 'mp4', 'heic'):
+            subset = [path for path in paths if path.endswith('.' + extension)]
+            for name, func in readers:
+                latencies, dates = TimePerFile(func, subset)
+                summary = Summarize(latencies)
+                print(f"  {extension:<5} {name:<7} {FormatSummary(summary)}  results {sorted(dates, key=str)}")
+                results.append(dict(format=extension, reader=name, results=sorted(dates, key=str), **summary))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(runs=results)
+
+
+def ProbeQuickHash(path):
+    return Utils.FileProbe(path, os.path.getsize(path)).QuickHash()
+
+
+def ProbeQuickHashAndExif(path):
+    probe = Utils.FileProbe(path, os.path.getsize(path), Utils.EXIF_PREFIX_SIZE)
+    return probe.QuickHash(), probe.ExifTimestamp()[1]
+
+
+def BenchmarkHash(args):
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    rng = random.Random(1)
+    timestamp = datetime(2019, 5, 6, 7, 8, 9).timestamp()
+    results = []
+    try:
+        print(f"{args.files} TIFF-based files per size, per-file latency in microseconds (page cache warm)")
+        for size_mb in args.sizes_mb:
+            size = int(size_mb * 1024 * 1024)
+            paths = []
+            for i in range(args.files):
+                path = os.path.join(root, f"RAW_{size_mb}_{i:05d}.tif")
+                with open(path, 'wb') as f:
+                    f.write(SyntheticTree.MakeRaw(rng, timestamp, 'tif', size))
+                paths.append(path)
+            for name, func in (('quick', Utils.ComputeQuickFileHash), ('full', Utils.ComputeFileHash),
+                               ('probe', ProbeQuickHash), ('probe+exif', ProbeQuickHashAndExif)):
+                latencies, _ = TimePerFile(func, paths)
+                summary = Summarize(latencies)
+                print(f"  {size_mb:>6} MB {name:<11} {FormatSummary(summary)}")
+                results.append(dict(size_mb=size_mb, hasher=name, **summary))
+            for path in paths:
+                os.remove(path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(runs=results)
+
+
+def FillPhotosTable(db_path, rows, rng):
+    """Insert rows random photos straight into the photos table. Returns a sample of (hash, path)."""
+    sample = []
+    conn = sqlite3.connect(db_path)
+    try:
+        for start in range(0, rows, 100000):
+            batch = []
+            for i in range(start, min(rows, start + 100000)):
+                file_hash = f"{rng.getrandbits(64):016x}"
+                path = f"/photos/{i // 1000:04d}/IMG_{i:07d}.jpg"
+                batch.append((f"IMG_{i:07d}.jpg", path, 1.5e9 + i, file_hash))
+                if len(sample) < 100000 and rng.random() < 0.1:
+                    sample.append((file_hash, path))
+            conn.executemany('INSERT INTO photos (name, filename, timestamp, hash) VALUES (?, ?, ?, ?)', batch)
+            conn.commit()
+    finally:
+        conn.close()
+    return sample
+
+
+def TimeLookups(func, keys):
+    latencies = []
+    for key in keys:
+        start = time.perf_counter()
+        func(key)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return Summarize(latencies)
+
+
+def BenchmarkDatabase(args):
+    from DataBase import DataBase
+    rng = random.Random(1)
+    results = []
+    print(f"{args.lookups} lookups per kind, latency in microseconds")
+    for rows in args.rows:
+        root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+        database = None
+        try:
+            # Create the schema, then bulk insert; DataBase.AddPhoto would take minutes at 1M rows
+            database = DataBase(root)
+            database.Close()
+            start = time.perf_counter()
+            sample = FillPhotosTable(database.db_path, rows, rng)
+            print(f"  {rows} rows: filled in {time.perf_counter() - start:.1f} s")
+            hits = [sample[rng.randrange(len(sample))] for _ in range(args.lookups)]
+            misses = [(f"{rng.getrandbits(64):016x}", f"/elsewhere/IMG_{i:07d}.jpg") for i in range(args.lookups)]
+            lookups = (('hash hit', database.GetPhotoAttributesByHash, [h for h, _ in hits]),
+                       ('hash miss', database.GetPhotoAttributesByHash, [h for h, _ in misses]),
+                       ('path hit', database.HasSourcePath, [p for _, p in hits]),
+                       ('path miss', database.HasSourcePath, [p for _, p in misses]))
+            for source in ('sqlite', 'index'):
+                if source == 'index':
+                    index_start = time.perf_counter()
+                    database.LoadIndex()
+                    print(f"    index loaded in {time.perf_counter() - index_start:.2f} s")
+                for name, func, keys in lookups:
+                    summary = TimeLookups(func, keys)
+                    print(f"    {source:<7} {name:<10} {FormatSummary(summary)}")
+                    results.append(dict(rows=rows, source=source, lookup=name, **summary))
+        finally:
+            if database is not None:
+                database.db.close()
+            shutil.rmtree(root, ignore_errors=True)
+    return dict(runs=results)
+
+
+def FullDecodeDHash(path):
+    """ComputeDHash without draft mode: decode every pixel, then downscale."""
+    from PIL import Image
+    with Image.open(path) as image:
+        small = image.convert('L').resize((PerceptualHash.DHASH_SIZE + 1, PerceptualHash.DHASH_SIZE))
+    pixels = small.tobytes()
+    value = 0
+    for row in range(PerceptualHash.DHASH_SIZE):
+        offset = row * (PerceptualHash.DHASH_SIZE + 1)
+        for column in range(PerceptualHash.DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + column + 1] > pixels[offset + column])
+    return value
+
+
+def BenchmarkPerceptualHash(args):
+    from PIL import Image, ImageFilter
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    rng = random.Random(1)
+    results = []
+    try:
+        width, height = (int(n) for n in args.size.split('x'))
+        paths = []
+        for i in range(args.files):
+            image = Image.effect_noise((width // 8, height // 8), 40 + i % 40).filter(ImageFilter.GaussianBlur(4)).resize((width, height))
+            path = os.path.join(root, f"IMG_{i:05d}.jpg")
+            image.convert('RGB').save(path, quality=90)
+            paths.append(path)
+        print(f"{args.files} JPEG files of {width}x{height}, per-file latency in microseconds (page cache warm)")
+        for name, func in (('draft', lambda path: PerceptualHash.ComputeDHash(path)[0]), ('full decode', FullDecodeDHash)):
+            latencies, _ = TimePerFile(func, paths)
+            summary = Summarize(latencies)
+            print(f"  {name:<12} {FormatSummary(summary)}")
+            results.append(dict(stage='dhash', method=name, **summary))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    distance = settings.gNearDuplicateDistance
+    print(f"Near-duplicate queries within {distance} bits, latency in microseconds")
+    for count in args.hashes:
+        hashes = [rng.getrandbits(64) for _ in range(count)]
+        index = PerceptualHash.MultiIndexHash(distance)
+        start = time.perf_counter()
+        for i, hash_value in enumerate(hashes):
+            index.Add(hash_value, i)
+        print(f"  {count} hashes: index built in {time.perf_counter() - start:.1f} s")
+        # Half the queries are near-duplicates of an indexed hash (2 bits flipped)
+        queries = [hashes[rng.randrange(count)] ^ (1 << rng.randrange(32)) ^ (1 << (32 + rng.randrange(32))) if i % 2 == 0
+                   else rng.getrandbits(64) for i in range(args.queries)]
+        # The linear scan is only sampled at large sizes
+        linear_queries = queries[:max(1, args.queries * 10000 // count)]
+        for name, func, keys in (('multi-index', index.Query, queries),
+                                 ('linear', lambda query: [h for h in hashes if PerceptualHash.HammingDistance(query, h) <= distance], linear_queries)):
+            summary = TimeLookups(func, keys)
+            print(f"    {name:<12} {FormatSummary(summary)}")
+            results.append(dict(stage='query', hashes=count, method=name, **summary))
+    return dict(runs=results)
+
+
+# Runs PhotoCrawler.Main in a child process: argv[1] is the latency in seconds, the rest crawler arguments
+CRAWL_CHILD = "import sys, json, Benchmark; print(json.dumps(Benchmark.RunCrawler(float(sys.argv[1]), sys.argv[2:])))"
+
+
+def RunCrawler(latency_s, crawler_args):
+    """Run PhotoCrawler.Main with the given arguments under the latency and call counting shims.
+
+    Returns:
+        dict: Wall time of Main, the calls it made (see CountCalls) and the run metrics
+            (see Metrics.Metrics.Snapshot)
+    """
+    import PhotoCrawler
+    sys.argv = ['PhotoCrawler.py'] + crawler_args
+    with InjectLatency(latency_s), CountCalls() as calls:
+        _, seconds = TimeIt(PhotoCrawler.Main)
+    return dict(seconds=seconds, calls=calls, metrics=Utils.GetMetrics().Snapshot())
+
+
+def BenchmarkCrawl(args):
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    results = []
+    try:
+        tree = os.path.join(root, 'tree')
+        summary = SyntheticTree.GenerateTree(tree, args.photos, args.depth, args.fanout, args.duplicate_rate,
+                                             zips=args.zips, libraries=args.libraries, seed=args.seed)
+        print(f"Tree: {summary['directories']} directories, {args.photos} media files, {summary['zips']} ZIPs, "
+              f"{summary['bytes'] / (1024 * 1024):.0f} MB, {args.latency_ms} ms latency per call")
+        for number, config in enumerate(args.configs):
+            output = os.path.join(root, f"output{number}")
+            os.makedirs(output)
+            crawler_args = ['--scan-path', tree, '--output-path', output] + config.split()
+            for run in ('cold', 'incremental'):
+                completed = subprocess.run([sys.executable, '-c', CRAWL_CHILD, str(args.latency_ms / 1000.0)] + crawler_args,
+                                           cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stderr, file=sys.stderr)
+                    raise RuntimeError(f"Crawler run failed for config '{config}'")
+                stats = json.loads(completed.stdout.strip().splitlines()[-1])
+                counters = stats['metrics']['counters']
+                print(f"  {config or '(defaults)':<50} {run:<11} {stats['seconds']:8.3f} s  "
+                      f"folder {counters.get('folder_images', 0)}  zip {counters.get('zip_images', 0)}  "
+                      f"in database {counters.get('skipped_database', 0)}")
+                results.append(dict(config=config, run=run, **stats))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(tree=summary, runs=results)
+
+
+def FormatCalls(calls, directories, files):
+    total = sum(calls.values())
+    names = '  '.join(f"{name} {count}" for name, count in sorted(calls.items()))
+    return f"{total:7d} calls  {total / directories:6.2f}/directory  {total / files:6.2f}/file  ({names})"
+
+
+def BenchmarkSyscalls(args):
+    root = tempfile.mkdtemp(prefix='photocrawler-bench-')
+    results = []
+    try:
+        tree = os.path.join(root, 'tree')
+        summary = SyntheticTree.GenerateTree(tree, args.photos, args.depth, args.fanout, args.duplicate_rate,
+                                             zips=0, libraries=args.libraries, seed=args.seed)
+        directories = sum(1 for _ in os.walk(tree))
+        files = sum(len(names) for _, _, names in os.walk(tree))
+        print(f"Tree: {directories} directories, {files} files, {summary['libraries']} Photos libraries; "
+              f"scandir/stat/lstat/open/listdir/mkdir calls and DirEntry stats")
+        for name, func in (('recursive', LegacyWalk), ('walker', lambda path: ConcurrentWalk(path, 1))):
+            with CountCalls() as calls:
+                func(tree)
+            print(f"  walk  {name:<12} {FormatCalls(calls, directories, files)}")
+            results.append(dict(run='walk', walk=name, calls=dict(calls)))
+        output = os.path.join(root, 'output')
+        os.makedirs(output)
+        crawler_args = ['--scan-path', tree, '--output-path', output] + args.config.split()
+        for run in ('cold', 'incremental'):
+            completed = subprocess.run([sys.executable, '-c', CRAWL_CHILD, '0'] + crawler_args,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stderr, file=sys.stderr)
+                raise RuntimeError("Crawler run failed")
+            stats = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"  crawl {run:<12} {FormatCalls(stats['calls'], directories, files)}")
+            results.append(dict(run='crawl', crawl=run, calls=stats['calls'], seconds=stats['seconds']))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(directories=directories, files=files, runs=results)
+
+
+def WriteResults(path, benchmark, args, results):
+    """Write the results of a benchmark and the environment it ran in as JSON."""
+    report = dict(benchmark=benchmark, args={k: v for k, v in vars(args).items() if k not in ('json_out', 'benchmark')},
+                  results=results, python=sys.version, platform=platform.platform(),
+                  timestamp=datetime.now().isoformat(timespec='seconds'))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Results written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoCrawler benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json-out', help='Also write the results to this JSON file')
+    int_list = lambda s: [int(n) for n in s.split(',')]
+
+    walk = subparsers.add_parser('walk', parents=[common], help='Recursive walk vs Walker.WalkFolder with injected latency')
+    walk.add_argument('--depth', type=int, default=3)
+    walk.add_argument('--fanout', type=int, default=6)
+    walk.add_argument('--files', type=int, default=20, help='Files per directory')
+    walk.add_argument('--latency-ms', type=float, default=2.0)
+    walk.add_argument('--workers', type=int_list, default=[1, 4, 8, 16])
+
+    exif = subparsers.add_parser('exif', parents=[common], help='Pillow vs header-only EXIF date parsing')
+    exif.add_argument('--files', type=int, default=10000, help='Files per group (JPEG/PNG/WebP and RAW/video)')
+    exif.add_argument('--size', default='1024x768', help='Image size WxH')
+
+    hash_parser = subparsers.add_parser('hash', parents=[common], help='Quick hash vs full hash vs FileProbe')
+    hash_parser.add_argument('--files', type=int, default=200, help='Files per size')
+    hash_parser.add_argument('--sizes-mb', type=lambda s: [float(n) for n in s.split(',')], default=[0.1, 5, 25])
+
+    db = subparsers.add_parser('db', parents=[common], help='DataBase lookups at several table sizes')
+    db.add_argument('--rows', type=int_list, default=[10000, 100000, 1000000])
+    db.add_argument('--lookups', type=int, default=10000)
+
+    phash = subparsers.add_parser('phash', parents=[common], help='Draft-mode dHash and multi-index near-duplicate queries')
+    phash.add_argument('--files', type=int, default=50)
+    phash.add_argument('--size', default='4000x3000', help='Image size WxH')
+    phash.add_argument('--hashes', type=int_list, default=[10000, 100000, 1000000])
+    phash.add_argument('--queries', type=int, default=1000)
+
+    crawl = subparsers.add_parser('crawl', parents=[common], help='End-to-end crawler runs on a synthetic tree')
+    crawl.add_argument('--photos', type=int, default=2000)
+    crawl.add_argument('--depth', type=int, default=3)
+    crawl.add_argument('--fanout', type=int, default=4)
+    crawl.add_argument('--duplicate-rate', type=float, default=0.1)
+    crawl.add_argument('--zips', type=int, default=2)
+    crawl.add_argument('--libraries', type=int, default=1)
+    crawl.add_argument('--seed', type=int, default=1)
+    crawl.add_argument('--latency-ms', type=float, default=0.0)
+    crawl.add_argument('--configs', type=lambda s: s.split(';'),
+                       default=['--hash-workers 0', '--hash-workers 4 --copy-workers 4 --zip-workers 2'],
+                       help='Crawler argument sets separated by ";"')
+
+    syscalls = subparsers.add_parser('syscalls', parents=[common], help='Filesystem calls made by the walk and by crawler runs')
+    syscalls.add_argument('--photos', type=int, default=2000)
+    syscalls.add_argument('--depth', type=int, default=3)
+    syscalls.add_argument('--fanout', type=int, default=4)
+    syscalls.add_argument('--duplicate-rate', type=float, default=0.1)
+    syscalls.add_argument('--libraries', type=int, default=1)
+    syscalls.add_argument('--seed', type=int, default=1)
+    syscalls.add_argument('--config', default='--hash-workers 4', help='Crawler arguments')
+
+    args = parser.parse_args()
+    benchmarks = dict(walk=BenchmarkWalk, exif=BenchmarkExif, hash=BenchmarkHash, db=BenchmarkDatabase, phash=BenchmarkPerceptualHash,
+                      crawl=BenchmarkCrawl, syscalls=BenchmarkSyscalls)
+    results = benchmarks[args.benchmark](args)
+    if args.json_out:
+        WriteResults(args.json_out, args.benchmark, args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import os
+import time
+import threading
+from datetime import datetime
+import settings
+from Utils import *
+from Walker import WalkState
+
+
+# Kinds of work units tracked between checkpoints
+UNIT_DIRECTORY = 'directory'
+UNIT_LIBRARY = 'library'
+
+
+class _WorkUnit:
+    """A directory or Photos library handed out by the walk whose photos may still be in flight."""
+    __slots__ = ('kind', 'path', 'group', 'zips', 'manifest')
+
+    def __init__(self, kind, path, group):
+        self.kind = kind
+        self.path = path
+        self.group = group
+        self.zips = []
+        self.manifest = None
+
+
+class CrawlCheckpoint:
+    """Periodically records how far a crawl got, so an interrupted crawl can be resumed.
+
+    A checkpoint holds:
+        frontier: Directories the walk has not listed yet (with their subtrees)
+        directories: Directories already listed whose photos or ZIP files were still being
+            processed; on resume only their files are imported again
+        libraries: Photos libraries that were being imported
+        zips: ZIP files that were queued or being processed
+
+    Every directory and library is a work unit from the moment the walk yields it until the
+    ingest pipeline has processed its photos (tracked with a SubmissionGroup, without
+    waiting for it) and its ZIP files are done. Its directory manifest (or library
+    fingerprint) is written only then, so a manifest never covers work that was lost.
+
+    Work that is redone on resume is skipped cheaply by the source path lookups, so a
+    resumed crawl costs about the work that was left.
+    """
+
+    def __init__(self, scan_path, interval):
+        """
+        Args:
+            scan_path: Root of the crawl; checkpoints are stored per normalized scan path
+            interval: Seconds between checkpoints (0 = only when the crawl is interrupted)
+        """
+        self.scan_path = os.path.normpath(scan_path)
+        self.interval = interval
+        self.walk = WalkState([scan_path])
+        self.resume_zips = []
+        self.resume_libraries = []
+        self._units = []
+        self._pending_zips = set()
+        self._zip_lock = threading.Lock()
+        self._last_save = time.monotonic()
+
+    def Load(self):
+        """Continue from the stored checkpoint of the scan path. Returns False if there is none."""
+        state = settings.gDatabase.GetCheckpoint(self.scan_path)
+        if state is None:
+            return False
+        self.walk = WalkState(state['frontier'] + state['directories'], state['directories'])
+        self.resume_zips = state['zips']
+        self.resume_libraries = state['libraries']
+        LOG('INFO', f"Resuming crawl of {self.scan_path} from checkpoint of {state['saved']}: "
+                    f"{len(state['frontier'])} directories to walk, {len(state['directories'])} to re-import, "
+                    f"{len(self.resume_zips)} ZIP files, {len(self.resume_libraries)} Photos libraries")
+        return True
+
+    def Discard(self):
+        """Drop a stored checkpoint of the scan path (a new crawl starts from the root)."""
+        if settings.gDatabase.GetCheckpoint(self.scan_path) is not None:
+            LOG('INFO', f"Discarding the checkpoint of an earlier crawl of {self.scan_path} (use --resume to continue it)")
+            settings.gDatabase.ClearCheckpoint(self.scan_path)
+
+    def BeginUnit(self, kind, path):
+        """Start tracking the photos the calling thread submits for a directory or library."""
+        group = settings.gPipeline.BeginGroup() if settings.gPipeline is not None else None
+        unit = _WorkUnit(kind, path, group)
+        self._units.append(unit)
+        return unit
+
+    def EndUnit(self, unit):
+        """Stop adding submissions to unit; its photos may still be in flight."""
+        if unit.group is not None:
+            settings.gPipeline.DetachGroup(unit.group)
+        self.MaybeSave()
+
+    def ZipQueued(self, unit, zip_path):
+        """Note a ZIP file handed to SubmitZip; pass ZipDone as its on_done callback."""
+        with self._zip_lock:
+            self._pending_zips.add(zip_path)
+        if unit is not None:
+            unit.zips.append(zip_path)
+
+    def ZipDone(self, zip_path):
+        with self._zip_lock:
+            self._pending_zips.discard(zip_path)
+
+    def WaitForQueuedWork(self):
+        """Wait for the ZIP pool and ingest pipeline to finish the work queued by the walk.
+
+        Checkpoints are still written every interval meanwhile, so an interrupt during this
+        drain loses no more than one during the walk.
+        """
+        timeout = self.interval if self.interval > 0 else None
+        # the ZIP files first, they feed the pipeline
+        for pool in (settings.gZipPool, settings.gPipeline):
+            if pool is not None:
+                while not pool.WaitIdle(timeout):
+                    self.MaybeSave()
+
+    def MaybeSave(self):
+        if self.interval > 0 and time.monotonic() - self._last_save >= self.interval:
+            self.Save()
+
+    def _RetireFinishedUnits(self):
+        """Drop the units whose work is done, queuing their directory manifests."""
+        with self._zip_lock:
+            pending_zips = set(self._pending_zips)
+        remaining = []
+        for unit in self._units:
+            if (unit.group is None or unit.group.IsDone()) and not any(path in pending_zips for path in unit.zips):
+                if unit.manifest is not None:
+                    settings.gDatabase.QueueDirectoryManifest(unit.path, *unit.manifest)
+            else:
+                remaining.append(unit)
+        self._units = remaining
+        return pending_zips
+
+    def Save(self):
+        """Write a checkpoint of the work that is not known to be done."""
+        self._last_save = time.monotonic()
+        pending_zips = self._RetireFinishedUnits()
+        # Rows and manifests of finished work are written before the checkpoint that omits it
+        settings.gDatabase.Flush()
+        settings.gDatabase.CommitDirectoryManifests(settings.gIncompleteDirectories)
+        settings.gDatabase.CommitPhotoLibraries(settings.gIncompleteDirectories,
+                                                {unit.path for unit in self._units if unit.kind == UNIT_LIBRARY})
+        frontier, files_only = self.walk.Pending()
+        directories = sorted(set(files_only) | {unit.path for unit in self._units if unit.kind == UNIT_DIRECTORY})
+        state = dict(saved=datetime.now().isoformat(timespec='seconds'), frontier=frontier,
+                     directories=directories,
+                     libraries=[unit.path for unit in self._units if unit.kind == UNIT_LIBRARY],
+                     zips=sorted(pending_zips))
+        settings.gDatabase.SaveCheckpoint(self.scan_path, state)
+        LOG('DEBUG', f"Checkpoint: {len(frontier)} directories to walk, {len(directories)} in progress, "
+                     f"{len(state['libraries'])} libraries, {len(state['zips'])} ZIP files")
+
+    def Close(self, completed):
+        """Finish up once the pipeline and ZIP pool are drained.
+
+        Queues the manifests of all finished work. A completed crawl removes its checkpoint;
+        an interrupted one leaves a checkpoint of what was not done.
+        """
+        if completed:
+            self._RetireFinishedUnits()
+            settings.gDatabase.ClearCheckpoint(self.scan_path)
+        else:
+            self.Save()
+            LOG('WARNING', "Crawl interrupted; run again with --resume to continue from the checkpoint")
@@ -0,0 +1,131 @@
+import re
+import json
+import fnmatch
+import settings
+from Utils import *
+
+
+# Kinds of files the crawler imports
+KIND_IMAGE = 'image'
+KIND_ARCHIVE = 'archive'
+
+# Formats found by SniffImageFormat that are imported as images
+SNIFFED_IMAGE_FORMATS = {'jpeg', 'png', 'webp', 'tiff', 'gif', 'bmp', 'isobmff'}
+
+# Bytes read from an extensionless file to sniff its format
+SNIFF_SIZE = 16
+
+
+class Classifier:
+    """Decides what the crawler does with a path; compiled once from the classifier config.
+
+    File kinds come from a dict keyed by the lowercase suffix after the last dot, so
+    "foo.xm4a" is not an m4a and "backup.7zip" is not a ZIP. Exclude rules become one
+    regular expression searched once per path.
+
+    Config (JSON; every key is optional and defaults to the settings lists):
+        image_extensions: Suffixes imported as images (settings.gImageExtensions)
+        metadata_extensions: Image suffixes whose capture date is read from the file
+            (settings.gExifImageExtensions)
+        archive_extensions: Suffixes opened as ZIP archives (["zip"])
+        exclude: Rules for directories that are not walked (settings.gIgnoreFolders);
+            directories inside ZIP files are matched as <zip path>/<dir>. A rule is a plain
+            string matched anywhere in the path, {"substring": ...}, {"glob": ...} matched
+            against the whole path, or {"regex": ...} searched in the path.
+        exclude_files: Rules in the same form for files (ZIP entries included, as
+            <zip path>/<entry>) that are not imported ([])
+        sniff_extensionless: Read the first bytes of files without a suffix and import
+            them when they are images or ZIP files (false)
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.kinds = {}
+        for suffix in config.get('image_extensions', settings.gImageExtensions):
+            self.kinds[suffix.lower().lstrip('.')] = KIND_IMAGE
+        for suffix in config.get('archive_extensions', ['zip']):
+            self.kinds[suffix.lower().lstrip('.')] = KIND_ARCHIVE
+        self.metadata_suffixes = frozenset(suffix.lower().lstrip('.') for suffix in config.get('metadata_extensions', settings.gExifImageExtensions))
+        self.sniff_extensionless = bool(config.get('sniff_extensionless', False))
+        self._exclude = _CompileRules(config.get('exclude', settings.gIgnoreFolders))
+        self._exclude_files = _CompileRules(config.get('exclude_files', []))
+
+    @classmethod
+    def Load(cls, config_path=None):
+        """Build a Classifier from a JSON config file, or from the settings lists if config_path is None."""
+        if config_path is None:
+            return cls()
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        LOG('INFO', f"Loaded classifier config from {config_path}")
+        return cls(config)
+
+    def Kind(self, filename, path=None):
+        """Return KIND_IMAGE, KIND_ARCHIVE or None (not imported) for a file.
+
+        Args:
+            filename: Name of the file
+            path: Full path of the file; needed for exclude_files rules and sniffing
+        """
+        if path is not None and self.IsExcludedFile(path):
+            return None
+        dot = filename.rfind('.')
+        if dot >= 0:
+            return self.kinds.get(filename[dot + 1:].lower())
+        if self.sniff_extensionless and path is not None:
+            return _SniffKind(path)
+        return None
+
+    def IsImage(self, filename):
+        return self.Kind(filename) == KIND_IMAGE
+
+    def IsArchive(self, filename):
+        return self.Kind(filename) == KIND_ARCHIVE
+
+    def WantsMetadataDate(self, filename):
+        """True if the capture date of the file should be read from its metadata."""
+        dot = filename.rfind('.')
+        if dot < 0:
+            # Only sniffed files get here; the probe reads whatever format they are
+            return self.sniff_extensionless
+        return filename[dot + 1:].lower() in self.metadata_suffixes
+
+    def IsExcludedDirectory(self, path):
+        return self._exclude is not None and self._exclude.search(path) is not None
+
+    def IsExcludedFile(self, path):
+        return self._exclude_files is not None and self._exclude_files.search(path) is not None
+
+
+def _CompileRules(rules):
+    """Compile exclude rules into one regular expression, or None if there are none."""
+    patterns = []
+    for rule in rules:
+        if isinstance(rule, str):
+            patterns.append(re.escape(rule))
+        elif 'substring' in rule:
+            patterns.append(re.escape(rule['substring']))
+        elif 'glob' in rule:
+            # fnmatch.translate matches the whole string, so anchor it at the start for search()
+            patterns.append('^' + fnmatch.translate(rule['glob']))
+        elif 'regex' in rule:
+            patterns.append(rule['regex'])
+        else:
+            raise ValueError(f"Unknown classifier rule: {rule}")
+    if not patterns:
+        return None
+    return re.compile('|'.join(f"(?:{pattern})" for pattern in patterns))
+
+
+def _SniffKind(path):
+    try:
+        with open(path, 'rb') as f:
+            image_format = SniffImageFormat(f.read(SNIFF_SIZE))
+    except OSError as e:
+        LOG('DEBUG', f"Cannot sniff {path}: {str(e)}")
+        return None
+    if image_format == 'zip':
+        return KIND_ARCHIVE
+    if image_format in SNIFFED_IMAGE_FORMATS:
+        return KIND_IMAGE
+    return None
@@ -0,0 +1,321 @@
+import os
+import sys
+import errno
+import time
+import stat
+import threading
+import xxhash
+from Utils import *
+
+
+# Modes understood by CopyEngine
+COPY_MODES = ('copy', 'reflink', 'hardlink')
+
+# Bytes copied per kernel call / throttle step
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning a kernel copy call does not work for this pair of files
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.ENOTSOCK}
+
+# ioctl request cloning a whole file on Linux (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+class Throttle:
+    """Token bucket limiting the combined rate of all copy threads."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def Consume(self, amount):
+        """Block until amount more bytes may be copied."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + amount / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class _TeeReader:
+    """File-like reader that writes everything read from source to dest and hashes it in full."""
+
+    def __init__(self, source, dest, throttle):
+        self.source = source
+        self.dest = dest
+        self.throttle = throttle
+        self.written = 0
+        self.hasher = xxhash.xxh64()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            if self.throttle is not None:
+                self.throttle.Consume(len(data))
+            self.dest.write(data)
+            self.hasher.update(data)
+            self.written += len(data)
+        return data
+
+
+def _LoadClonefile():
+    """Return macOS clonefile(2) through ctypes, or None on other platforms."""
+    if sys.platform != 'darwin':
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        clonefile = libc.clonefile
+        clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32)
+        clonefile.restype = ctypes.c_int
+        return clonefile
+    except (OSError, AttributeError):
+        return None
+
+
+# Extended attribute errors that mean "not supported here" rather than a failed copy
+_XATTR_IGNORED_ERRORS = (errno.ENOTSUP, errno.ENODATA, errno.EINVAL, errno.EPERM, errno.EACCES)
+
+
+def _CopyXattr(src, dest):
+    """Copy the extended attributes of src to dest where the platform and filesystems allow it."""
+    try:
+        names = os.listxattr(src)
+    except OSError as e:
+        if e.errno not in _XATTR_IGNORED_ERRORS:
+            raise
+        return
+    for name in names:
+        try:
+            os.setxattr(dest, name, os.getxattr(src, name))
+        except OSError as e:
+            if e.errno not in _XATTR_IGNORED_ERRORS:
+                raise
+
+
+def _CopyStat(in_stat, src, dest):
+    """shutil.copystat(src, dest) from the stat the caller already has, without statting src again."""
+    os.utime(dest, ns=(in_stat.st_atime_ns, in_stat.st_mtime_ns))
+    if hasattr(os, 'listxattr'):
+        _CopyXattr(src, dest)
+    os.chmod(dest, stat.S_IMODE(in_stat.st_mode))
+    if hasattr(os, 'chflags') and getattr(in_stat, 'st_flags', 0):
+        try:
+            os.chflags(dest, in_stat.st_flags)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+
+
+class CopyEngine:
+    """Copies photos into the output path.
+
+    Modes:
+        copy: kernel-side copy (copy_file_range, then sendfile, then a read/write loop)
+        reflink: clone the source's data blocks when source and destination share a device
+            and the filesystem supports it (btrfs/XFS on Linux, APFS on macOS); copy otherwise
+        hardlink: hard link the source when it is on the same device; copy otherwise.
+            The output then shares its inode with the source, so editing one edits both.
+
+    With verify set, copies go through user space and every byte streamed is hashed. The
+    quick hash (see ComputeQuickFileHash) of the data must be the hash the photo was
+    deduplicated by, and the full xxh64 must be the full-content hash of the source (see
+    ComputeFileHash) when the caller knows it; otherwise the streamed full hash is handed
+    back to be recorded. A source that changed after it was hashed is never recorded, and
+    the destination never has to be read back. Links and clones share the source's data
+    and are not verified.
+
+    Destinations get the source's timestamps and permission bits like shutil.copy2.
+    Safe to use from several copy workers at once; bytes_per_second is shared by all of them.
+    """
+
+    def __init__(self, mode='copy', verify=False, bytes_per_second=0):
+        if mode not in COPY_MODES:
+            raise ValueError(f"Unknown copy mode: {mode}")
+        self.mode = mode
+        self.verify = verify
+        self.throttle = Throttle(bytes_per_second) if bytes_per_second > 0 else None
+        self._use_copy_file_range = hasattr(os, 'copy_file_range')
+        self._use_sendfile = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+        # (call, source device, destination device) where a kernel copy call is not supported
+        self._unsupported_calls = set()
+        self._clonefile = _LoadClonefile()
+        # st_dev of the destination directories seen so far
+        self._dest_devices = {}
+        LOG('INFO', f"Copy engine: mode {mode}, verify {'on' if verify else 'off'}, "
+                    f"limit {f'{bytes_per_second // (1024 * 1024)} MB/s' if bytes_per_second > 0 else 'none'}")
+
+    def CopyFile(self, src, dest, expected_hash=None, in_stat=None, full_hash=None):
+        """Copy src to dest, replacing dest if it exists.
+
+        Args:
+            src: Source file path
+            dest: Destination file path
+            expected_hash: Quick hash the copied data must have (checked in verify mode)
+            in_stat: os.stat_result of src if the caller already has it
+            full_hash: LazyFullHash of src (checked in verify mode); when its value is not
+                known, it is set to the full hash of the copied data
+
+        Returns:
+            bool: True if dest holds the source's data
+        """
+        try:
+            if in_stat is None:
+                in_stat = os.stat(src)
+            devices = (in_stat.st_dev, self._DestinationDevice(os.path.dirname(dest) or '.'))
+            if self.mode != 'copy' and devices[0] == devices[1]:
+                if self.mode == 'hardlink' and self._Link(src, dest):
+                    return True
+                if self.mode == 'reflink' and self._Clone(src, dest):
+                    _CopyStat(in_stat, src, dest)
+                    return True
+
+            with open(src, 'rb') as source, open(dest, 'wb') as target:
+                if self.verify and expected_hash is not None:
+                    copied = self._StreamVerified(source, target, dest, in_stat.st_size, expected_hash, full_hash)
+                else:
+                    self._KernelCopy(source, target, in_stat.st_size, devices)
+                    copied = True
+            if not copied:
+                os.remove(dest)
+                return False
+            _CopyStat(in_stat, src, dest)
+        except Exception as e:
+            LOG('ERROR', f"Error copying {src} to {dest}: {str(e)}", exc_info=True)
+            return False
+        return True
+
+    def _DestinationDevice(self, directory):
+        device = self._dest_devices.get(directory)
+        if device is None:
+            device = self._dest_devices[directory] = os.stat(directory).st_dev
+        return device
+
+    def CopyStream(self, source, dest, size, expected_hash=None, timestamp=None, full_hash=None):
+        """Write a readable stream (e.g. a ZIP entry) to dest.
+
+        Args:
+            source: Readable file object positioned at the start of the data
+            dest: Destination file path
+            size: Size of the data
+            expected_hash: Quick hash the data must have (checked in verify mode)
+            timestamp: Modification time to give dest
+            full_hash: LazyFullHash of the data, as in CopyFile
+
+        Returns:
+            bool: True if dest was written
+        """
+        try:
+            with open(dest, 'wb') as target:
+                if self.verify and expected_hash is not None:
+                    copied = self._StreamVerified(source, target, dest, size, expected_hash, full_hash)
+                else:
+                    copied = True
+                    for block in iter(lambda: source.read(STREAM_BLOCK_SIZE), b""):
+                        if self.throttle is not None:
+                            self.throttle.Consume(len(block))
+                        target.write(block)
+            if not copied:
+                os.remove(dest)
+                return False
+            if timestamp is not None:
+                os.utime(dest, (timestamp, timestamp))
+        except Exception as e:
+            LOG('ERROR', f"Error writing {dest}: {str(e)}", exc_info=True)
+            return False
+        return True
+
+    def _StreamVerified(self, source, target, dest, size, expected_hash, full_hash):
+        tee = _TeeReader(source, target, self.throttle)
+        copied_hash, _ = ComputeQuickStreamHash(tee, size, head_size=0)
+        if tee.written != size or copied_hash != expected_hash:
+            LOG('ERROR', f"Verification of {dest} failed: source changed since it was hashed "
+                         f"({tee.written} of {size} bytes, hash {copied_hash} != {expected_hash})")
+            return False
+        copied_full_hash = tee.hasher.hexdigest()
+        if full_hash is not None:
+            if full_hash.value is None:
+                full_hash.value = copied_full_hash
+            elif full_hash.value != copied_full_hash:
+                LOG('ERROR', f"Verification of {dest} failed: source changed since it was hashed "
+                             f"(full hash {copied_full_hash} != {full_hash.value})")
+                return False
+        return True
+
+    def _Link(self, src, dest):
+        # Link next to dest first so an existing dest is replaced atomically
+        temp_dest = f"{dest}.link-tmp"
+        try:
+            os.link(src, temp_dest)
+            os.replace(temp_dest, dest)
+            return True
+        except OSError as e:
+            LOG('DEBUG', f"Hard link {src} -> {dest} failed, copying instead: {str(e)}")
+            if os.path.lexists(temp_dest):
+                os.remove(temp_dest)
+            return False
+
+    def _Clone(self, src, dest):
+        if self._clonefile is not None:
+            # clonefile() refuses to overwrite, so clone next to dest and rename
+            temp_dest = f"{dest}.clone-tmp"
+            if self._clonefile(os.fsencode(src), os.fsencode(temp_dest), 0) == 0:
+                os.replace(temp_dest, dest)
+                return True
+            LOG('DEBUG', f"clonefile {src} -> {dest} failed, copying instead")
+            return False
+        try:
+            import fcntl
+            with open(src, 'rb') as source, open(dest, 'wb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return True
+        except (ImportError, OSError) as e:
+            LOG('DEBUG', f"Reflink {src} -> {dest} failed, copying instead: {str(e)}")
+            return False
+
+    def _KernelCopy(self, source, target, size, devices):
+        """Copy all of source to target, keeping the data in the kernel where possible.
+
+        A call that fails for one pair of (source, destination) devices, e.g. copy_file_range
+        across filesystems on older kernels, is not tried for that pair again; other pairs
+        keep using it.
+        """
+        src_fd = source.fileno()
+        dst_fd = target.fileno()
+        if self._use_copy_file_range and ('copy_file_range',) + devices not in self._unsupported_calls:
+            if self._KernelLoop(lambda count, offset: os.copy_file_range(src_fd, dst_fd, count, offset, offset), size):
+                return
+            LOG('DEBUG', f"copy_file_range unsupported between devices {devices}, falling back to sendfile")
+            self._unsupported_calls.add(('copy_file_range',) + devices)
+        if self._use_sendfile and ('sendfile',) + devices not in self._unsupported_calls:
+            if self._KernelLoop(lambda count, offset: os.sendfile(dst_fd, src_fd, offset, count), size):
+                return
+            LOG('DEBUG', f"sendfile unsupported between devices {devices}, falling back to read/write")
+            self._unsupported_calls.add(('sendfile',) + devices)
+        for block in iter(lambda: source.read(COPY_BLOCK_SIZE), b""):
+            if self.throttle is not None:
+                self.throttle.Consume(len(block))
+            target.write(block)
+
+    def _KernelLoop(self, copy_func, size):
+        """Run copy_func(count, offset) until end of file.
+
+        Returns:
+            bool: False if the call is not supported for these files (nothing was copied)
+        """
+        offset = 0
+        while True:
+            try:
+                copied = copy_func(COPY_BLOCK_SIZE, offset)
+            except OSError as e:
+                if offset == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+                    return False
+                raise
+            if copied == 0:
+                # Some filesystems report 0 instead of failing; only trust it at the real end
+                return offset > 0 or size == 0
+            if self.throttle is not None:
+                self.throttle.Consume(copied)
+            offset += copied
@@ -2,32 +2,92 @@ import os
 import sys
 import settings
 from Utils import *
-from ZipCrawl import AnalyzeZip
+from ZipCrawl import SubmitZip
+from Walker import WalkFolder
+from Classifier import KIND_IMAGE, KIND_ARCHIVE
+from Checkpoint import UNIT_DIRECTORY, UNIT_LIBRARY
 import IPhotoLibrary
 
 
-def AnalyzeFolder(path):
+def _ProcessLibrary(library_path, checkpoint=None):
+    """Import a Photos library, as a checkpoint work unit when checkpoint is given."""
+    unit = checkpoint.BeginUnit(UNIT_LIBRARY, library_path) if checkpoint is not None else None
     try:
-        for entry in os.scandir(path):
-            # print("Found entry ", entry.path)
-            if IPhotoLibrary.IsPhotosLibraryPackage(entry.path) == IPhotoLibrary.IPhotoLibraryVersion.MODERN:
-                # Process Modern iPhotos library using osxphotos
-                try:
-                    IPhotoLibrary.ProcessPhotosLibrary(entry.path)
-                except Exception as e:
-                    LOG('ERROR', f"Error processing Photos library {entry.path}: {str(e)}")
-            elif entry.is_dir() and IsValidSubDirectory(entry.path):
-                AnalyzeFolder(entry.path)
-            elif IsImageFile(entry.name):
-                settings.gFolderImageCount += 1
-                fullpath = os.path.join(path, entry.name)
-                AddPhoto(fullpath, entry.name, entry.stat().st_mtime)
-            elif IsZipFile(entry.name):
-                AnalyzeZip(entry.path)
-            elif entry.is_file():
-                settings.gNonImageFileCount += 1
-                LOG('DEBUG', f"Skipping non-image file: {entry.path}")
+        # Process Modern iPhotos library using osxphotos
+        with GetMetrics().Time('photos_library'):
+            record = IPhotoLibrary.ProcessPhotosLibrary(library_path)
+        # Written once its photos are processed, like directory manifests; until then later
+        # copies of the library in this run are already checked against it
+        if record is not None:
+            settings.gDatabase.QueuePhotoLibrary(library_path, *record)
     except Exception as e:
-        LOG('ERROR', f"Error scanning {path}: {str(e)}", exc_info=True)
+        LOG('ERROR', f"Error processing Photos library {library_path}: {str(e)}")
+    finally:
+        if unit is not None:
+            checkpoint.EndUnit(unit)
 
 
+def AnalyzeFolder(path, in_zip=False, checkpoint=None):
+    """Import the photos, ZIP files and Photos libraries below path.
+    
+    The tree is listed by Walker.WalkFolder with settings.gWalkWorkers concurrent directory
+    listings; this function imports what each listing yields, in the calling thread.
+    Directories left unchanged since an earlier run come back without files (see
+    Walker.VisitDirectory).
+    
+    Args:
+        path: Directory to scan
+        in_zip: True when path holds an extracted ZIP file; images are then counted as ZIP images
+        checkpoint: Optional Checkpoint.CrawlCheckpoint; the walk then starts from its state,
+            and every directory and library is tracked as a work unit until it is done
+    """
+    image_counter = 'zip_images' if in_zip else 'folder_images'
+    classifier = GetClassifier()
+
+    walk_state = None
+    if checkpoint is not None:
+        walk_state = checkpoint.walk
+        # Work that was in flight when the previous run stopped
+        for library_path in checkpoint.resume_libraries:
+            _ProcessLibrary(library_path, checkpoint)
+        for zip_path in checkpoint.resume_zips:
+            checkpoint.ZipQueued(None, zip_path)
+            SubmitZip(zip_path, checkpoint.ZipDone)
+
+    # Extracted ZIPs live at a new temp path every run, so they are never recorded
+    for listing in WalkFolder(path, settings.gWalkWorkers, track_manifests=not in_zip, state=walk_state):
+        for library_path in listing.libraries:
+            _ProcessLibrary(library_path, checkpoint)
+
+        directory = os.path.normpath(listing.path)
+        unit = checkpoint.BeginUnit(UNIT_DIRECTORY, directory) if checkpoint is not None else None
+        try:
+            for entry in listing.files:
+                kind = classifier.Kind(entry.name, entry.path)
+                if kind == KIND_IMAGE:
+                    CountStat(image_counter)
+                    entry_stat = entry.stat()
+                    CountStat('image_bytes', entry_stat.st_size)
+                    AddPhoto(entry.path, entry.name, entry_stat.st_mtime, entry_stat)
+                elif kind == KIND_ARCHIVE:
+                    if unit is not None:
+                        checkpoint.ZipQueued(unit, entry.path)
+                        SubmitZip(entry.path, checkpoint.ZipDone)
+                    else:
+                        SubmitZip(entry.path)
+                elif entry.is_file():
+                    CountStat('non_image_files')
+                    LOG('DEBUG', f"Skipping non-image file: {entry.path}")
+
+            # Written at the end of the run, once the photos queued above are processed;
+            # with a checkpoint, only once they are (see Checkpoint.CrawlCheckpoint)
+            if listing.manifest is not None:
+                if unit is not None:
+                    unit.manifest = listing.manifest
+                else:
+                    settings.gDatabase.QueueDirectoryManifest(directory, *listing.manifest)
+        except Exception as e:
+            LOG('ERROR', f"Error scanning {listing.path}: {str(e)}", exc_info=True)
+        finally:
+            if unit is not None:
+                checkpoint.EndUnit(unit)
@@ -2,15 +2,46 @@ import dataset
 import sqlite3
 import datetime
 import os
+import threading
+import time
+import atexit
+import json
+import bisect
+import xxhash
+from array import array
+from sqlalchemy import event
+from sqlalchemy import text
 from Utils import LOG
+from Utils import GetMetrics
 from Utils import ComputeQuickFileHash
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 # Database schema version - increment when making breaking changes (e.g., hash algorithm change)
 # Version history:
 #   1: Original MD5 hashing
 #   2: Changed to xxHash (xxh64) for faster hashing
 DB_SCHEMA_VERSION = 2
 
+# Key prefix of the per-run metrics summaries in the metadata table
+RUN_SUMMARY_PREFIX = 'run_summary:'
+
+# Key prefix of the crawl checkpoints in the metadata table (see Checkpoint.py)
+CHECKPOINT_PREFIX = 'checkpoint:'
+
+# Pragmas applied to every SQLite connection: WAL lets lookups run while a batch is written,
+# synchronous=NORMAL only fsyncs at checkpoints in WAL mode, and a 64MB page cache keeps the
+# hash and filename indexes in memory
+SQLITE_PRAGMAS = [
+	'PRAGMA journal_mode=WAL',
+	'PRAGMA synchronous=NORMAL',
+	'PRAGMA cache_size=-65536',
+	'PRAGMA temp_store=MEMORY',
+]
+
 
 class Base:
 	def __init__(self):
@@ -37,16 +68,283 @@ class Album:
 
 
 
+def _HashKey(in_hash):
+	"""Convert a hex xxh64 digest to the uint64 used as key in PhotoIndex.
+	
+	Returns None for a hash that is not hex (rows written by other tools or older versions).
+	"""
+	try:
+		return int(in_hash[:16], 16)
+	except ValueError:
+		return None
+
+
+def _PathKey(in_path):
+	"""Hash a source path to the uint64 used as key in PhotoIndex."""
+	return xxhash.xxh64_intdigest(in_path.encode('utf-8', 'surrogateescape'))
+
+
+def _SortedKeys(keys):
+	"""Sort and deduplicate an array('Q') of keys, using NumPy when available."""
+	if numpy is not None:
+		return array('Q', numpy.unique(numpy.frombuffer(keys, dtype=numpy.uint64)).tobytes())
+	return array('Q', sorted(set(keys)))
+
+
+def _SortOrder(keys):
+	"""Positions that sort an array('Q') of keys, using NumPy when available."""
+	if numpy is not None:
+		return numpy.argsort(numpy.frombuffer(keys, dtype=numpy.uint64), kind='stable').tolist()
+	return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+def _InodeKey(in_fingerprint):
+	"""Hash a (st_dev, st_ino, size, mtime_ns) fingerprint to the uint64 used as key in PhotoIndex."""
+	return xxhash.xxh64_intdigest(b'%d:%d:%d:%d' % tuple(in_fingerprint))
+
+
+class PhotoIndex:
+	"""Compact in-memory index of every hash and source path in the photos table.
+	
+	Both are stored as sorted arrays of 64-bit keys (8 bytes per row each) and searched with
+	bisect, so answering "seen before?" costs O(log n) comparisons and no SQLite round-trip.
+	Rows added during the run go to small sets next to the arrays.
+	
+	Source paths are keyed by their xxh64, so a false "seen" needs a 64-bit collision between
+	two paths; hashes are exact because the quick hash already is an xxh64. The rare hash that
+	is not hex has no key and is kept as a string in a set of its own.
+	
+	The fingerprints table is held the same way: parallel arrays sorted by path key (about
+	50 bytes per row), plus a sorted (dev, ino, size, mtime_ns) key for the lookup by inode.
+	Rows that do not fit the arrays and rows recorded during the run are kept as dicts.
+	The inode lookup may still find the row a path had before it was re-recorded, which is
+	harmless: an identical (dev, ino, size, mtime_ns) means the same unchanged file.
+	"""
+	def __init__(self):
+		self._hashes = array('Q')
+		self._paths = array('Q')
+		self._other_hashes = set()
+		self._added_hashes = set()
+		self._added_paths = set()
+		self.row_count = 0
+		self._fingerprint_paths = array('Q')
+		self._fingerprint_stats = (array('Q'), array('Q'), array('q'), array('q'))
+		self._fingerprint_hashes = array('Q')
+		self._fingerprint_hashed = bytearray()
+		self._inodes = array('Q')
+		self._inode_rows = array('Q')
+		self._other_fingerprints = {}
+		self._added_fingerprints = {}
+		self._added_inodes = {}
+		self.fingerprint_count = 0
+
+	def Load(self, in_db_path):
+		"""Read every hash and source path from the database file in one pass."""
+		hashes = array('Q')
+		paths = array('Q')
+		other_hashes = set()
+		conn = sqlite3.connect(f"file:{in_db_path}?mode=ro", uri=True)
+		try:
+			for row_hash, row_filename in conn.execute('SELECT hash, filename FROM photos'):
+				if row_hash:
+					key = _HashKey(row_hash)
+					if key is None:
+						other_hashes.add(row_hash)
+					else:
+						hashes.append(key)
+				if row_filename:
+					paths.append(_PathKey(row_filename))
+		finally:
+			conn.close()
+		if other_hashes:
+			LOG('WARNING', f"Photo index: {len(other_hashes)} hashes are not hex xxh64 digests, "
+						   f"first {next(iter(other_hashes))!r}; kept aside as strings")
+		self.row_count = max(len(hashes) + len(other_hashes), len(paths))
+		self._hashes = _SortedKeys(hashes)
+		self._paths = _SortedKeys(paths)
+		self._other_hashes = other_hashes
+		self._added_hashes = set()
+		self._added_paths = set()
+		self._LoadFingerprints(in_db_path)
+
+	def _LoadFingerprints(self, in_db_path):
+		"""Read every fingerprint row from the database file in one pass."""
+		paths = array('Q')
+		stats = (array('Q'), array('Q'), array('q'), array('q'))
+		hashes = array('Q')
+		hashed = bytearray()
+		other = {}
+		other_inodes = {}
+		conn = sqlite3.connect(f"file:{in_db_path}?mode=ro", uri=True)
+		try:
+			for path, dev, ino, size, mtime_ns, row_hash in conn.execute(
+					'SELECT path, dev, ino, size, mtime_ns, hash FROM fingerprints'):
+				key = _HashKey(row_hash) if row_hash else 0
+				try:
+					unsigned = array('Q', (dev, ino))
+					signed = array('q', (size, mtime_ns))
+				except (TypeError, OverflowError):
+					unsigned = None
+				if unsigned is None or key is None or (row_hash and '%016x' % key != row_hash):
+					# Not an xxh64 digest, or a stat value out of range: keep the row as it is
+					row = dict(path=path, dev=dev, ino=ino, size=size, mtime_ns=mtime_ns, hash=row_hash)
+					other[path] = row
+					if row_hash:
+						other_inodes[(dev, ino, size, mtime_ns)] = row
+					continue
+				stats[0].append(unsigned[0])
+				stats[1].append(unsigned[1])
+				stats[2].append(signed[0])
+				stats[3].append(signed[1])
+				paths.append(_PathKey(path))
+				hashes.append(key)
+				hashed.append(1 if row_hash else 0)
+		finally:
+			conn.close()
+		order = _SortOrder(paths)
+		self._fingerprint_paths = array('Q', (paths[i] for i in order))
+		self._fingerprint_stats = tuple(array(column.typecode, (column[i] for i in order)) for column in stats)
+		self._fingerprint_hashes = array('Q', (hashes[i] for i in order))
+		self._fingerprint_hashed = bytearray(hashed[i] for i in order)
+		del paths, hashes, hashed
+		inodes = array('Q')
+		rows = array('Q')
+		for row, is_hashed in enumerate(self._fingerprint_hashed):
+			if is_hashed:
+				inodes.append(_InodeKey(column[row] for column in self._fingerprint_stats))
+				rows.append(row)
+		order = _SortOrder(inodes)
+		self._inodes = array('Q', (inodes[i] for i in order))
+		self._inode_rows = array('Q', (rows[i] for i in order))
+		self._other_fingerprints = other
+		self._added_fingerprints = {}
+		self._added_inodes = other_inodes
+		self.fingerprint_count = len(self._fingerprint_paths) + len(other)
+
+	def MemoryBytes(self):
+		"""Approximate memory used by the index in bytes."""
+		import sys
+		arrays = (self._hashes, self._paths, self._fingerprint_paths, self._fingerprint_hashes,
+				  self._inodes, self._inode_rows) + self._fingerprint_stats
+		return (sum(keys.buffer_info()[1] * keys.itemsize for keys in arrays) +
+				len(self._fingerprint_hashed) +
+				sys.getsizeof(self._other_hashes) + sys.getsizeof(self._other_fingerprints) +
+				sys.getsizeof(self._added_hashes) + sys.getsizeof(self._added_paths) +
+				sys.getsizeof(self._added_fingerprints) + sys.getsizeof(self._added_inodes))
+
+	@staticmethod
+	def _Contains(keys, key):
+		i = bisect.bisect_left(keys, key)
+		return i < len(keys) and keys[i] == key
+
+	def HasHash(self, in_hash):
+		key = _HashKey(in_hash)
+		if key is None:
+			return in_hash in self._other_hashes
+		return key in self._added_hashes or self._Contains(self._hashes, key)
+
+	def HasPath(self, in_path):
+		key = _PathKey(in_path)
+		return key in self._added_paths or self._Contains(self._paths, key)
+
+	def Add(self, in_hash, in_path):
+		key = _HashKey(in_hash)
+		if key is None:
+			self._other_hashes.add(in_hash)
+		else:
+			self._added_hashes.add(key)
+		self._added_paths.add(_PathKey(in_path))
+
+	def _FingerprintRow(self, in_row, in_path):
+		dev, ino, size, mtime_ns = (column[in_row] for column in self._fingerprint_stats)
+		row_hash = '%016x' % self._fingerprint_hashes[in_row] if self._fingerprint_hashed[in_row] else None
+		return dict(path=in_path, dev=dev, ino=ino, size=size, mtime_ns=mtime_ns, hash=row_hash)
+
+	def GetFingerprint(self, in_path):
+		"""Fingerprint row of a source path (same keys as the table), or None if it was never seen."""
+		if in_path in self._added_fingerprints:
+			return self._added_fingerprints[in_path]
+		if in_path in self._other_fingerprints:
+			return self._other_fingerprints[in_path]
+		key = _PathKey(in_path)
+		keys = self._fingerprint_paths
+		i = bisect.bisect_left(keys, key)
+		if i < len(keys) and keys[i] == key:
+			return self._FingerprintRow(i, in_path)
+		return None
+
+	def FindFingerprintByInode(self, in_fingerprint):
+		"""Hashed fingerprint row with the same (dev, ino, size, mtime_ns), or None.
+		
+		Rows loaded from the database only keep the key of their path, so 'path' is None.
+		"""
+		in_fingerprint = tuple(in_fingerprint)
+		if in_fingerprint in self._added_inodes:
+			return self._added_inodes[in_fingerprint]
+		key = _InodeKey(in_fingerprint)
+		i = bisect.bisect_left(self._inodes, key)
+		while i < len(self._inodes) and self._inodes[i] == key:
+			row = self._inode_rows[i]
+			if tuple(column[row] for column in self._fingerprint_stats) == in_fingerprint:
+				return self._FingerprintRow(row, None)
+			i += 1
+		return None
+
+	def AddFingerprint(self, in_row):
+		"""Record a fingerprint row written during the run; it replaces any loaded row of its path."""
+		self._added_fingerprints[in_row['path']] = in_row
+		if in_row['hash']:
+			self._added_inodes[(in_row['dev'], in_row['ino'], in_row['size'], in_row['mtime_ns'])] = in_row
+
+
 class DataBase:
-	def __init__(self,in_path):
+	def __init__(self,in_path,in_flush_rows=0,in_flush_interval_ms=1000,in_dry_run=False):
+		"""Open (or create) myphotos.db in the given directory.
+		
+		Args:
+			in_path: Directory containing the database file
+			in_flush_rows: Write-behind batch size. When > 0, AddPhoto buffers rows and writes them
+				in one transaction every in_flush_rows rows or in_flush_interval_ms milliseconds.
+				0 writes every row immediately.
+			in_flush_interval_ms: Maximum time a buffered row waits before it is written
+			in_dry_run: Write nothing (plan mode, see Plan.py): every change stays buffered in
+				memory, where the lookups of this run still find it, and is dropped on Close
+		"""
 		# Ensure path ends with separator for directory paths
 		if not in_path.endswith(os.sep) and not in_path.endswith('/'):
 			in_path = in_path + os.sep
 		# Construct full database path
 		db_path = in_path + 'myphotos.db'
+		self.db_path = db_path
 		
 		LOG('DEBUG', f"Opening database at: {db_path}")
 		
+		# Serializes access from the crawler and ingest pipeline threads
+		self.lock = threading.RLock()
+		
+		# Write-behind buffer: rows not yet written, indexed for lookups made before the flush
+		self.dry_run = in_dry_run
+		self.flush_rows = max(in_flush_rows, 1) if in_dry_run else in_flush_rows
+		self.flush_interval = in_flush_interval_ms / 1000.0
+		self._pending = []
+		self._pending_by_hash = {}
+		self._pending_by_filename = {}
+		self._pending_fingerprints = {}
+		self._pending_perceptual = {}
+		self._pending_full_hashes = {}
+		# Directory manifests are held back until the photos of the run are fully processed
+		self._deferred_directories = []
+		# Likewise Photos library fingerprints, and their assets by UUID
+		self._deferred_libraries = []
+		self._deferred_library_assets = {}
+		self._last_flush = time.monotonic()
+		self._flush_stop = threading.Event()
+		self._flush_thread = None
+		self._closed = False
+		
+		# Optional in-memory index of known hashes and source paths (see LoadIndex)
+		self.index = None
+		
 		# Check if database file exists
 		db_exists = os.path.exists(db_path)
 		if db_exists:
@@ -55,20 +353,171 @@ class DataBase:
 			LOG('INFO', f"Creating new database file: {db_path}")
 		
 		try:
-			self.db = dataset.connect('sqlite:///' + db_path)
+			# dataset keeps one connection per thread for the life of the thread; with the default
+			# pool limit, walk, pre-count and pipeline threads together can exhaust the pool and
+			# block while another thread waits on self.lock, so the pool may grow without limit
+			self.db = dataset.connect('sqlite:///' + db_path, engine_kwargs=dict(max_overflow=-1))
+			self._configure_sqlite()
 			LOG('INFO', f"Database opened successfully: {db_path}")
 			
 			# Check and handle database version migration
 			self._check_and_migrate_version()
 			
+			# dataset creates tables lazily on first insert; the indexes below need the table now
+			self.db.query('CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, name TEXT, filename TEXT, timestamp FLOAT, hash TEXT)')
+			
 			# Create indexes for faster lookups (O(1) instead of O(n) table scan)
 			self.db.query('CREATE INDEX IF NOT EXISTS idx_photos_hash ON photos(hash)')
 			self.db.query('CREATE INDEX IF NOT EXISTS idx_photos_filename ON photos(filename)')
+			
+			# Per-source stat fingerprints, so unchanged files are not hashed again on the next run
+			self.db.query('CREATE TABLE IF NOT EXISTS fingerprints (id INTEGER PRIMARY KEY, path TEXT, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_fingerprints_path ON fingerprints(path)')
+			self.db.query('CREATE INDEX IF NOT EXISTS idx_fingerprints_inode ON fingerprints(dev, ino)')
+			
+			# Per-directory manifests, so unchanged directories are not listed or checked again
+			self.db.query('CREATE TABLE IF NOT EXISTS directories (id INTEGER PRIMARY KEY, path TEXT, mtime_ns INTEGER, entry_count INTEGER, digest TEXT, subdirs TEXT)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_directories_path ON directories(path)')
+			
+			# Perceptual hashes of the photos in the output, keyed by their destination (see PerceptualHash.py)
+			self.db.query('CREATE TABLE IF NOT EXISTS perceptual_hashes (id INTEGER PRIMARY KEY, dest TEXT, hash TEXT, phash TEXT, pixels INTEGER, size INTEGER, quality REAL, aspect REAL, taken FLOAT)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_perceptual_hashes_dest ON perceptual_hashes(dest)')
+			columns = {row['name'] for row in self.db.query('PRAGMA table_info(perceptual_hashes)')}
+			if 'quality' not in columns:
+				# Tables from before quality scores; old rows are scored from their file when compared
+				self.db.query('ALTER TABLE perceptual_hashes ADD COLUMN quality REAL')
+			if 'aspect' not in columns:
+				# Likewise aspect ratios and capture dates, read from the file when compared
+				self.db.query('ALTER TABLE perceptual_hashes ADD COLUMN aspect REAL')
+				self.db.query('ALTER TABLE perceptual_hashes ADD COLUMN taken FLOAT')
+			
+			# Full-content hashes of source files whose quick hash matched another file (see Utils.IsKnownDuplicate)
+			self.db.query('CREATE TABLE IF NOT EXISTS full_hashes (id INTEGER PRIMARY KEY, path TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT, full_hash TEXT)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_full_hashes_path ON full_hashes(path)')
+			
+			# Fingerprints of imported Photos libraries and the assets imported from them, so copies
+			# of a library are skipped whole or only import their new assets (see IPhotoLibrary.py)
+			self.db.query('CREATE TABLE IF NOT EXISTS photo_libraries (id INTEGER PRIMARY KEY, path TEXT, asset_count INTEGER, max_modified FLOAT, digest TEXT, missing INTEGER)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_photo_libraries_path ON photo_libraries(path)')
+			self.db.query('CREATE INDEX IF NOT EXISTS idx_photo_libraries_digest ON photo_libraries(digest)')
+			self.db.query('CREATE TABLE IF NOT EXISTS library_assets (id INTEGER PRIMARY KEY, uuid TEXT, size INTEGER, modified FLOAT)')
+			self.db.query('CREATE UNIQUE INDEX IF NOT EXISTS idx_library_assets_uuid ON library_assets(uuid)')
 			LOG('DEBUG', "Database indexes on hash and filename columns ensured")
 		except Exception as e:
 			error_msg = f"Unexpected error opening database at {db_path}. Error: {str(e)}"
 			LOG('ERROR', error_msg, exc_info=True)
 			raise
+		
+		if self.dry_run:
+			LOG('INFO', "Dry run: nothing is written to the database")
+		elif self.flush_rows > 0:
+			LOG('INFO', f"Write-behind enabled: flushing every {self.flush_rows} rows or {in_flush_interval_ms} ms")
+			self._flush_thread = threading.Thread(target=self._flush_loop, name="database-flush", daemon=True)
+			self._flush_thread.start()
+		# Last line of defence; PhotoCrawler.Main closes the database explicitly
+		atexit.register(self.Close)
+
+	def LoadIndex(self):
+		"""Preload all hashes, source paths and fingerprints into a PhotoIndex.
+		
+		Afterwards lookups for unknown hashes and source paths are answered from memory;
+		only hits still query SQLite for the full row. Fingerprint lookups, hits included,
+		are answered from memory.
+		"""
+		with self.lock:
+			self.Flush()
+			start = time.monotonic()
+			index = PhotoIndex()
+			index.Load(self.db_path)
+			self.index = index
+			size = index.MemoryBytes()
+			per_million = size * 1000000 / index.row_count if index.row_count else 0
+			LOG('INFO', f"Photo index loaded: {index.row_count} rows and {index.fingerprint_count} fingerprints "
+						f"in {time.monotonic() - start:.2f}s, "
+						f"{size / (1024 * 1024):.1f} MB ({per_million / (1024 * 1024):.1f} MB per million rows)")
+
+	def _configure_sqlite(self):
+		"""Apply SQLITE_PRAGMAS to the current connection and to every connection opened later."""
+		def _on_connect(dbapi_connection, connection_record):
+			cursor = dbapi_connection.cursor()
+			for pragma in SQLITE_PRAGMAS:
+				cursor.execute(pragma)
+			cursor.close()
+		event.listen(self.db.engine, 'connect', _on_connect)
+		for pragma in SQLITE_PRAGMAS:
+			self.db.query(pragma)
+
+	def _flush_loop(self):
+		"""Background thread writing buffered rows that are older than the flush interval."""
+		while not self._flush_stop.wait(self.flush_interval / 2):
+			if self._HasPending() and time.monotonic() - self._last_flush >= self.flush_interval:
+				try:
+					self.Flush()
+				except Exception:
+					# Already logged by Flush; the rows stay buffered for the next attempt
+					pass
+
+	def _Buffering(self):
+		"""Whether a change goes to the write-behind buffer rather than straight to the database.
+		
+		Once Close has run nothing flushes the buffer any more, so later changes are written
+		through (except in a dry run, which writes nothing anyway).
+		"""
+		return self.flush_rows > 0 and (not self._closed or self.dry_run)
+
+	def _HasPending(self):
+		return bool(self._pending or self._pending_fingerprints or self._pending_perceptual or self._pending_full_hashes)
+
+	def _CheckFlush(self):
+		"""Flush the write-behind buffer when it is full or its oldest row is too old."""
+		pending_count = (len(self._pending) + len(self._pending_fingerprints) + len(self._pending_perceptual)
+		                 + len(self._pending_full_hashes))
+		if pending_count >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+			self.Flush()
+
+	def Flush(self):
+		"""Write all buffered photos and fingerprints in a single transaction."""
+		with self.lock:
+			self._last_flush = time.monotonic()
+			if self.dry_run or not self._HasPending():
+				return
+			rows = self._pending
+			fingerprints = list(self._pending_fingerprints.values())
+			perceptual = self._pending_perceptual
+			full_hashes = list(self._pending_full_hashes.values())
+			try:
+				with GetMetrics().Time('db_write'):
+					self.db.begin()
+					if rows:
+						self.db['photos'].insert_many(rows)
+					if fingerprints:
+						self._write_fingerprints(fingerprints)
+					if perceptual:
+						self._write_perceptual_hashes(perceptual)
+					if full_hashes:
+						self._write_full_hashes(full_hashes)
+					self.db.commit()
+			except Exception as e:
+				self.db.rollback()
+				LOG('ERROR', f"Unexpected error writing {len(rows)} buffered photos and {len(fingerprints)} fingerprints: {str(e)}", exc_info=True)
+				raise
+			self._pending = []
+			self._pending_by_hash = {}
+			self._pending_by_filename = {}
+			self._pending_fingerprints = {}
+			self._pending_perceptual = {}
+			self._pending_full_hashes = {}
+			LOG('DEBUG', f"Flushed {len(rows)} photos and {len(fingerprints)} fingerprints to database")
+
+	def Close(self):
+		"""Stop the flush thread and write any buffered rows. Safe to call more than once."""
+		if self._closed:
+			return
+		self._closed = True
+		self._flush_stop.set()
+		if self._flush_thread is not None:
+			self._flush_thread.join()
+		self.Flush()
 
 	def _check_and_migrate_version(self):
 		"""Check database schema version and migrate if necessary.
@@ -124,6 +573,12 @@ class DataBase:
 		try:
 			photos_table = self.db['photos']
 			photos_table.delete()
+			# Fingerprints and full hashes carry hashes too, which are just as incompatible;
+			# directory manifests and Photos library fingerprints (with the assets imported
+			# from each library) would skip the files that now need to be imported again
+			for table_name in ('fingerprints', 'directories', 'full_hashes', 'photo_libraries', 'library_assets'):
+				if table_name in self.db.tables:
+					self.db[table_name].delete()
 			LOG('INFO', "Photos table cleared successfully")
 		except Exception as e:
 			LOG('ERROR', f"Error clearing photos table: {str(e)}", exc_info=True)
@@ -132,26 +587,41 @@ class DataBase:
 
 	def AddPhoto(self, in_name, in_filename, in_timestamp, in_hash):
 		# LOG('DEBUG', f"Adding photo to database: {in_filename} (hash: {in_hash[:16]}...)")
-		try:
-			table = self.db['photos']
-			table.insert(dict(name=in_name, filename=in_filename, timestamp=in_timestamp, hash=in_hash))
-			# LOG('DEBUG', f"Photo added successfully: {in_filename}")
-			return True
-		except Exception as e:
-			error_msg = f"Unexpected error adding photo {in_filename}: {str(e)}"
-			LOG('ERROR', error_msg, exc_info=True)
-			raise
-		return False
+		with self.lock:
+			row = dict(name=in_name, filename=in_filename, timestamp=in_timestamp, hash=in_hash)
+			if self.index is not None:
+				self.index.Add(in_hash, in_filename)
+			if self._Buffering():
+				self._pending.append(row)
+				self._pending_by_hash.setdefault(in_hash, row)
+				self._pending_by_filename.setdefault(in_filename, row)
+				self._CheckFlush()
+				return True
+			try:
+				table = self.db['photos']
+				with GetMetrics().Time('db_write'):
+					table.insert(row)
+				# LOG('DEBUG', f"Photo added successfully: {in_filename}")
+				return True
+			except Exception as e:
+				error_msg = f"Unexpected error adding photo {in_filename}: {str(e)}"
+				LOG('ERROR', error_msg, exc_info=True)
+				raise
+			return False
 
 
 	def FindPhoto(self, in_filename):
 		"""Find a photo by filename in the database."""
 		# LOG('DEBUG', f"Finding photo in database: {in_filename}")
 		
+		with self.lock:
+			pending = [row for row in self._pending if row['filename'] == in_filename]
 		try:
 			table = self.db['photos']
 			result = table.find(filename=in_filename)
 			# LOG('DEBUG', f"Photo lookup completed for: {in_filename}")
+			if pending:
+				return iter(pending + list(result))
 			return result
 		except Exception as e:
 			error_msg = f"Unexpected error finding photo {in_filename}: {str(e)}"
@@ -163,15 +633,54 @@ class DataBase:
 		"""Get the attributes of a photo by file hash."""
 		# LOG('DEBUG', f"Finding photo in database: {in_filename}")
 		
-		try:
-			table = self.db['photos']
-			result = table.find_one(hash=in_file_hash)
-			# LOG('DEBUG', f"Photo lookup completed for: {in_filename}")
-			return result
-		except Exception as e:
-			error_msg = f"Unexpected error finding photo by hash {in_file_hash}: {str(e)}"
-			LOG('ERROR', error_msg, exc_info=True)
-			return None
+		with self.lock:
+			try:
+				if in_file_hash in self._pending_by_hash:
+					return self._pending_by_hash[in_file_hash]
+				if self.index is not None and not self.index.HasHash(in_file_hash):
+					return None
+				table = self.db['photos']
+				result = table.find_one(hash=in_file_hash)
+				# LOG('DEBUG', f"Photo lookup completed for: {in_filename}")
+				return result
+			except Exception as e:
+				error_msg = f"Unexpected error finding photo by hash {in_file_hash}: {str(e)}"
+				LOG('ERROR', error_msg, exc_info=True)
+				return None
+
+
+	def FindPhotosByHash(self, in_file_hash):
+		"""Get every photo with a quick hash; there are several only after quick hash collisions."""
+		with self.lock:
+			try:
+				pending = [row for row in self._pending if row['hash'] == in_file_hash] if in_file_hash in self._pending_by_hash else []
+				if self.index is not None and not self.index.HasHash(in_file_hash):
+					return pending
+				return pending + list(self.db['photos'].find(hash=in_file_hash))
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error finding photos by hash {in_file_hash}: {str(e)}", exc_info=True)
+				return []
+
+
+	def FindKnownHashes(self, in_hashes, in_batch_size=500):
+		"""Return the subset of in_hashes already in the photos table, in batched queries.
+		
+		Used by the shard merge (see Shard.py) to check a whole set of hashes at once instead
+		of one lookup per file.
+		"""
+		with self.lock:
+			self.Flush()
+			hashes = list(in_hashes)
+			if self.index is not None:
+				hashes = [file_hash for file_hash in hashes if self.index.HasHash(file_hash)]
+			known = set()
+			for start in range(0, len(hashes), in_batch_size):
+				batch = hashes[start:start + in_batch_size]
+				placeholders = ', '.join(f':h{i}' for i in range(len(batch)))
+				rows = self.db.query(f'SELECT DISTINCT hash FROM photos WHERE hash IN ({placeholders})',
+									 **{f'h{i}': file_hash for i, file_hash in enumerate(batch)})
+				known.update(row['hash'] for row in rows)
+			return known
 
 
 	def FindPhotoBySourcePath(self, source_path):
@@ -186,29 +695,414 @@ class DataBase:
 		Returns:
 			Photo attributes dict if found, None otherwise
 		"""
-		try:
-			table = self.db['photos']
-			result = table.find_one(filename=source_path)
-			return result
-		except Exception as e:
-			error_msg = f"Unexpected error finding photo by source path {source_path}: {str(e)}"
-			LOG('ERROR', error_msg, exc_info=True)
-			return None		
+		with self.lock:
+			try:
+				if source_path in self._pending_by_filename:
+					return self._pending_by_filename[source_path]
+				if self.index is not None and not self.index.HasPath(source_path):
+					return None
+				table = self.db['photos']
+				result = table.find_one(filename=source_path)
+				return result
+			except Exception as e:
+				error_msg = f"Unexpected error finding photo by source path {source_path}: {str(e)}"
+				LOG('ERROR', error_msg, exc_info=True)
+				return None		
+
+
+	def HasSourcePath(self, source_path):
+		"""Check whether a source path was already imported.
+		
+		With a preloaded index this never touches SQLite.
+		
+		Args:
+			source_path: The full source path of the file being imported
+			
+		Returns:
+			bool: True if a photo with this source path is in the database
+		"""
+		with self.lock:
+			if self.index is not None:
+				return self.index.HasPath(source_path)
+		return self.FindPhotoBySourcePath(source_path) is not None
+
+
+	def _write_fingerprints(self, rows):
+		self.db.executable.execute(text(
+			'INSERT OR REPLACE INTO fingerprints (path, dev, ino, size, mtime_ns, hash) '
+			'VALUES (:path, :dev, :ino, :size, :mtime_ns, :hash)'), rows)
+
+
+	def SetFingerprint(self, in_path, in_fingerprint, in_hash):
+		"""Record the stat fingerprint (and quick hash, if known) of a source file.
+		
+		Args:
+			in_path: Full source path
+			in_fingerprint: (st_dev, st_ino, size, mtime_ns) tuple, see Utils.StatFingerprint
+			in_hash: Quick hash of the file, or None if it was skipped without hashing
+		"""
+		dev, ino, size, mtime_ns = in_fingerprint
+		row = dict(path=in_path, dev=dev, ino=ino, size=size, mtime_ns=mtime_ns, hash=in_hash)
+		with self.lock:
+			if self.index is not None:
+				self.index.AddFingerprint(row)
+			if self._Buffering():
+				self._pending_fingerprints[in_path] = row
+				self._CheckFlush()
+				return
+			try:
+				self.db.begin()
+				self._write_fingerprints([row])
+				self.db.commit()
+			except Exception as e:
+				self.db.rollback()
+				LOG('ERROR', f"Unexpected error recording fingerprint of {in_path}: {str(e)}", exc_info=True)
+
+
+	def GetFingerprint(self, in_path):
+		"""Get the stored fingerprint row of a source path, or None if it was never seen.
+		
+		With a preloaded index this never touches SQLite.
+		"""
+		with self.lock:
+			if in_path in self._pending_fingerprints:
+				return self._pending_fingerprints[in_path]
+			if self.index is not None:
+				return self.index.GetFingerprint(in_path)
+			try:
+				return self.db['fingerprints'].find_one(path=in_path)
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error finding fingerprint of {in_path}: {str(e)}", exc_info=True)
+				return None
+
+
+	def FindFingerprintByInode(self, in_fingerprint):
+		"""Find a hashed fingerprint row for the same unchanged file seen under another path.
+		
+		Catches renamed mount points and moved folders: same device, inode, size and mtime.
+		"""
+		dev, ino, size, mtime_ns = in_fingerprint
+		with self.lock:
+			# The index also holds every row recorded since it was loaded, pending ones included
+			if self.index is not None:
+				return self.index.FindFingerprintByInode(in_fingerprint)
+			for row in self._pending_fingerprints.values():
+				if row['hash'] and (row['dev'], row['ino'], row['size'], row['mtime_ns']) == in_fingerprint:
+					return row
+			try:
+				for row in self.db['fingerprints'].find(dev=dev, ino=ino, size=size, mtime_ns=mtime_ns):
+					if row['hash']:
+						return row
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error finding fingerprint by inode {dev}:{ino}: {str(e)}", exc_info=True)
+			return None
+
+
+	def _write_perceptual_hashes(self, changes):
+		rows = [row for row in changes.values() if row is not None]
+		removed = [dict(dest=dest) for dest, row in changes.items() if row is None]
+		if rows:
+			self.db.executable.execute(text(
+				'INSERT OR REPLACE INTO perceptual_hashes (dest, hash, phash, pixels, size, quality, aspect, taken) '
+				'VALUES (:dest, :hash, :phash, :pixels, :size, :quality, :aspect, :taken)'), rows)
+		if removed:
+			self.db.executable.execute(text('DELETE FROM perceptual_hashes WHERE dest = :dest'), removed)
+
+
+	def SetPerceptualHash(self, in_dest, in_hash, in_phash, in_pixels, in_size, in_quality=None, in_aspect=None, in_taken=None):
+		"""Record the perceptual hash, quality score, aspect ratio and capture date of a photo copied to in_dest (in_phash is an int)."""
+		self._ChangePerceptualHash(in_dest, dict(dest=in_dest, hash=in_hash, phash=f"{in_phash:016x}", pixels=in_pixels,
+		                                         size=in_size, quality=in_quality, aspect=in_aspect, taken=in_taken))
+
+
+	def RemovePerceptualHash(self, in_dest):
+		"""Forget the perceptual hash of a photo replaced by a better near-duplicate."""
+		self._ChangePerceptualHash(in_dest, None)
+
+
+	def _ChangePerceptualHash(self, in_dest, in_row):
+		with self.lock:
+			self._pending_perceptual[in_dest] = in_row
+			if self._Buffering():
+				self._CheckFlush()
+			else:
+				self.Flush()
+
+
+	def GetPerceptualHashes(self):
+		"""Yield every stored perceptual hash row, with phash as an int."""
+		with self.lock:
+			self.Flush()
+			rows = list(self.db.query('SELECT dest, hash, phash, pixels, size, quality, aspect, taken FROM perceptual_hashes'))
+		for row in rows:
+			yield dict(dest=row['dest'], hash=row['hash'], phash=int(row['phash'], 16), pixels=row['pixels'], size=row['size'],
+			           quality=row['quality'], aspect=row['aspect'], taken=row['taken'])
+
+
+	def _write_full_hashes(self, rows):
+		self.db.executable.execute(text(
+			'INSERT OR REPLACE INTO full_hashes (path, size, mtime_ns, hash, full_hash) '
+			'VALUES (:path, :size, :mtime_ns, :hash, :full_hash)'), rows)
+
+
+	def SetFullHash(self, in_path, in_size, in_mtime_ns, in_hash, in_full_hash):
+		"""Record the full-content hash of a source file, valid while its size and mtime are unchanged.
+		
+		Args:
+			in_path: Full source path (or virtual path of a ZIP entry)
+			in_size: Size of the file (of the ZIP file, for an entry)
+			in_mtime_ns: Modification time of the file in nanoseconds (of the ZIP file, for an entry)
+			in_hash: Quick hash of the file
+			in_full_hash: Utils.ComputeFileHash value of the file
+		"""
+		row = dict(path=in_path, size=in_size, mtime_ns=in_mtime_ns, hash=in_hash, full_hash=in_full_hash)
+		with self.lock:
+			self._pending_full_hashes[in_path] = row
+			if self._Buffering():
+				self._CheckFlush()
+			else:
+				self.Flush()
+
+
+	def GetFullHash(self, in_path, in_size, in_mtime_ns):
+		"""Get the full-content hash recorded for a source file, or None if it changed or was never hashed."""
+		with self.lock:
+			row = self._pending_full_hashes.get(in_path)
+			if row is None:
+				try:
+					row = self.db['full_hashes'].find_one(path=in_path)
+				except Exception as e:
+					LOG('ERROR', f"Unexpected error finding full hash of {in_path}: {str(e)}", exc_info=True)
+					return None
+		if row is None or (row['size'], row['mtime_ns']) != (in_size, in_mtime_ns):
+			return None
+		return row['full_hash']
+
+
+	def GetDirectoryManifest(self, in_path):
+		"""Get the manifest recorded for a directory by an earlier run, or None."""
+		with self.lock:
+			try:
+				return self.db['directories'].find_one(path=in_path)
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error finding manifest of {in_path}: {str(e)}", exc_info=True)
+				return None
+
+
+	def QueueDirectoryManifest(self, in_path, in_mtime_ns, in_entry_count, in_digest, in_subdirs):
+		"""Remember a directory manifest to be written by CommitDirectoryManifests.
+		
+		Args:
+			in_path: Directory path
+			in_mtime_ns: mtime of the directory, taken before it was listed
+			in_entry_count: Number of entries in the directory
+			in_digest: Order-independent digest of the entry names, sizes and mtimes
+			in_subdirs: Names of the subdirectories to descend into when the directory is unchanged
+		"""
+		row = dict(path=in_path, mtime_ns=in_mtime_ns, entry_count=in_entry_count,
+				   digest=in_digest, subdirs=json.dumps(in_subdirs))
+		with self.lock:
+			self._deferred_directories.append(row)
+
+
+	def CommitDirectoryManifests(self, in_incomplete_directories=()):
+		"""Write the queued directory manifests in one transaction.
+		
+		Call only once every photo found in those directories has been processed. Directories
+		listed in in_incomplete_directories (where an import failed) are not recorded, so the
+		next run checks them again.
+		"""
+		if self.dry_run:
+			return
+		with self.lock:
+			rows = [row for row in self._deferred_directories if row['path'] not in in_incomplete_directories]
+			self._deferred_directories = []
+			if not rows:
+				return
+			try:
+				self.db.begin()
+				self.db.executable.execute(text(
+					'INSERT OR REPLACE INTO directories (path, mtime_ns, entry_count, digest, subdirs) '
+					'VALUES (:path, :mtime_ns, :entry_count, :digest, :subdirs)'), rows)
+				self.db.commit()
+				LOG('INFO', f"Recorded {len(rows)} directory manifests")
+			except Exception as e:
+				self.db.rollback()
+				LOG('ERROR', f"Unexpected error recording {len(rows)} directory manifests: {str(e)}", exc_info=True)
+
+
+	def FindPhotoLibrary(self, in_fingerprint):
+		"""Find a library recorded with the given fingerprint and no missing assets.
+		
+		Args:
+			in_fingerprint: PhotosDatabase.LibraryFingerprint
+		
+		Returns:
+			Path of the recorded library (which may be in_fingerprint's own), or None
+		"""
+		with self.lock:
+			for row in self._deferred_libraries:
+				if (row['asset_count'], row['max_modified'], row['digest']) == tuple(in_fingerprint) and row['missing'] == 0:
+					return row['path']
+			try:
+				rows = self.db.query('SELECT path, asset_count, max_modified FROM photo_libraries WHERE digest = :digest AND missing = 0',
+									 digest=in_fingerprint.digest)
+				for row in rows:
+					if (row['asset_count'], row['max_modified']) == (in_fingerprint.asset_count, in_fingerprint.max_modified):
+						return row['path']
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error finding Photos library {in_fingerprint.digest}: {str(e)}", exc_info=True)
+			return None
+
+
+	def FindLibraryAssets(self, in_assets, in_batch_size=500):
+		"""Return the UUIDs of the assets already imported from a Photos library, in batched queries.
+		
+		An asset counts as imported when a library recorded it with the same size and
+		modification date, so edited assets are imported again.
+		
+		Args:
+			in_assets: PhotosDatabase.PhotosAsset records
+		"""
+		with self.lock:
+			assets = {}
+			known = set()
+			for asset in in_assets:
+				if self._deferred_library_assets.get(asset.uuid) == (asset.size, asset.modified):
+					known.add(asset.uuid)
+				else:
+					assets[asset.uuid] = asset
+			uuids = list(assets)
+			for start in range(0, len(uuids), in_batch_size):
+				batch = uuids[start:start + in_batch_size]
+				placeholders = ', '.join(f':u{i}' for i in range(len(batch)))
+				rows = self.db.query(f'SELECT uuid, size, modified FROM library_assets WHERE uuid IN ({placeholders})',
+									 **{f'u{i}': uuid for i, uuid in enumerate(batch)})
+				known.update(row['uuid'] for row in rows
+							 if (row['size'], row['modified']) == (assets[row['uuid']].size, assets[row['uuid']].modified))
+			return known
+
+
+	def QueuePhotoLibrary(self, in_path, in_fingerprint, in_missing, in_assets):
+		"""Remember a Photos library fingerprint to be written by CommitPhotoLibraries.
+		
+		Args:
+			in_path: Library package path
+			in_fingerprint: PhotosDatabase.LibraryFingerprint
+			in_missing: Number of assets whose file was not in the library (e.g. only in iCloud)
+			in_assets: PhotosDatabase.PhotosAsset records handed to the import
+		"""
+		row = dict(path=in_path, asset_count=in_fingerprint.asset_count, max_modified=in_fingerprint.max_modified,
+				   digest=in_fingerprint.digest, missing=in_missing,
+				   assets=[dict(uuid=asset.uuid, size=asset.size, modified=asset.modified) for asset in in_assets])
+		with self.lock:
+			self._deferred_libraries.append(row)
+			for asset in row['assets']:
+				self._deferred_library_assets[asset['uuid']] = (asset['size'], asset['modified'])
+
+
+	def CommitPhotoLibraries(self, in_incomplete_directories=(), in_busy_libraries=()):
+		"""Write the queued Photos library fingerprints and their assets in one transaction.
+		
+		Call only once every photo of those libraries has been processed, except for the
+		libraries listed in in_busy_libraries: these stay queued for a later call. A library
+		holding one of in_incomplete_directories (where an import failed) is not recorded.
+		"""
+		if self.dry_run:
+			return
+		with self.lock:
+			incomplete = [directory + os.sep for directory in in_incomplete_directories]
+			rows = []
+			busy = []
+			for row in self._deferred_libraries:
+				if row['path'] in in_busy_libraries:
+					busy.append(row)
+				elif not any(directory.startswith(os.path.normpath(row['path']) + os.sep) for directory in incomplete):
+					rows.append(row)
+			self._deferred_libraries = busy
+			self._deferred_library_assets = {asset['uuid']: (asset['size'], asset['modified'])
+											 for row in busy for asset in row['assets']}
+			if not rows:
+				return
+			try:
+				self.db.begin()
+				self.db.executable.execute(text(
+					'INSERT OR REPLACE INTO photo_libraries (path, asset_count, max_modified, digest, missing) '
+					'VALUES (:path, :asset_count, :max_modified, :digest, :missing)'),
+					[{key: row[key] for key in ('path', 'asset_count', 'max_modified', 'digest', 'missing')} for row in rows])
+				assets = [asset for row in rows for asset in row['assets']]
+				if assets:
+					self.db.executable.execute(text(
+						'INSERT OR REPLACE INTO library_assets (uuid, size, modified) VALUES (:uuid, :size, :modified)'), assets)
+				self.db.commit()
+				LOG('INFO', f"Recorded {len(rows)} Photos library fingerprints with {len(assets)} new assets")
+			except Exception as e:
+				self.db.rollback()
+				LOG('ERROR', f"Unexpected error recording {len(rows)} Photos library fingerprints: {str(e)}", exc_info=True)
+
+
+	def RecordRunSummary(self, in_summary):
+		"""Store the metrics summary of a run in the metadata table, keyed by its start time.
+		
+		Args:
+			in_summary: Metrics.Metrics.Snapshot() of the run
+		"""
+		if self.dry_run:
+			return
+		with self.lock:
+			try:
+				self.db['metadata'].upsert(dict(key=RUN_SUMMARY_PREFIX + in_summary['started'], value=json.dumps(in_summary)), ['key'])
+			except Exception as e:
+				LOG('ERROR', f"Unexpected error recording run summary: {str(e)}", exc_info=True)
+
+
+	def GetRunSummaries(self):
+		"""Return the run summaries stored by RecordRunSummary, oldest first."""
+		with self.lock:
+			rows = self.db.query('SELECT value FROM metadata WHERE key LIKE :prefix ORDER BY key', prefix=RUN_SUMMARY_PREFIX + '%')
+			return [json.loads(row['value']) for row in rows]
+
+
+	def SaveCheckpoint(self, in_scan_path, in_state):
+		"""Store the checkpoint of a crawl of in_scan_path, replacing the previous one."""
+		if self.dry_run:
+			return
+		with self.lock:
+			self.db['metadata'].upsert(dict(key=CHECKPOINT_PREFIX + in_scan_path, value=json.dumps(in_state)), ['key'])
+
+
+	def GetCheckpoint(self, in_scan_path):
+		"""Return the last checkpoint stored for in_scan_path, or None."""
+		with self.lock:
+			row = self.db['metadata'].find_one(key=CHECKPOINT_PREFIX + in_scan_path)
+		return json.loads(row['value']) if row else None
+
+
+	def ClearCheckpoint(self, in_scan_path):
+		if self.dry_run:
+			return
+		with self.lock:
+			self.db['metadata'].delete(key=CHECKPOINT_PREFIX + in_scan_path)
 
 
 	def PhotoExists(self, filename, file_hash):
 		"""Check if a photo with the given hash already exists in the database."""
 		#LOG('DEBUG', f"Checking if photo exists (hash: {file_hash[:16]}...)")
 		
-		try:
-			table = self.db['photos']
-			result = table.find_one(hash=file_hash)
-			exists = result is not None
-			return exists
-		except Exception as e:
-			error_msg = f"Unexpected error checking photo existence: {str(e)}"
-			LOG('ERROR', error_msg, exc_info=True)
-			return False
+		with self.lock:
+			try:
+				if file_hash in self._pending_by_hash:
+					return True
+				if self.index is not None:
+					return self.index.HasHash(file_hash)
+				table = self.db['photos']
+				result = table.find_one(hash=file_hash)
+				exists = result is not None
+				return exists
+			except Exception as e:
+				error_msg = f"Unexpected error checking photo existence: {str(e)}"
+				LOG('ERROR', error_msg, exc_info=True)
+				return False
 
 
 	def GetPhotoCount(self):
@@ -217,8 +1111,9 @@ class DataBase:
 		
 		try:
 			# Use SQL COUNT(*) for efficiency instead of loading all rows into memory
-			result = self.db.query('SELECT COUNT(*) as count FROM photos')
-			count = list(result)[0]['count']
+			with self.lock:
+				result = self.db.query('SELECT COUNT(*) as count FROM photos')
+				count = list(result)[0]['count'] + len(self._pending)
 			LOG('DEBUG', f"Photo count: {count}")
 			return count
 		except Exception as e:
@@ -232,6 +1127,7 @@ class DataBase:
 		LOG('DEBUG', "Exporting database...")
 		
 		try:
+			self.Flush()
 			result = self.db['photos'].all()
 
 			total_count = self.GetPhotoCount()
@@ -3,13 +3,23 @@ import settings
 import time
 from enum import Enum
 from Utils import *
-import osxphotos
+from PhotosDatabase import OpenPhotosDatabase
+
+try:
+    import osxphotos
+except ImportError:
+    osxphotos = None
 
 class IPhotoLibraryVersion(Enum):
     NONE = 0
     OLD = 1
     MODERN = 2
 
+def IsPhotosLibraryName(name):
+    """Check by name alone if a directory is a modern Photos library package (no file system access)."""
+    return name.lower().endswith('.photoslibrary')
+
+
 def IsPhotosLibraryPackage(path):
     """Check if a path is an Apple Photos library package.
     
@@ -20,7 +30,7 @@ def IsPhotosLibraryPackage(path):
         IPhotoLibraryVersion: NONE, OLD, or MODERN
     """
     if os.path.isdir(path):
-        if path.lower().endswith('.photoslibrary'):
+        if IsPhotosLibraryName(path):
             LOG('DEBUG', f"Found modern Photos library: {path}")
             return IPhotoLibraryVersion.MODERN
         try:
@@ -35,22 +45,112 @@ def IsPhotosLibraryPackage(path):
 
 
 def ProcessPhotosLibrary(library_path):
-    """Process Photos library using osxphotos.
+    """Process Photos library.
+    
+    Photos 5+ libraries are read straight from Photos.sqlite (see PhotosDatabase.py); other
+    schema versions, and libraries the direct reader cannot open, go through osxphotos.
+    
+    Libraries read from Photos.sqlite are fingerprinted (see PhotosDatabase.Fingerprint): a
+    library whose fingerprint was recorded by an earlier import with every asset present is
+    skipped without touching its files, and assets recorded from any earlier library (with
+    the same size and modification date) are not imported again.
     
     Args:
         library_path: Path to the Photos library package
+    
+    Returns:
+        (fingerprint, missing asset count, imported PhotosAsset records) to record with
+            DataBase.QueuePhotoLibrary once the photos are processed, or None
     """
     version = IsPhotosLibraryPackage(library_path)
     
     if version == IPhotoLibraryVersion.NONE:
         LOG('DEBUG', f"Path is not a Photos library: {library_path}")
-        return
+        return None
     
     if version == IPhotoLibraryVersion.OLD:
         LOG('WARNING', f"Old iPhoto libraries are not fully supported by osxphotos: {library_path}")
         # Could fallback to old implementation if needed
         #return
     
+    database = OpenPhotosDatabase(library_path)
+    if database is not None:
+        try:
+            return _ProcessPhotosDatabase(database)
+        finally:
+            database.Close()
+    _ProcessWithOsxphotos(library_path)
+    return None
+
+
+def _ProcessPhotosDatabase(database):
+    """Import the assets of a library opened with PhotosDatabase.OpenPhotosDatabase.
+    
+    Returns:
+        (fingerprint, missing asset count, imported PhotosAsset records), or None when the
+            library was skipped as a copy of a recorded one
+    """
+    with GetMetrics().Time('library_fingerprint'):
+        fingerprint = database.Fingerprint()
+    skip_assets = None
+    if not settings.gFullRescan:
+        copy_of = settings.gDatabase.FindPhotoLibrary(fingerprint)
+        if copy_of is not None:
+            if copy_of == database.library_path:
+                LOG('INFO', f"Skipping Photos library {database.library_path}: unchanged since it was imported")
+            else:
+                LOG('INFO', f"Skipping Photos library {database.library_path}: same {fingerprint.asset_count} assets as {copy_of}")
+            CountStat('skipped_libraries')
+            return None
+        skip_assets = _KnownAssets
+    
+    LOG('INFO', f"Processing Photos library from Photos.sqlite (model version {database.model_version}): {database.library_path}")
+    photo_count = 0
+    skipped_count = 0
+    missing_count = 0
+    imported = []
+    for asset, entry in database.Files(skip_assets):
+        if entry is None:
+            LOG('DEBUG', f"Skipping photo (file not found, may be in iCloud): {asset.filename} [{asset.uuid}]")
+            skipped_count += 1
+            missing_count += 1
+            CountStat('skipped_photos_library')
+            continue
+        try:
+            entry_stat = entry.stat()
+            CountStat('folder_images')
+            timestamp = asset.timestamp if asset.timestamp is not None else entry_stat.st_mtime
+            filename = asset.filename
+            if entry.path != asset.path:
+                # Rendered edit: keep the original name, with the extension of the render
+                filename = os.path.splitext(filename)[0] + os.path.splitext(entry.name)[1]
+            AddPhoto(entry.path, filename, timestamp, entry_stat)
+            imported.append(asset)
+            photo_count += 1
+        except Exception as e:
+            LOG('ERROR', f"Error processing photo {asset.uuid}: {str(e)}", exc_info=True)
+            MarkIncomplete(entry.path)
+            skipped_count += 1
+    known_count = fingerprint.asset_count - photo_count - skipped_count
+    LOG('INFO', f"Processed {photo_count} photos from Photos library, skipped {skipped_count}, already imported {known_count}")
+    return fingerprint, missing_count, imported
+
+
+def _KnownAssets(assets):
+    """PhotosDatabase.Files filter leaving out assets imported from an earlier copy of a library."""
+    with GetMetrics().Time('db_lookup'):
+        known = settings.gDatabase.FindLibraryAssets(assets)
+    if known:
+        CountStat('skipped_library_assets', len(known))
+    return known
+
+
+def _ProcessWithOsxphotos(library_path):
+    """Import a library through osxphotos.PhotosDB (any schema version osxphotos supports)."""
+    if osxphotos is None:
+        LOG('WARNING', f"Cannot read Photos library {library_path}: osxphotos is not installed")
+        return
+    
     # Process modern Photos library using osxphotos
     try:
         LOG('INFO', f"Processing Photos library with osxphotos: {library_path}")
@@ -70,7 +170,7 @@ def ProcessPhotosLibrary(library_path):
                     else:
                         LOG('DEBUG', f"Skipping photo (file not found, may be in iCloud): {photo.original_filename} [{photo.uuid}]")
                         skipped_count += 1
-                        settings.gSkippedPhotosLibraryCount += 1
+                        CountStat('skipped_photos_library')
                         continue
                 
                 # Get original filename
@@ -89,7 +189,7 @@ def ProcessPhotosLibrary(library_path):
                     timestamp = os.path.getmtime(photo_path)
                 
                 # Increment folder image count (photos from Photos libraries)
-                settings.gFolderImageCount += 1
+                CountStat('folder_images')
                 
                 # Process the photo
                 AddPhoto(photo_path, original_filename, timestamp)
@@ -1,6 +1,5 @@
 import os
 import sys
-import settings
 import sqlite3
 import time
 from enum import Enum
@@ -227,7 +226,7 @@ def AnalyzeIphotoFolder(path, library_root=None, metadata_dict=None, library_ver
             if entry.is_dir() and IsValidSubDirectory(entry.path):
                 AnalyzeIphotoFolder(entry.path, library_root, metadata_dict, library_version)
             elif IsImageFile(entry.name):
-                settings.gFolderImageCount += 1
+                CountStat('folder_images')
                 
                 # Try to get timestamp and original filename from metadata database
                 fullpath = entry.path
@@ -255,7 +254,7 @@ def AnalyzeIphotoFolder(path, library_root=None, metadata_dict=None, library_ver
                 
                 AddPhoto(fullpath, new_filename, timestamp)
             elif entry.is_file():
-                settings.gNonImageFileCount += 1
+                CountStat('non_image_files')
                 LOG('DEBUG', f"Skipping non-image file: {entry.path}")
     except PermissionError:
         LOG('WARNING', f"Permission denied accessing Photos library (macOS may restrict access): {path}")
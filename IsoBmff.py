@@ -0,0 +1,403 @@
+"""Minimal ISO Base Media File Format box reader (HEIC/HEIF, MOV, MP4) for capture dates.
+
+Only box headers and the few boxes that hold dates are read, so a file costs a handful of
+small reads even when the movie data comes first. Every function takes
+read_at(offset, size) -> bytes, which returns fewer bytes than asked at the end of the data;
+malformed or truncated boxes end the search instead of raising.
+"""
+import re
+import time
+from datetime import datetime, timezone, timedelta
+
+
+# Seconds between the QuickTime/MP4 epoch (1904-01-01 UTC) and the Unix epoch
+MAC_EPOCH_OFFSET = 2082844800
+
+# Largest metadata box or item that is read into memory as a whole
+MAX_BOX_READ = 1024 * 1024
+
+# QuickTime metadata key holding the capture time with its UTC offset (iPhone, most cameras)
+QUICKTIME_CREATIONDATE_KEY = b'com.apple.quicktime.creationdate'
+
+# '©day' user data / iTunes item
+QUICKTIME_DAY_BOX = b'\xa9day'
+
+ISO_DATE_PATTERN = re.compile(rb'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?')
+
+
+class _Cursor:
+    """Reads big-endian fields from a byte string; sets ok to False instead of reading past the end."""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.ok = True
+
+    def UInt(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            self.ok = False
+            self.pos = len(self.data)
+            return 0
+        value = int.from_bytes(self.data[self.pos:end], 'big')
+        self.pos = end
+        return value
+
+    def Bytes(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            self.ok = False
+            self.pos = len(self.data)
+            return b''
+        value = bytes(self.data[self.pos:end])
+        self.pos = end
+        return value
+
+
+def _Boxes(read_at, start, end):
+    """Yield (box type, payload offset, box end) for the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        header = read_at(offset, 16)
+        if len(header) < 8:
+            return
+        size = int.from_bytes(header[0:4], 'big')
+        box_type = bytes(header[4:8])
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                return
+            size = int.from_bytes(header[8:16], 'big')
+            header_size = 16
+        elif size == 0:
+            # Box extends to the end of the enclosing box / file
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def _FindBox(read_at, start, end, box_type):
+    """Return (payload offset, box end) of the first box of the given type, or None."""
+    for found_type, payload, box_end in _Boxes(read_at, start, end):
+        if found_type == box_type:
+            return payload, box_end
+    return None
+
+
+def _ReadBox(read_at, payload, box_end):
+    """Return the payload of a box as bytes, or None if it is too large or truncated."""
+    size = box_end - payload
+    if size > MAX_BOX_READ:
+        return None
+    data = read_at(payload, size)
+    return bytes(data) if len(data) == size else None
+
+
+def _MetaChildrenOffset(read_at, payload):
+    """Return where the children of a 'meta' box start.
+
+    ISO/HEIF meta boxes are full boxes (4 bytes of version and flags before the children);
+    QuickTime ones are not. The first child is always 'hdlr', which tells them apart.
+    """
+    peek = read_at(payload, 12)
+    if len(peek) >= 8 and peek[4:8] == b'hdlr':
+        return payload
+    return payload + 4
+
+
+def ParseIsoDate(text):
+    """Parse an ISO 8601 date such as 2021-06-05T14:03:22+0200 into a Unix timestamp.
+
+    Dates without a UTC offset are taken as local time, like EXIF dates.
+
+    Returns:
+        float or None if the text does not hold a full date and time
+    """
+    match = ISO_DATE_PATTERN.search(text)
+    if match is None:
+        return None
+    year, month, day, hour, minute = (int(match.group(i)) for i in range(1, 6))
+    second = int(match.group(6) or 0)
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60 and second < 61):
+        return None
+    try:
+        moment = datetime(year, month, day, hour, minute, min(second, 59))
+    except ValueError:
+        # Day out of range for the month
+        return None
+    zone = match.group(7)
+    if zone is None:
+        return time.mktime(moment.timetuple())
+    if zone == b'Z':
+        offset = timedelta(0)
+    else:
+        digits = zone[1:].replace(b':', b'')
+        offset = timedelta(hours=int(digits[0:2]), minutes=int(digits[2:4]))
+        if zone[0:1] == b'-':
+            offset = -offset
+    return moment.replace(tzinfo=timezone(offset)).timestamp()
+
+
+# === HEIF: Exif item referenced by iinf/iloc ===
+
+def FindHeifExif(read_at, file_size):
+    """Return the TIFF-structured EXIF block of a HEIF/HEIC image, or None.
+
+    Follows meta/iinf to the item of type 'Exif' and meta/iloc to its data.
+    """
+    meta = _FindBox(read_at, 0, file_size, b'meta')
+    if meta is None:
+        return None
+    meta_payload, meta_end = meta
+    children = _MetaChildrenOffset(read_at, meta_payload)
+
+    iinf = _FindBox(read_at, children, meta_end, b'iinf')
+    iloc = _FindBox(read_at, children, meta_end, b'iloc')
+    if iinf is None or iloc is None:
+        return None
+    exif_item = _FindExifItemId(read_at, *iinf)
+    if exif_item is None:
+        return None
+    iloc_data = _ReadBox(read_at, *iloc)
+    if iloc_data is None:
+        return None
+    location = _FindItemExtents(iloc_data, exif_item)
+    if location is None:
+        return None
+    construction_method, extents = location
+
+    if construction_method == 1:
+        # Offsets relative to the meta box's idat payload
+        idat = _FindBox(read_at, children, meta_end, b'idat')
+        if idat is None:
+            return None
+        base = idat[0]
+    elif construction_method == 0:
+        base = 0
+    else:
+        return None
+
+    data = b''
+    for extent_offset, extent_length in extents:
+        if len(data) + extent_length > MAX_BOX_READ:
+            return None
+        data += bytes(read_at(base + extent_offset, extent_length))
+
+    # Exif item: 4-byte offset to the TIFF header, counted from the end of the field
+    cursor = _Cursor(data)
+    tiff_offset = 4 + cursor.UInt(4)
+    if not cursor.ok or tiff_offset >= len(data):
+        return None
+    tiff = data[tiff_offset:]
+    return tiff if tiff[0:2] in (b'II', b'MM') else None
+
+
+def _FindExifItemId(read_at, payload, box_end):
+    """Return the item ID of the 'Exif' item listed in an iinf box, or None."""
+    header = _Cursor(read_at(payload, 8))
+    version = header.UInt(1)
+    header.UInt(3)  # flags
+    header.UInt(2 if version == 0 else 4)  # entry count
+    if not header.ok:
+        return None
+    for box_type, infe_payload, infe_end in _Boxes(read_at, header.pos + payload, box_end):
+        if box_type != b'infe':
+            continue
+        infe = _Cursor(read_at(infe_payload, 16))
+        infe_version = infe.UInt(1)
+        infe.UInt(3)  # flags
+        if infe_version < 2:
+            # Versions 0 and 1 have no item type
+            continue
+        item_id = infe.UInt(2 if infe_version == 2 else 4)
+        infe.UInt(2)  # protection index
+        item_type = infe.Bytes(4)
+        if infe.ok and item_type == b'Exif':
+            return item_id
+    return None
+
+
+def _FindItemExtents(data, item_id):
+    """Parse an iloc box payload and return (construction method, [(offset, length), ...]) of an item."""
+    cursor = _Cursor(data)
+    version = cursor.UInt(1)
+    cursor.UInt(3)  # flags
+    sizes = cursor.UInt(2)
+    offset_size = (sizes >> 12) & 0xF
+    length_size = (sizes >> 8) & 0xF
+    base_offset_size = (sizes >> 4) & 0xF
+    index_size = sizes & 0xF if version in (1, 2) else 0
+    item_count = cursor.UInt(2 if version < 2 else 4)
+
+    for _ in range(item_count):
+        if not cursor.ok:
+            return None
+        current_id = cursor.UInt(2 if version < 2 else 4)
+        construction_method = cursor.UInt(2) & 0xF if version in (1, 2) else 0
+        cursor.UInt(2)  # data reference index
+        base_offset = cursor.UInt(base_offset_size)
+        extent_count = cursor.UInt(2)
+        extents = []
+        for _ in range(extent_count):
+            cursor.UInt(index_size)
+            extent_offset = cursor.UInt(offset_size)
+            extent_length = cursor.UInt(length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        if current_id == item_id:
+            return (construction_method, extents) if cursor.ok else None
+    return None
+
+
+# === HEIF: image properties (iprp/ipco) ===
+
+def FindHeifImageSize(read_at, file_size):
+    """Return (width, height, bits per channel) of the largest image of a HEIF/HEIC file, or None.
+
+    Reads the 'ispe' (image spatial extents) and 'pixi' (pixel information) properties in
+    meta/iprp/ipco. A grid image lists the full size next to its tiles, so the largest
+    extent is the size of the photo. bits per channel is 8 when there is no 'pixi'.
+    """
+    meta = _FindBox(read_at, 0, file_size, b'meta')
+    if meta is None:
+        return None
+    meta_payload, meta_end = meta
+    iprp = _FindBox(read_at, _MetaChildrenOffset(read_at, meta_payload), meta_end, b'iprp')
+    if iprp is None:
+        return None
+    ipco = _FindBox(read_at, iprp[0], iprp[1], b'ipco')
+    if ipco is None:
+        return None
+
+    width = height = 0
+    bit_depth = 8
+    for box_type, payload, box_end in _Boxes(read_at, ipco[0], ipco[1]):
+        if box_type == b'ispe':
+            # Full box: version and flags, then 32-bit width and height
+            cursor = _Cursor(read_at(payload, 12), 4)
+            box_width, box_height = cursor.UInt(4), cursor.UInt(4)
+            if cursor.ok and box_width * box_height > width * height:
+                width, height = box_width, box_height
+        elif box_type == b'pixi':
+            # Full box: version and flags, channel count, then bits per channel
+            cursor = _Cursor(read_at(payload, 8), 4)
+            channels = cursor.UInt(1)
+            bits = [cursor.UInt(1) for _ in range(min(channels, 3))]
+            if cursor.ok and bits:
+                bit_depth = max(bit_depth, max(bits))
+    if width == 0:
+        return None
+    return width, height, bit_depth
+
+
+# === QuickTime / MP4 movie metadata ===
+
+def FindMovieCreationTime(read_at, file_size):
+    """Return the capture time of a MOV/MP4 file as a Unix timestamp, or None.
+
+    In order of preference: the com.apple.quicktime.creationdate metadata key (local time
+    with UTC offset), the '©day' user data, then the creation time of the movie header.
+    """
+    moov = _FindBox(read_at, 0, file_size, b'moov')
+    if moov is None:
+        return None
+    moov_payload, moov_end = moov
+
+    meta = _FindBox(read_at, moov_payload, moov_end, b'meta')
+    if meta is not None:
+        timestamp = _FindKeyedCreationDate(read_at, *meta)
+        if timestamp is not None:
+            return timestamp
+
+    udta = _FindBox(read_at, moov_payload, moov_end, b'udta')
+    if udta is not None:
+        timestamp = _FindUserDataDay(read_at, *udta)
+        if timestamp is not None:
+            return timestamp
+
+    mvhd = _FindBox(read_at, moov_payload, moov_end, b'mvhd')
+    if mvhd is not None:
+        return _MovieHeaderCreationTime(read_at(mvhd[0], 12))
+    return None
+
+
+def _MovieHeaderCreationTime(data):
+    cursor = _Cursor(data)
+    version = cursor.UInt(1)
+    cursor.UInt(3)  # flags
+    creation_time = cursor.UInt(8 if version == 1 else 4)
+    # 0 means unset; some writers also leave it at or before the Unix epoch
+    if not cursor.ok or creation_time <= MAC_EPOCH_OFFSET:
+        return None
+    return float(creation_time - MAC_EPOCH_OFFSET)
+
+
+def _FindKeyedCreationDate(read_at, payload, box_end):
+    """Look up the creationdate key in a QuickTime meta box (keys + ilst)."""
+    children = _MetaChildrenOffset(read_at, payload)
+    keys = _FindBox(read_at, children, box_end, b'keys')
+    ilst = _FindBox(read_at, children, box_end, b'ilst')
+    if keys is None or ilst is None:
+        return None
+    keys_data = _ReadBox(read_at, *keys)
+    if keys_data is None:
+        return None
+
+    cursor = _Cursor(keys_data)
+    cursor.UInt(4)  # version and flags
+    entry_count = cursor.UInt(4)
+    key_index = None
+    for index in range(1, entry_count + 1):
+        key_size = cursor.UInt(4)
+        cursor.UInt(4)  # namespace, normally 'mdta'
+        key_name = cursor.Bytes(key_size - 8)
+        if not cursor.ok:
+            return None
+        if key_name == QUICKTIME_CREATIONDATE_KEY:
+            key_index = index
+            break
+    if key_index is None:
+        return None
+
+    # ilst items are named by their 1-based key index
+    item = _FindBox(read_at, ilst[0], ilst[1], key_index.to_bytes(4, 'big'))
+    if item is None:
+        return None
+    return _ParseDataBox(read_at, *item)
+
+
+def _ParseDataBox(read_at, payload, box_end):
+    """Parse the date held by the 'data' box of a metadata item."""
+    data_box = _FindBox(read_at, payload, box_end, b'data')
+    if data_box is None:
+        return None
+    value = _ReadBox(read_at, *data_box)
+    if value is None or len(value) <= 8:
+        return None
+    # Type indicator (4) and locale (4) precede the value
+    return ParseIsoDate(value[8:])
+
+
+def _FindUserDataDay(read_at, payload, box_end):
+    """Read '©day' from udta: QuickTime text directly in udta, or an iTunes item in udta/meta/ilst."""
+    day = _FindBox(read_at, payload, box_end, QUICKTIME_DAY_BOX)
+    if day is not None:
+        if read_at(day[0] + 4, 4) == b'data':
+            return _ParseDataBox(read_at, *day)
+        value = _ReadBox(read_at, *day)
+        if value is not None and len(value) > 4:
+            # Text size (2) and language (2) precede the text
+            return ParseIsoDate(value[4:])
+        return None
+
+    meta = _FindBox(read_at, payload, box_end, b'meta')
+    if meta is None:
+        return None
+    ilst = _FindBox(read_at, _MetaChildrenOffset(read_at, meta[0]), meta[1], b'ilst')
+    if ilst is None:
+        return None
+    item = _FindBox(read_at, ilst[0], ilst[1], QUICKTIME_DAY_BOX)
+    if item is None:
+        return None
+    return _ParseDataBox(read_at, *item)
@@ -0,0 +1,182 @@
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# dHash grid: DHASH_SIZE x DHASH_SIZE brightness comparisons, a 64-bit hash
+DHASH_SIZE = 8
+
+# Formats SniffImageFormat reports that Pillow can decode for a perceptual hash. TIFF is left
+# out: TIFF-based RAW files would be hashed (and sized) by their embedded preview.
+PERCEPTUAL_FORMATS = ('jpeg', 'png', 'webp')
+
+# Two versions of a photo have the same aspect ratio up to the rounding of a resize (relative)
+ASPECT_TOLERANCE = 0.01
+
+# and the same capture date; EXIF dates have a resolution of one second
+CAPTURE_TIME_TOLERANCE = 1.0
+
+# Resampling filter of the final downscale (Pillow >= 9.1 moved the constants)
+_RESAMPLE = getattr(Image, 'Resampling', Image).BILINEAR
+
+
+def ComputeDHash(source, hash_size=DHASH_SIZE):
+    """Compute the difference hash (dHash) of an image.
+
+    The image is scaled down to hash_size + 1 by hash_size gray pixels and every pixel is
+    compared with its right neighbour. JPEGs are decoded in draft mode, which lets libjpeg
+    scale by up to 1/8 in the DCT so a 24MP photo decodes as a ~0.4MP image. Re-encodes,
+    resized copies and thumbnails of a photo get the same or a nearby hash.
+
+    Args:
+        source: Path or seekable binary file object
+        hash_size: Grid size; the hash has hash_size * hash_size bits
+
+    Returns:
+        tuple[int, int, int]: (hash, width, height), width and height of the full image,
+            or None if Pillow cannot decode it or the image has no structure to compare
+            (a hash of 0, such as a single-color image)
+    """
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            # Ask for at least 4x the grid so the draft scale keeps enough detail
+            image.draft('L', (hash_size * 4, hash_size * 4))
+            small = image.convert('L').resize((hash_size + 1, hash_size), _RESAMPLE)
+            if numpy is not None:
+                pixels = numpy.asarray(small, dtype=numpy.int16)
+                bits = numpy.packbits(pixels[:, 1:] > pixels[:, :-1])
+                value = int.from_bytes(bits.tobytes(), 'big')
+            else:
+                pixels = small.tobytes()
+                value = 0
+                for row in range(hash_size):
+                    offset = row * (hash_size + 1)
+                    for column in range(hash_size):
+                        value = (value << 1) | (pixels[offset + column + 1] > pixels[offset + column])
+    except Exception:
+        return None
+    if value == 0:
+        return None
+    return value, width, height
+
+
+def HammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def IsSameShot(entry, other):
+    """Return True if two near-duplicate entries can be versions of one photo.
+
+    A close perceptual hash alone also matches burst shots and bracketed exposures, so both
+    entries need a known aspect ratio (width / height) and capture date ('aspect', 'taken'),
+    and these must agree.
+    """
+    if not entry.get('aspect') or not other.get('aspect') or entry.get('taken') is None or other.get('taken') is None:
+        return False
+    return (abs(entry['aspect'] / other['aspect'] - 1) <= ASPECT_TOLERANCE
+            and abs(entry['taken'] - other['taken']) < CAPTURE_TIME_TOLERANCE)
+
+
+class MultiIndexHash:
+    """Multi-index hashing: finds every hash within max_distance bits of a query.
+
+    The hash bits are split into max_distance + 1 disjoint chunks, each with its own table.
+    By the pigeonhole principle two hashes at most max_distance bits apart agree exactly on at
+    least one chunk, so a query only verifies the entries sharing one of its chunk values:
+    max_distance + 1 dictionary lookups and about count / 2 ** (bits / (max_distance + 1))
+    candidates per table. For 64-bit hashes and a distance of 4 that is ~120 candidates per
+    table at a million hashes, where a linear scan compares all of them.
+    """
+
+    def __init__(self, max_distance, bits=DHASH_SIZE * DHASH_SIZE):
+        self.max_distance = max_distance
+        self.count = 0
+        chunks = min(max_distance + 1, bits)
+        self._chunks = []
+        shift = 0
+        for i in range(chunks):
+            width = bits // chunks + (1 if i < bits % chunks else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._chunks]
+
+    def __len__(self):
+        return self.count
+
+    def Add(self, hash_value, value):
+        self.count += 1
+        item = (hash_value, value)
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((hash_value >> shift) & mask, []).append(item)
+
+    def Remove(self, hash_value, value):
+        """Remove value (by identity) added with hash_value; does nothing if it is not there."""
+        removed = False
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            key = (hash_value >> shift) & mask
+            items = table.get(key)
+            if not items:
+                continue
+            remaining = [item for item in items if item[1] is not value]
+            if len(remaining) < len(items):
+                removed = True
+                if remaining:
+                    table[key] = remaining
+                else:
+                    del table[key]
+        if removed:
+            self.count -= 1
+
+    def Query(self, hash_value):
+        """Return [(distance, value)] of every value within max_distance, nearest first."""
+        found = []
+        seen = set()
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            for item in table.get((hash_value >> shift) & mask, ()):
+                if id(item) in seen:
+                    continue
+                seen.add(id(item))
+                distance = HammingDistance(hash_value, item[0])
+                if distance <= self.max_distance:
+                    found.append((distance, item[1]))
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Perceptual hashes of the photos in the output, grouped into near-duplicates.
+
+    Every entry is a dict with at least dest (its file in the output) and phash. Only the
+    live entry of each destination is in the hash tables.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self._hashes = MultiIndexHash(max_distance)
+        self._live = {}
+
+    def __len__(self):
+        return len(self._live)
+
+    def Add(self, entry):
+        previous = self._live.get(entry['dest'])
+        if previous is not None:
+            self._hashes.Remove(previous['phash'], previous)
+        self._live[entry['dest']] = entry
+        self._hashes.Add(entry['phash'], entry)
+
+    def Remove(self, entry):
+        if self._live.get(entry['dest']) is entry:
+            del self._live[entry['dest']]
+            self._hashes.Remove(entry['phash'], entry)
+
+    def IsLive(self, entry):
+        return self._live.get(entry['dest']) is entry
+
+    def Find(self, phash):
+        """Return the live entries within max_distance of phash, nearest first."""
+        return [entry for distance, entry in self._hashes.Query(phash) if self.IsLive(entry)]
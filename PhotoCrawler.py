@@ -1,13 +1,26 @@
 #my first python program!
 import os
+import re
 import sys
 import argparse
 import logging
 import sqlite3
+import json
+import tempfile
 import settings
 from Utils import *
 from DataBase import *
 import Crawl
+from Pipeline import IngestPipeline
+from ZipCrawl import ZipPool
+from CopyEngine import CopyEngine, COPY_MODES
+from Classifier import Classifier
+from Metrics import FormatSnapshot
+from Progress import ProgressReporter
+from Checkpoint import CrawlCheckpoint
+import Shard
+from Plan import PlanWriter, ApplyPlan
+from PerceptualHash import NearDuplicateIndex
 
 
 def ParseArguments():
@@ -18,7 +31,8 @@ def ParseArguments():
     )
     
     parser.add_argument('--scan-path', '-s',
-                        help='Directory to start scanning for photos (default: platform-specific)')
+                        action='append',
+                        help='Directory to start scanning for photos; may be repeated with --scan-only (default: platform-specific)')
     parser.add_argument('--output-path', '-o',
                         help='Directory where photos are copied (default: platform-specific)')
     parser.add_argument('--temp-path', '-t',
@@ -28,8 +42,113 @@ def ParseArguments():
     parser.add_argument('--debug',
                         action='store_true',
                         help='Enable debug logging (default: off)')
+    parser.add_argument('--db-batch-size',
+                        type=int, default=settings.gDatabaseFlushRows,
+                        help=f'Buffer database inserts and write them in batches of this many rows; 0 writes every row immediately (default: {settings.gDatabaseFlushRows})')
+    parser.add_argument('--db-flush-ms',
+                        type=int, default=settings.gDatabaseFlushIntervalMs,
+                        help=f'Maximum time in milliseconds a buffered insert waits before it is written (default: {settings.gDatabaseFlushIntervalMs})')
+    parser.add_argument('--zip-mode',
+                        choices=['stream', 'extract'], default=settings.gZipMode,
+                        help=f'stream: hash ZIP entries in place and write only new images; extract: unpack archives to the temp path first (default: {settings.gZipMode})')
+    parser.add_argument('--nested-zip-memory-mb',
+                        type=int, default=settings.gNestedZipMemoryLimit // (1024 * 1024),
+                        help=f'Nested ZIPs up to this size are opened in memory, larger ones are spilled to the temp path (default: {settings.gNestedZipMemoryLimit // (1024 * 1024)})')
+    parser.add_argument('--zip-workers',
+                        type=int, default=settings.gZipWorkers,
+                        help=f'ZIP files processed concurrently with the directory walk; needs --hash-workers > 0, 0 processes ZIPs inline (default: {settings.gZipWorkers})')
+    parser.add_argument('--copy-mode',
+                        choices=COPY_MODES, default=settings.gCopyMode,
+                        help=f'copy: kernel-side copy; reflink/hardlink: clone or hard link sources on the same device as the output, copy others (default: {settings.gCopyMode})')
+    parser.add_argument('--verify-copies',
+                        action='store_true',
+                        help='Hash data while copying and reject copies whose source changed since it was hashed (default: off)')
+    parser.add_argument('--copy-limit-mbps',
+                        type=float, default=settings.gCopyBytesPerSecond / (1024 * 1024),
+                        help='Combined copy rate limit in MB/s for all copy workers; 0 is unlimited (default: 0)')
+    parser.add_argument('--classifier-config',
+                        help='JSON file with image/archive suffixes and exclude rules (glob, regex or substring); see Classifier.py (default: built-in lists)')
+    parser.add_argument('--walk-workers',
+                        type=int, default=settings.gWalkWorkers,
+                        help=f'Directories listed concurrently; raise for high-latency network filesystems, 1 lists one at a time (default: {settings.gWalkWorkers})')
+    parser.add_argument('--full-rescan',
+                        action='store_true',
+                        help='Ignore directory manifests from earlier runs and check every directory (default: off)')
+    parser.add_argument('--trust-dir-mtime',
+                        action='store_true',
+                        help='Skip directories whose mtime is unchanged since the last run without listing them; faster, but misses files rewritten in place (default: off)')
+    parser.add_argument('--preload-index',
+                        action='store_true',
+                        help='Load all known hashes and source paths into memory at startup so lookups skip SQLite (default: off)')
+    parser.add_argument('--verify-duplicates',
+                        action='store_true',
+                        help='Confirm quick hash matches by hashing both files in full (once per file, kept in the database) before skipping one as a duplicate (default: off)')
+    parser.add_argument('--near-duplicates',
+                        action='store_true',
+                        help='Group re-encodes, resized copies and thumbnails by perceptual hash, aspect ratio and capture date, keep only the version with the best quality score and move the others to --near-duplicate-review-path (default: off)')
+    parser.add_argument('--near-duplicate-distance',
+                        type=int, default=settings.gNearDuplicateDistance,
+                        help=f'Bits (of 64) in which the perceptual hashes of two versions of a photo may differ (default: {settings.gNearDuplicateDistance})')
+    parser.add_argument('--near-duplicate-review-path',
+                        help='Directory replaced near-duplicates are moved to for review, below their path in the output (default: output-path/NearDuplicates/)')
+    parser.add_argument('--hash-workers',
+                        type=int, default=settings.gHashWorkers,
+                        help=f'Threads hashing files and reading metadata; 0 processes files inline (default: {settings.gHashWorkers})')
+    parser.add_argument('--copy-workers',
+                        type=int, default=settings.gCopyWorkers,
+                        help=f'Threads copying files to the output path (default: {settings.gCopyWorkers})')
+    parser.add_argument('--exif-processes',
+                        type=int, default=settings.gExifProcesses,
+                        help=f'Processes reading EXIF data with Pillow; 0 reads in the hash threads (default: {settings.gExifProcesses})')
+    parser.add_argument('--queue-size',
+                        type=int, default=settings.gPipelineQueueSize,
+                        help=f'Maximum number of files queued between pipeline stages (default: {settings.gPipelineQueueSize})')
+    parser.add_argument('--progress',
+                        choices=['auto', 'on', 'off'], default=settings.gProgress,
+                        help=f'Refreshing status line with files/s, MB/s and new/duplicate/skipped counts on stderr; auto shows it when stderr is a terminal (default: {settings.gProgress})')
+    parser.add_argument('--progress-interval',
+                        type=float, default=settings.gProgressInterval,
+                        help=f'Seconds between status line updates (default: {settings.gProgressInterval})')
+    parser.add_argument('--precount',
+                        action='store_true',
+                        help='Count the image files of the scan path alongside the crawl to show a percentage and ETA (default: off)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue an interrupted crawl of the scan path from its last checkpoint (default: off, a new crawl discards the checkpoint)')
+    parser.add_argument('--checkpoint-interval',
+                        type=float, default=settings.gCheckpointInterval,
+                        help=f'Seconds between crawl checkpoints; 0 only writes one when the crawl is interrupted (default: {settings.gCheckpointInterval})')
+    parser.add_argument('--scan-only',
+                        metavar='SHARD',
+                        help='Copy nothing: hash every image below the scan paths and write a shard manifest for --merge (default: off)')
+    parser.add_argument('--node-id',
+                        help='Node name stored in the shard manifest or plan; --apply executes the plan actions of this node (default: host name)')
+    parser.add_argument('--merge',
+                        nargs='+', metavar='SHARD',
+                        help='Deduplicate the images of shard manifests across nodes and against the database, and write a copy plan to --plan-out')
+    parser.add_argument('--plan-out',
+                        help='Copy plan written by --merge (JSON Lines, one copy per unique image)')
+    parser.add_argument('--plan',
+                        metavar='PLAN',
+                        help='Dry run: crawl and decide as usual, but copy nothing and write nothing to the database; write every copy, database record and near-duplicate removal to this plan file for --apply (default: off)')
+    parser.add_argument('--apply',
+                        metavar='PLAN',
+                        help='Execute a plan written by --plan or --merge: create its output directories in one pass, then copy grouped by destination directory and source device on --copy-workers threads')
+    parser.add_argument('--metrics-out',
+                        help='Write the run metrics (counters, per-stage latency histograms and throughput) to this JSON file (default: off)')
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    modes = [option for option, value in (('--scan-only', args.scan_only), ('--merge', args.merge),
+                                          ('--plan', args.plan), ('--apply', args.apply)) if value]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} cannot be combined")
+    if args.plan and args.resume:
+        parser.error('--plan writes no checkpoints and cannot be combined with --resume')
+    if args.merge and not args.plan_out:
+        parser.error('--merge needs --plan-out')
+    if args.scan_path and len(args.scan_path) > 1 and not args.scan_only:
+        parser.error('more than one --scan-path is only supported with --scan-only')
+    return args
 
 
 def SetupLogging(database_path, debug=False):
@@ -84,6 +203,76 @@ def SetupLogging(database_path, debug=False):
     return gLogger
 
 
+def WriteMetrics(summary):
+    """Log the run metrics and write them to settings.gMetricsOut when set."""
+    for line in FormatSnapshot(summary):
+        LOG('INFO', line)
+    if settings.gMetricsOut:
+        try:
+            with open(settings.gMetricsOut, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+            LOG('INFO', f"Metrics written to {settings.gMetricsOut}")
+        except OSError as e:
+            LOG('ERROR', f"Failed to write metrics to {settings.gMetricsOut}: {str(e)}")
+
+
+def FinishQueuedWork(checkpoint=None):
+    """Wait for the ZIP pool and the ingest pipeline to finish their queued work, then stop them.
+
+    With a checkpoint, checkpoints are written on its timer meanwhile (see CrawlCheckpoint.WaitForQueuedWork).
+    """
+    if checkpoint is not None:
+        checkpoint.WaitForQueuedWork()
+    # finish the queued ZIP files first, they feed the pipeline
+    if settings.gZipPool is not None:
+        settings.gZipPool.Close()
+        settings.gZipPool = None
+    if settings.gPipeline is not None:
+        settings.gPipeline.Close()
+        settings.gPipeline = None
+
+
+def RunScanOnly(args, scanpaths):
+    """Scan-only mode: write a shard manifest of the scan paths (see Shard.ScanShard)."""
+    shard_path = os.path.abspath(args.scan_only)
+    log_path = args.database_path or os.path.dirname(shard_path)
+    SetupLogging(ValidatePath(log_path, "Database", must_be_writable=True), args.debug)
+    settings.gClassifier = Classifier.Load(args.classifier_config)
+    # nested ZIP files too large for memory are spilled here
+    settings.gTempPath = args.temp_path or tempfile.gettempdir()
+    settings.gNestedZipMemoryLimit = args.nested_zip_memory_mb * 1024 * 1024
+    settings.gWalkWorkers = args.walk_workers
+    settings.gNodeId = args.node_id or Shard.DefaultNodeId()
+    Shard.ScanShard(scanpaths, shard_path, settings.gNodeId, max(1, args.hash_workers))
+    WriteMetrics(GetMetrics().Snapshot())
+
+
+def RunMerge(args):
+    """Merge mode: turn shard manifests into a copy plan (see Shard.MergeShards)."""
+    try:
+        Shard.MergeShards(args.merge, args.plan_out)
+    finally:
+        settings.gDatabase.Close()
+    WriteMetrics(GetMetrics().Snapshot())
+
+
+def RunApply(args):
+    """Apply mode: execute a plan (see Plan.ApplyPlan)."""
+    settings.gCopyWorkers = args.copy_workers
+    settings.gCopyMode = args.copy_mode
+    settings.gCopyVerify = args.verify_copies
+    settings.gCopyBytesPerSecond = int(args.copy_limit_mbps * 1024 * 1024)
+    settings.gCopyEngine = CopyEngine(settings.gCopyMode, settings.gCopyVerify, settings.gCopyBytesPerSecond)
+    settings.gNodeId = args.node_id or Shard.DefaultNodeId()
+    try:
+        ApplyPlan(os.path.abspath(args.apply), settings.gNodeId, settings.gCopyWorkers)
+    finally:
+        settings.gDatabase.Close()
+    summary = GetMetrics().Snapshot()
+    WriteMetrics(summary)
+    settings.gDatabase.RecordRunSummary(summary)
+
+
 def Main():
     import Utils
     
@@ -91,15 +280,24 @@ def Main():
 
     # Parse command-line arguments
     args = ParseArguments()
+    settings.gMetricsOut = args.metrics_out
+    GetMetrics().Reset()
     
     # Get default paths based on platform
     from os.path import expanduser
     userpath = expanduser("~")
     from sys import platform as _platform
 
-    # Set scan path (default or from argument)
-    scanpath = args.scan_path or os.path.join(userpath, 'Pictures')
-    scanpath = ValidatePath(scanpath, "Scan", must_exist=True)
+    # Set scan paths (default or from argument); --merge and --apply walk nothing and need none
+    scanpaths = scanpath = None
+    if not (args.merge or args.apply):
+        scanpaths = [ValidatePath(path, "Scan", must_exist=True) for path in args.scan_path or [os.path.join(userpath, 'Pictures')]]
+        scanpath = scanpaths[0]
+
+    # scan-only nodes write a shard manifest and need no output path or database
+    if args.scan_only:
+        RunScanOnly(args, scanpaths)
+        return
 
     # Set output path (default or from argument)
     settings.gOutputPath = args.output_path or os.path.join(userpath, "PhotoExportTest/")
@@ -109,6 +307,9 @@ def Main():
     settings.gTempPath = args.temp_path or os.path.join(settings.gOutputPath, "Temp/")
     settings.gTempPath = ValidatePath(settings.gTempPath, "Temp", must_be_writable=True)
 
+    # Set the folder replaced near-duplicates are moved to (default to output/NearDuplicates/ or from argument)
+    settings.gNearDuplicateReviewPath = args.near_duplicate_review_path or os.path.join(settings.gOutputPath, "NearDuplicates/")
+
     # Set database path (default to output path or from argument)
     settings.gDatabasePath = args.database_path or settings.gOutputPath
     settings.gDatabasePath = ValidatePath(settings.gDatabasePath, "Database", must_be_writable=True)
@@ -116,17 +317,35 @@ def Main():
     # Initialize logging
     SetupLogging(settings.gDatabasePath, args.debug)
     
+    # compile the file classification and exclude rules once
+    settings.gClassifierConfig = args.classifier_config
+    try:
+        settings.gClassifier = Classifier.Load(settings.gClassifierConfig)
+    except (OSError, ValueError, re.error) as e:
+        LOG('ERROR', f"Invalid classifier config {settings.gClassifierConfig}: {str(e)}")
+        raise
+    
     #initialize database
     LOG('INFO', f"Initializing database at: {settings.gDatabasePath}")
     
+    settings.gDatabaseFlushRows = args.db_batch_size
+    settings.gDatabaseFlushIntervalMs = args.db_flush_ms
     try:
-        settings.gDatabase = DataBase(settings.gDatabasePath)
+        settings.gDatabase = DataBase(settings.gDatabasePath, settings.gDatabaseFlushRows, settings.gDatabaseFlushIntervalMs,
+                                      in_dry_run=bool(args.plan))
         LOG('DEBUG', "Database initialized successfully")
     except Exception as e:
         error_msg = f"Failed to initialize database at {settings.gDatabasePath}: {str(e)}"
         LOG('ERROR', error_msg, exc_info=True)
         raise
     
+    if args.merge:
+        RunMerge(args)
+        return
+    if args.apply:
+        RunApply(args)
+        return
+
     # show database status for incremental mode
     LOG('DEBUG', "Getting photo count from database...")
     initial_count = 0
@@ -142,9 +361,113 @@ def Main():
         LOG('ERROR', error_msg)
         # Continue with scan even if count fails
         LOG('WARNING', "Continuing with scan despite count error")
+
+    settings.gFullRescan = args.full_rescan
+    settings.gTrustDirectoryMtime = args.trust_dir_mtime
+    settings.gZipMode = args.zip_mode
+    settings.gNestedZipMemoryLimit = args.nested_zip_memory_mb * 1024 * 1024
+
+    # preload known hashes and source paths so most lookups never reach SQLite
+    settings.gPreloadIndex = args.preload_index
+    settings.gVerifyDuplicates = args.verify_duplicates
+    if settings.gPreloadIndex:
+        settings.gDatabase.LoadIndex()
+
+    # perceptual hashes of the photos already in the output, for near-duplicate detection
+    settings.gNearDuplicateDistance = args.near_duplicate_distance
+    if args.near_duplicates:
+        settings.gNearDuplicateIndex = NearDuplicateIndex(settings.gNearDuplicateDistance)
+        for entry in settings.gDatabase.GetPerceptualHashes():
+            entry['recorded'] = True
+            settings.gNearDuplicateIndex.Add(entry)
+        LOG('INFO', f"Near-duplicate detection on: {len(settings.gNearDuplicateIndex)} perceptual hashes loaded, "
+                    f"distance {settings.gNearDuplicateDistance}")
     
+    # start the ingest pipeline (hash/metadata workers, database writer, copy workers)
+    settings.gHashWorkers = args.hash_workers
+    settings.gCopyWorkers = args.copy_workers
+    settings.gExifProcesses = args.exif_processes
+    settings.gPipelineQueueSize = args.queue_size
+    if settings.gHashWorkers > 0:
+        settings.gPipeline = IngestPipeline(settings.gHashWorkers, settings.gCopyWorkers,
+                                            settings.gExifProcesses, settings.gPipelineQueueSize)
+
+    # copies to the output path (kernel copy, reflinks or hard links, throttle, verification)
+    settings.gCopyMode = args.copy_mode
+    settings.gCopyVerify = args.verify_copies
+    settings.gCopyBytesPerSecond = int(args.copy_limit_mbps * 1024 * 1024)
+    settings.gCopyEngine = CopyEngine(settings.gCopyMode, settings.gCopyVerify, settings.gCopyBytesPerSecond)
+
+    # ZIP workers rely on the pipeline's single database writer for deduplication
+    settings.gZipWorkers = args.zip_workers
+    if settings.gZipWorkers > 0 and settings.gPipeline is not None:
+        settings.gZipPool = ZipPool(settings.gZipWorkers)
+
+    settings.gWalkWorkers = args.walk_workers
+
+    # status line on its own thread, reading the run metrics
+    settings.gProgress = args.progress
+    settings.gProgressInterval = args.progress_interval
+    settings.gPreCount = args.precount
+    progress = None
+    if settings.gProgress == 'on' or (settings.gProgress == 'auto' and sys.stderr.isatty()):
+        progress = ProgressReporter(settings.gProgressInterval)
+        progress.Start(scanpath if settings.gPreCount else None)
+
+    # plan mode: decide every copy without making it (see Plan.PlanWriter)
+    if args.plan:
+        settings.gNodeId = args.node_id or Shard.DefaultNodeId()
+        settings.gPlan = PlanWriter(settings.gNodeId)
+
+    # checkpoints of the walk and of the work in flight, so an interrupted crawl can be resumed
+    settings.gResume = args.resume
+    settings.gCheckpointInterval = args.checkpoint_interval
+    checkpoint = None
+    if settings.gPlan is None:
+        checkpoint = CrawlCheckpoint(scanpath, settings.gCheckpointInterval)
+        if settings.gResume:
+            if not checkpoint.Load():
+                LOG('WARNING', f"No checkpoint found for {scanpath}, starting a new crawl")
+        else:
+            checkpoint.Discard()
+
     #recursively analyze folder
-    Crawl.AnalyzeFolder(scanpath)
+    completed = False
+    interrupted = False
+    try:
+        Crawl.AnalyzeFolder(scanpath, checkpoint=checkpoint)
+        completed = True
+    finally:
+        # wait for queued photos to be copied and recorded before reporting
+        try:
+            FinishQueuedWork(checkpoint)
+        except KeyboardInterrupt:
+            # the work still queued is in the checkpoint written below
+            LOG('WARNING', "Interrupted while finishing the queued work")
+            completed = False
+            interrupted = True
+        # record what was done, or what is left to do when the crawl stopped early
+        if checkpoint is not None:
+            checkpoint.Close(completed)
+        if settings.gPlan is not None:
+            settings.gPlan.Write(os.path.abspath(args.plan), completed)
+        # every photo found so far is processed now, so the walked directories can be recorded;
+        # a crawl that stopped early recorded its finished units in the checkpoint above, and the
+        # libraries whose photos are still in flight must not be skipped as imported on --resume
+        if completed:
+            settings.gDatabase.CommitDirectoryManifests(settings.gIncompleteDirectories)
+            settings.gDatabase.CommitPhotoLibraries(settings.gIncompleteDirectories)
+        # write any buffered database rows, also when the crawl raised
+        settings.gDatabase.Close()
+        if progress is not None:
+            progress.Stop()
+        if interrupted:
+            raise KeyboardInterrupt
+
+    # a plan run has nothing to export; --apply records its photos
+    if settings.gPlan is not None:
+        WriteMetrics(GetMetrics().Snapshot())
+        return
 
     #export database
     LOG('DEBUG', "Starting database export")
@@ -159,17 +482,17 @@ def Main():
         LOG('WARNING', "Database export failed, but scan completed")
 
     # Display import statistics
+    summary = GetMetrics().Snapshot()
+    counters = summary['counters']
     LOG('INFO', "="*60)
     LOG('INFO', "Import complete")
     LOG('INFO', "="*60)
-    LOG('INFO', f"Images scanned in folders:     {settings.gFolderImageCount}")
-    LOG('INFO', f"Images scanned in ZIP files:   {settings.gZipImageCount}")
-    LOG('INFO', f"Files skipped (better version): {settings.gSkippedBetterCount}")
-    LOG('INFO', f"Files skipped (in database):   {settings.gSkippedDatabaseCount}")
-    LOG('INFO', f"Non-image files encountered:   {settings.gNonImageFileCount}")
-    LOG('INFO', f"Photos skipped (not available): {settings.gSkippedPhotosLibraryCount}")
+    WriteMetrics(summary)
     LOG('INFO', "="*60)
-    LOG('INFO', f"Import complete - Folders: {settings.gFolderImageCount}, ZIPs: {settings.gZipImageCount}, Skipped (better): {settings.gSkippedBetterCount}, Skipped (database): {settings.gSkippedDatabaseCount}, Non-image: {settings.gNonImageFileCount}, Photos skipped: {settings.gSkippedPhotosLibraryCount}")
+    LOG('INFO', f"Import complete - Folders: {counters.get('folder_images', 0)}, ZIPs: {counters.get('zip_images', 0)}, Skipped (better): {counters.get('skipped_better', 0)}, Skipped (database): {counters.get('skipped_database', 0)}, Non-image: {counters.get('non_image_files', 0)}, Photos skipped: {counters.get('skipped_photos_library', 0)}")
+
+    # keep every run's summary next to the photos so throughput can be compared across runs
+    settings.gDatabase.RecordRunSummary(summary)
 
 
     
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import plistlib
+import xxhash
+from collections import namedtuple
+from Utils import *
+
+
+# Seconds between the Core Data epoch (2001-01-01 UTC) and the Unix epoch
+CORE_DATA_EPOCH_OFFSET = 978307200.0
+
+# Photos.sqlite model versions (PLModelVersion in Z_METADATA) this reader knows, with their
+# asset table: Photos 5 (macOS 10.15) names it ZGENERICASSET, Photos 6 to 11 (macOS 11 to 26)
+# ZASSET. Other versions are read with osxphotos.
+SUPPORTED_MODEL_VERSIONS = (
+    (13000, 13999, 'ZGENERICASSET'),
+    (14000, 19999, 'ZASSET'),
+)
+
+# Columns the asset query needs, checked before it runs
+ASSET_COLUMNS = ('Z_PK', 'ZUUID', 'ZDIRECTORY', 'ZFILENAME', 'ZDATECREATED', 'ZMODIFICATIONDATE',
+                 'ZTRASHEDSTATE', 'ZHASADJUSTMENTS', 'ZKIND')
+ATTRIBUTE_COLUMNS = ('ZASSET', 'ZORIGINALFILENAME', 'ZORIGINALFILESIZE')
+
+# ZKIND of videos; everything else is treated as a photo
+ASSET_KIND_VIDEO = 1
+
+# Rows fetched from the cursor at a time
+ASSET_FETCH_ROWS = 1000
+
+
+# One asset of a library. path is where its original would be; timestamp and modified are Unix
+# timestamps; size is the original's size as recorded by Photos (None if unknown)
+PhotosAsset = namedtuple('PhotosAsset', 'uuid path filename timestamp modified size edited video')
+
+# Summary of the asset table of a library: asset_count, max_modified (Unix timestamp, None if no
+# asset has one) and digest, the xxh64 of all asset UUIDs and sizes in UUID order. Copies of a
+# library have the same fingerprint until one of them is changed.
+LibraryFingerprint = namedtuple('LibraryFingerprint', 'asset_count max_modified digest')
+
+
+def _ModelVersion(connection):
+    row = connection.execute('SELECT MAX(Z_VERSION), Z_PLIST FROM Z_METADATA').fetchone()
+    if row is None or row[1] is None:
+        return None
+    return int(plistlib.loads(row[1]).get('PLModelVersion', 0)) or None
+
+
+def _Columns(connection, table):
+    return {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+
+
+def OpenPhotosDatabase(library_path):
+    """Open the Photos.sqlite of a library for the fast import path.
+
+    The database is opened read-only with immutable=1, so a running Photos app (or a library
+    on read-only media) does not block the read.
+
+    Returns:
+        PhotosDatabase, or None if the library has no Photos.sqlite or its schema is not one
+            this reader knows (the caller then falls back to osxphotos)
+    """
+    db_path = os.path.join(library_path, 'database', 'Photos.sqlite')
+    if not os.path.isfile(db_path):
+        LOG('DEBUG', f"Photos.sqlite not found at {db_path}")
+        return None
+    connection = None
+    try:
+        connection = sqlite3.connect(f"file:{db_path}?immutable=1", uri=True)
+        model_version = _ModelVersion(connection)
+        asset_table = next((table for first, last, table in SUPPORTED_MODEL_VERSIONS
+                            if model_version is not None and first <= model_version <= last), None)
+        if asset_table is None:
+            LOG('INFO', f"Photos.sqlite model version {model_version} of {library_path} is not supported by the direct reader")
+            connection.close()
+            return None
+        missing = (set(ASSET_COLUMNS) - _Columns(connection, asset_table)) | \
+                  (set(ATTRIBUTE_COLUMNS) - _Columns(connection, 'ZADDITIONALASSETATTRIBUTES'))
+        if missing:
+            LOG('INFO', f"Photos.sqlite of {library_path} lacks columns {', '.join(sorted(missing))}; not using the direct reader")
+            connection.close()
+            return None
+        return PhotosDatabase(library_path, connection, asset_table, model_version)
+    except (sqlite3.DatabaseError, plistlib.InvalidFileException, ValueError) as e:
+        LOG('WARNING', f"Cannot read Photos.sqlite of {library_path}: {str(e)}")
+        if connection is not None:
+            connection.close()
+        return None
+
+
+class PhotosDatabase:
+    """Streams the assets of a Photos 5+ library straight from its Photos.sqlite.
+
+    Unlike osxphotos.PhotosDB nothing is loaded up front: one query runs over the asset table
+    and rows are turned into PhotosAsset records as the cursor reaches them. Files lists each
+    originals directory once to check which assets are on disk, instead of one os.path.exists
+    per asset, and hands out the DirEntry so the import needs no further stat.
+    """
+
+    def __init__(self, library_path, connection, asset_table, model_version):
+        self.library_path = library_path
+        self.model_version = model_version
+        self._connection = connection
+        self._asset_table = asset_table
+
+    def Close(self):
+        self._connection.close()
+
+    def _QueryAssets(self, columns, order):
+        """Run a query over the assets not in the trash and yield its rows in fetchmany batches."""
+        asset = self._asset_table
+        select = ', '.join(column.format(asset=asset) for column in columns)
+        cursor = self._connection.execute(f"""
+            SELECT {select}
+            FROM {asset}
+            LEFT JOIN ZADDITIONALASSETATTRIBUTES ON ZADDITIONALASSETATTRIBUTES.ZASSET = {asset}.Z_PK
+            WHERE {asset}.ZFILENAME IS NOT NULL AND {asset}.ZDIRECTORY IS NOT NULL
+              AND ({asset}.ZTRASHEDSTATE IS NULL OR {asset}.ZTRASHEDSTATE = 0)
+            ORDER BY {order.format(asset=asset)}""")
+        while True:
+            rows = cursor.fetchmany(ASSET_FETCH_ROWS)
+            if not rows:
+                return
+            yield rows
+
+    def Fingerprint(self):
+        """Compute the LibraryFingerprint of the library from its database alone (no file is read)."""
+        digest = xxhash.xxh64()
+        asset_count = 0
+        max_modified = None
+        for rows in self._QueryAssets(('{asset}.ZUUID', 'ZADDITIONALASSETATTRIBUTES.ZORIGINALFILESIZE',
+                                       '{asset}.ZMODIFICATIONDATE'), '{asset}.ZUUID'):
+            for uuid, size, modified in rows:
+                digest.update(f"{uuid}:{size}\n".encode('utf-8'))
+                if modified is not None and (max_modified is None or modified > max_modified):
+                    max_modified = modified
+            asset_count += len(rows)
+        return LibraryFingerprint(asset_count, max_modified + CORE_DATA_EPOCH_OFFSET if max_modified is not None else None,
+                                  digest.hexdigest())
+
+    def _AssetBatches(self):
+        originals = os.path.join(self.library_path, 'originals')
+        for rows in self._QueryAssets(('{asset}.ZUUID', '{asset}.ZDIRECTORY', '{asset}.ZFILENAME', '{asset}.ZDATECREATED',
+                                       '{asset}.ZMODIFICATIONDATE', '{asset}.ZHASADJUSTMENTS', '{asset}.ZKIND',
+                                       'ZADDITIONALASSETATTRIBUTES.ZORIGINALFILENAME',
+                                       'ZADDITIONALASSETATTRIBUTES.ZORIGINALFILESIZE'),
+                                      '{asset}.ZDIRECTORY, {asset}.ZFILENAME'):
+            batch = []
+            for uuid, directory, filename, created, modified, adjusted, kind, original_filename, size in rows:
+                # Referenced files (not copied into the library) have an absolute directory
+                path = os.path.join(directory if os.path.isabs(directory) else os.path.join(originals, directory), filename)
+                batch.append(PhotosAsset(uuid, path, original_filename or filename,
+                                         created + CORE_DATA_EPOCH_OFFSET if created is not None else None,
+                                         modified + CORE_DATA_EPOCH_OFFSET if modified is not None else None,
+                                         size, bool(adjusted), kind == ASSET_KIND_VIDEO))
+            yield batch
+
+    def Assets(self):
+        """Yield a PhotosAsset for every asset not in the trash, grouped by originals directory."""
+        for batch in self._AssetBatches():
+            yield from batch
+
+    def _EditedNames(self, asset):
+        """File names Photos gives the rendered edit of an asset in resources/renders."""
+        if asset.video:
+            return (f"{asset.uuid}_2_0_a.mov",)
+        return (f"{asset.uuid}_1_201_a.jpeg", f"{asset.uuid}_1_201_a.heic")
+
+    def Files(self, skip_assets=None):
+        """Yield (asset, DirEntry) for every asset, with the DirEntry of its file on disk.
+
+        The original is used when it is on disk; otherwise the rendered edit, if the asset was
+        edited. DirEntry is None when neither is (e.g. an original only in iCloud). Every
+        directory is listed once: the query returns assets grouped by directory.
+
+        Args:
+            skip_assets: Optional function called with each batch of PhotosAsset records that
+                returns the set of UUIDs to leave out; their files are not looked up
+        """
+        listings = _DirectoryListings()
+        renders = os.path.join(self.library_path, 'resources', 'renders')
+        for batch in self._AssetBatches():
+            skipped = skip_assets(batch) if skip_assets is not None else ()
+            for asset in batch:
+                if asset.uuid in skipped:
+                    continue
+                entry = listings.Find(asset.path)
+                if entry is None and asset.edited:
+                    render_directory = os.path.join(renders, asset.uuid[0])
+                    for name in self._EditedNames(asset):
+                        entry = listings.Find(os.path.join(render_directory, name))
+                        if entry is not None:
+                            break
+                yield asset, entry
+
+
+class _DirectoryListings:
+    """Answers file lookups from one os.scandir per directory, keeping the listings of the
+    originals directory and the renders directory in use."""
+
+    # Listings kept at a time; assets arrive grouped by directory, renders interleave
+    MAX_LISTINGS = 4
+
+    def __init__(self):
+        self._listings = {}
+
+    def Find(self, path):
+        directory, name = os.path.split(path)
+        listing = self._listings.get(directory)
+        if listing is None:
+            if len(self._listings) >= self.MAX_LISTINGS:
+                # Drop the oldest listing
+                del self._listings[next(iter(self._listings))]
+            try:
+                with os.scandir(directory) as entries:
+                    listing = {entry.name: entry for entry in entries}
+            except OSError:
+                listing = {}
+            self._listings[directory] = listing
+        entry = listing.get(name)
+        return entry if entry is not None and entry.is_file() else None
@@ -0,0 +1,282 @@
+import os
+import queue
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from Utils import *
+
+
+# Message kinds on the writer queue
+_MSG_CHECKED = 'checked'
+_MSG_COPIED = 'copied'
+
+# Sentinel used to stop worker threads
+_STOP = object()
+
+
+class SubmissionGroup:
+    """Tracks the photos one thread submitted between IngestPipeline.BeginGroup and EndGroup.
+
+    Lets a ZIP worker wait for its own entries instead of for the whole pipeline, which
+    keeps receiving files from the directory walk in the meantime.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._outstanding = 0
+        self._done = threading.Condition()
+
+    def _Add(self):
+        with self._done:
+            self._outstanding += 1
+
+    def _Finish(self):
+        with self._done:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._done.notify_all()
+
+    def Wait(self):
+        with self._done:
+            while self._outstanding > 0:
+                self._done.wait()
+
+    def IsDone(self):
+        """True once every photo submitted to the group has been processed."""
+        with self._done:
+            return self._outstanding == 0
+
+
+class IngestPipeline:
+    """Staged, multi-threaded version of Utils.AddPhoto.
+
+    Stages:
+        walker (caller of Submit) -> hash/metadata workers -> database writer -> copy workers
+
+    The hash workers run CheckPhoto (face filter, source path lookup, quick hash, hash lookup,
+    EXIF), optionally sending EXIF reads to a process pool. A single writer thread owns every
+    decision that depends on other files: it re-checks the hash against the database and the
+    files still in flight, resolves the destination and inserts the database row once the copy
+    workers report success. Files whose hash or destination is already in flight are parked
+    until that file is done, so two copies of the same photo are never copied twice.
+
+    Memory is capped by the bounded hash and copy queues and by a semaphore limiting the
+    number of checked items waiting for the writer.
+    """
+
+    def __init__(self, hash_workers=4, copy_workers=2, exif_processes=0, queue_size=256):
+        self.hash_workers = max(1, hash_workers)
+        self.copy_workers = max(1, copy_workers)
+        self.queue_size = max(1, queue_size)
+
+        self._hash_queue = queue.Queue(maxsize=self.queue_size)
+        self._copy_queue = queue.Queue(maxsize=self.queue_size)
+        # Unbounded so copy workers never block on reporting back; checked items are
+        # bounded by _writer_slots instead
+        self._writer_queue = queue.Queue()
+        self._writer_slots = threading.BoundedSemaphore(self.queue_size)
+
+        # Writer-owned state (only touched from the writer thread)
+        self._inflight_hashes = set()
+        self._inflight_dests = set()
+        self._parked = {}
+
+        # Outstanding submitted items, used by WaitIdle
+        self._outstanding = 0
+        self._idle = threading.Condition()
+
+        # Per-thread SubmissionGroup that new submissions are added to (see BeginGroup)
+        self._local = threading.local()
+
+        self._exif_executor = None
+        if exif_processes > 0:
+            # Workers start lazily, on the first submit from a hash thread; forking then would
+            # copy a multi-threaded process (held locks included), so they are spawned instead
+            self._exif_executor = ProcessPoolExecutor(max_workers=exif_processes,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+
+        self._threads = []
+        for i in range(self.hash_workers):
+            self._StartThread(self._HashWorker, f"ingest-hash-{i}")
+        for i in range(self.copy_workers):
+            self._StartThread(self._CopyWorker, f"ingest-copy-{i}")
+        self._writer_thread = self._StartThread(self._WriterLoop, "ingest-writer")
+
+        LOG('INFO', f"Ingest pipeline started: {self.hash_workers} hash workers, {self.copy_workers} copy workers, "
+                    f"{exif_processes} EXIF processes, queue size {self.queue_size}")
+
+    def _StartThread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def _Add(self):
+        group = getattr(self._local, 'group', None)
+        if group is not None:
+            group._Add()
+        with self._idle:
+            self._outstanding += 1
+        return group
+
+    def Submit(self, in_fullpath, in_filename, in_timestamp_float, in_stat=None):
+        """Queue a photo for ingestion. Blocks while the hash queue is full."""
+        group = self._Add()
+        self._hash_queue.put((in_fullpath, in_filename, in_timestamp_float, in_stat, group))
+
+    def SubmitChecked(self, item):
+        """Queue a work item that already went through the checks of CheckPhoto.
+        
+        Used for sources that are hashed by the caller, such as streamed ZIP entries.
+        """
+        item['group'] = self._Add()
+        self._writer_slots.acquire()
+        self._writer_queue.put((_MSG_CHECKED, item))
+
+    def BeginGroup(self):
+        """Start collecting the photos submitted from the current thread into a new SubmissionGroup."""
+        group = SubmissionGroup(getattr(self._local, 'group', None))
+        self._local.group = group
+        return group
+
+    def EndGroup(self, group):
+        """Stop collecting into group and wait until all of its photos are processed."""
+        self._local.group = group.parent
+        group.Wait()
+
+    def DetachGroup(self, group):
+        """Stop collecting into group without waiting; check group.IsDone() later."""
+        self._local.group = group.parent
+
+    def WaitIdle(self, timeout=None):
+        """Block until every submitted photo has been fully processed. Returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._outstanding == 0, timeout)
+
+    def Close(self):
+        """Drain all queued work and stop the worker threads."""
+        self.WaitIdle()
+        for _ in range(self.hash_workers):
+            self._hash_queue.put(_STOP)
+        for _ in range(self.copy_workers):
+            self._copy_queue.put(_STOP)
+        self._writer_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if self._exif_executor is not None:
+            self._exif_executor.shutdown()
+        LOG('DEBUG', "Ingest pipeline stopped")
+
+    def _Finish(self, group):
+        if group is not None:
+            group._Finish()
+        with self._idle:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._idle.notify_all()
+
+    # === Stage 1: hash and metadata workers ===
+
+    def _HashWorker(self):
+        while True:
+            work = self._hash_queue.get()
+            if work is _STOP:
+                return
+            in_fullpath, in_filename, in_timestamp_float, in_stat, group = work
+            try:
+                item = CheckPhoto(in_fullpath, in_filename, in_timestamp_float, self._exif_executor, in_stat)
+            except Exception as e:
+                LOG('ERROR', f"Error checking {in_fullpath}: {str(e)}", exc_info=True)
+                MarkIncomplete(in_fullpath)
+                item = None
+            if item is None:
+                self._Finish(group)
+                continue
+            item['group'] = group
+            self._writer_slots.acquire()
+            self._writer_queue.put((_MSG_CHECKED, item))
+
+    # === Stage 2: single database writer ===
+
+    def _WriterLoop(self):
+        while True:
+            message = self._writer_queue.get()
+            if message is _STOP:
+                return
+            if message[0] == _MSG_CHECKED:
+                self._writer_slots.release()
+                self._HandleChecked(message[1])
+            else:
+                self._HandleCopied(message[1], message[2])
+
+    def _Park(self, key, item):
+        self._parked.setdefault(key, []).append(item)
+
+    def _HandleChecked(self, item):
+        try:
+            self._DecidePhoto(item)
+        except Exception as e:
+            LOG('ERROR', f"Error resolving {item['fullpath']}: {str(e)}", exc_info=True)
+            MarkIncomplete(item['fullpath'])
+            self._Finish(item['group'])
+
+    def _DecidePhoto(self, item):
+        file_hash = item['hash']
+        if file_hash in self._inflight_hashes:
+            # Same content is being copied right now; decide once that copy is done
+            self._Park(file_hash, item)
+            return
+
+        # Re-check: the row may have been added since the hash worker looked
+        is_duplicate, item['attributes'] = IsKnownDuplicate(item['fullpath'], file_hash, item.get('full_hash'))
+        if is_duplicate:
+            self._Finish(item['group'])
+            return
+
+        dest_path = os.path.join(OrganizePath(item['fullpath'], item['organization_timestamp']), item['filename'])
+        if dest_path in self._inflight_dests:
+            # Another file is being written to the same name; compare against it once it exists
+            self._Park(dest_path, item)
+            return
+
+        if not ResolvePhoto(item):
+            LOG('DEBUG', f"Not copying {item['fullpath']} - existing file is better")
+            self._Finish(item['group'])
+            return
+
+        self._inflight_hashes.add(file_hash)
+        self._inflight_dests.add(item['dest_path'])
+        self._copy_queue.put(item)
+
+    def _HandleCopied(self, item, copied):
+        try:
+            if copied:
+                RecordPhoto(item)
+            else:
+                ForgetNearDuplicate(item)
+                MarkIncomplete(item['fullpath'])
+        except Exception as e:
+            LOG('ERROR', f"Error recording {item['fullpath']}: {str(e)}", exc_info=True)
+            MarkIncomplete(item['fullpath'])
+        finally:
+            self._inflight_hashes.discard(item['hash'])
+            self._inflight_dests.discard(item['dest_path'])
+            self._Finish(item['group'])
+        # Re-evaluate anything that was waiting on this file, in arrival order
+        for key in (item['hash'], item['dest_path']):
+            for parked_item in self._parked.pop(key, []):
+                self._HandleChecked(parked_item)
+
+    # === Stage 3: copy workers ===
+
+    def _CopyWorker(self):
+        while True:
+            item = self._copy_queue.get()
+            if item is _STOP:
+                return
+            try:
+                copied = CopyResolvedPhoto(item)
+            except Exception as e:
+                LOG('ERROR', f"Error copying {item['fullpath']}: {str(e)}", exc_info=True)
+                copied = False
+            self._writer_queue.put((_MSG_COPIED, item, copied))
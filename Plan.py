@@ -0,0 +1,452 @@
+import os
+import json
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import settings
+from Utils import *
+from ZipCrawl import ExtractZipEntries, CopyZipEntry
+
+
+# File format of copy plans (written by a crawl with settings.gPlan set and by Shard.MergeShards)
+PLAN_FORMAT = 'photocrawler-plan'
+PLAN_VERSION = 1
+
+# Actions a plan can hold:
+#   copy:   copy source to dest and record it in the database
+#       {"action": "copy", "node", "source", "dest", "filename", "hash", "size", "timestamp",
+#        "in_archive", optional "device", "quality" and "phash"/"pixels"/"aspect"/"taken" for near-duplicates}
+#   record: record a source in the database without copying it (its copy was overwritten or
+#       replaced by a better near-duplicate within the plan); same fields as copy
+#   remove: move an output file replaced by a better near-duplicate to the review folder, once
+#       the copy to replaced_by succeeded (always when replaced_by is null)
+#       {"action": "remove", "node", "dest", "size", "hash", "replaced_by"}
+#   confirm: a file with the quick hash of the copy to original (written by Shard.MergeShards);
+#       copied to dest like a copy action only if its full hash differs from the original's
+#       {"action": "confirm", "original", and the fields of copy}
+PLAN_ACTIONS = ('copy', 'record', 'remove', 'confirm')
+
+
+def WritePlan(plan_path, actions, **header):
+    """Write a plan file: a JSON Lines file with a header line, then one action per line.
+
+    Args:
+        plan_path: Plan file to write
+        actions: Action dicts (see PLAN_ACTIONS)
+        header: Further header fields (output path, shards, ...)
+    """
+    header = dict(format=PLAN_FORMAT, version=PLAN_VERSION, created=datetime.now().isoformat(timespec='seconds'), **header)
+    with open(plan_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for action in actions:
+            f.write(json.dumps(action) + '\n')
+
+
+def ReadPlan(plan_path):
+    """Read a plan file written by WritePlan.
+
+    Returns:
+        tuple: (header dict, list of action dicts)
+
+    Raises:
+        ValueError: If the file is not a plan of a supported version
+    """
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('format') != PLAN_FORMAT:
+            raise ValueError(f"{plan_path} is not a copy plan")
+        if header.get('version') != PLAN_VERSION:
+            raise ValueError(f"{plan_path} has unsupported plan version {header.get('version')}")
+        actions = [json.loads(line) for line in f if line.strip()]
+    for action in actions:
+        if action.get('action') not in PLAN_ACTIONS:
+            raise ValueError(f"{plan_path} has unknown action {action.get('action')}")
+    return header, actions
+
+
+class PlanWriter:
+    """Collects the actions of a crawl run in plan mode (settings.gPlan) instead of executing them.
+
+    The crawl decides exactly as it would when copying: CopyResolvedPhoto hands every copy
+    to AddCopy, and replaced near-duplicates arrive through AddRemove. The database is opened
+    as a dry run (see DataBase), so planned photos are still found by the lookups of this run.
+
+    Copies are keyed by destination, like the files they would become: a second copy to the
+    same destination turns the first into a record action, as its file would have been
+    overwritten, and a planned copy replaced by a better near-duplicate is recorded without
+    being copied at all.
+
+    Safe to use from the ingest pipeline's copy workers and writer at once.
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._copies = {}
+        self._records = []
+        self._removes = []
+
+    def AddCopy(self, item):
+        """Plan the copy of a work item that went through ResolvePhoto."""
+        action = dict(action='copy', node=self.node_id, source=item['fullpath'], dest=item['dest_path'],
+                      filename=item['filename'], hash=item['hash'], size=item['size'], timestamp=item['timestamp'],
+                      in_archive=item.get('copy_func') is not None)
+        if item.get('stat') is not None:
+            action['device'] = item['stat'].st_dev
+        if item.get('quality') is not None:
+            action['quality'] = item['quality']
+        entry = item.get('near_duplicate')
+        if entry is not None:
+            action.update(phash=f"{entry['phash']:016x}", pixels=entry['pixels'], aspect=entry['aspect'], taken=entry['taken'])
+        with self._lock:
+            replaced = self._copies.get(action['dest'])
+            if replaced is not None:
+                self._records.append(dict(replaced, action='record'))
+            self._copies[action['dest']] = action
+
+    def AddRemove(self, entry, replaced_by=None):
+        """Plan the removal of a near-duplicate replaced by a better version (see Utils.RemoveReplacedCopy).
+
+        Args:
+            entry: Near-duplicate entry (see Utils.ResolveNearDuplicate)
+            replaced_by: Destination of the version replacing it, if known
+        """
+        with self._lock:
+            planned = self._copies.get(entry['dest'])
+            if planned is not None:
+                if planned['hash'] == entry['hash']:
+                    del self._copies[entry['dest']]
+                    self._records.append(dict(planned, action='record'))
+                    # Removals waiting for this copy now wait for its replacement
+                    for remove in self._removes:
+                        if remove['replaced_by'] == entry['dest']:
+                            remove['replaced_by'] = replaced_by
+                # Otherwise the planned copy overwrites the file anyway
+                return
+            self._removes.append(dict(action='remove', node=self.node_id, dest=entry['dest'], size=entry['size'],
+                                      hash=entry['hash'], replaced_by=replaced_by))
+
+    def PlannedCopy(self, dest_path):
+        """Return the copy action planned to dest_path, or None."""
+        with self._lock:
+            return self._copies.get(dest_path)
+
+    def Write(self, plan_path, complete=True):
+        """Write the plan, copies sorted by destination.
+
+        Args:
+            plan_path: Plan file to write
+            complete: False if the crawl stopped early; the plan then covers part of the scan path
+        """
+        with self._lock:
+            copies = sorted(self._copies.values(), key=lambda action: action['dest'])
+            records = sorted(self._records, key=lambda action: action['source'])
+            removes = list(self._removes)
+        WritePlan(plan_path, copies + records + removes, node=self.node_id, output=settings.gOutputPath, complete=complete)
+        CountStat('planned_copies', len(copies))
+        CountStat('planned_removals', len(removes))
+        directories = len({os.path.dirname(action['dest']) for action in copies})
+        size = sum(action['size'] for action in copies)
+        LOG('INFO', f"Plan written to {plan_path}: {len(copies)} copies ({size / (1024 * 1024):.1f} MB) into "
+                    f"{directories} directories, {len(records)} records, {len(removes)} removals")
+
+
+def _InterleaveDevices(groups_by_device):
+    """Order groups round-robin over the source devices, so concurrent workers read from different devices."""
+    queues = [groups_by_device[device] for device in sorted(groups_by_device, key=str)]
+    return [group for round_ in itertools.zip_longest(*queues) for group in round_ if group is not None]
+
+
+def _RecordAction(action):
+    """Add the photo of a copy or record action to the database, like Utils.RecordPhoto."""
+    if settings.gDatabase.AddPhoto(action['filename'], action['source'], action['timestamp'], action['hash']):
+        CountStat('imported')
+    if action['action'] == 'copy' and action.get('phash') is not None:
+        settings.gDatabase.SetPerceptualHash(action['dest'], action['hash'], int(action['phash'], 16), action['pixels'],
+                                           action['size'], action.get('quality'), action.get('aspect'), action.get('taken'))
+
+
+def _DestinationNames(dest, file_hash):
+    """Yield the names _ClaimDestination tries for a copy, up to the first that does not exist."""
+    root, ext = os.path.splitext(dest)
+    attempt = 0
+    while os.path.lexists(dest):
+        yield dest
+        attempt += 1
+        dest = f"{root}_{file_hash[:8]}{ext}" if attempt == 1 else f"{root}_{file_hash[:8]}_{attempt}{ext}"
+    yield dest
+
+
+def _ClaimDestination(action):
+    """Find where a planned copy goes without replacing a different file already in the output.
+
+    Merge plans are made without looking at the output, and the output may have changed
+    since any plan was made. A destination holding the same photo (by quick hash, or by full
+    hash for a confirm action, see _ConfirmAction) is used as it is; one holding another file
+    is left alone and the copy gets a unique name.
+
+    Returns:
+        tuple: (action, with dest and filename changed if the name was taken, and whether
+            the file still has to be copied)
+    """
+    for dest in _DestinationNames(action['dest'], action['hash']):
+        if not os.path.lexists(dest):
+            break
+        if ComputeQuickFileHash(dest) == action['hash'] and (
+                action.get('full_hash') is None or FullHashOfSource(dest, action['hash']) == action['full_hash']):
+            CountStat('plan_already_present')
+            return dict(action, dest=dest, filename=os.path.basename(dest)), False
+    if dest != action['dest']:
+        CountStat('plan_renamed')
+        LOG('WARNING', f"{action['dest']} holds another file; copying {action['source']} to {dest}")
+    return dict(action, dest=dest, filename=os.path.basename(dest)), True
+
+
+def _ConfirmAction(action):
+    """Compare a confirm action's source with the copy of its original in the output, by full hash.
+
+    The copy is the first file with the same quick hash under the names _ClaimDestination
+    gives the original. When either full hash cannot be computed the quick hash decides,
+    like Utils._IsSameContent. The source's full hash is kept as action['full_hash'], for
+    _ClaimDestination to tell a copy made by an earlier apply from another file.
+
+    Returns:
+        bool: True if the source duplicates the original, False if it has to be copied, or
+            None if the original is not in the output yet
+    """
+    original = next((dest for dest in _DestinationNames(action['original'], action['hash'])
+                     if os.path.lexists(dest) and ComputeQuickFileHash(dest) == action['hash']), None)
+    if original is None:
+        return None
+    action['full_hash'] = FullHashOfSource(action['source'], action['hash'])
+    original_full_hash = FullHashOfSource(original, action['hash'])
+    if action['full_hash'] is None or original_full_hash is None or action['full_hash'] == original_full_hash:
+        return True
+    CountStat('quick_hash_collisions')
+    LOG('WARNING', f"{action['source']} has the quick hash of {original} but different content")
+    return False
+
+
+def _CopyFiles(actions):
+    """Copy plain files of one destination directory and source device, in source order.
+
+    Returns:
+        list: Planned destinations of the copies that succeeded
+    """
+    metrics = GetMetrics()
+    copied = []
+    for action in sorted(actions, key=lambda action: action['source']):
+        source = action['source']
+        try:
+            in_stat = os.stat(source)
+        except OSError as e:
+            LOG('ERROR', f"Cannot copy {source}: {str(e)}")
+            continue
+        if in_stat.st_size != action['size']:
+            CountStat('plan_changed')
+            LOG('WARNING', f"Skipping {source} - changed since it was planned")
+            continue
+        claimed, needs_copy = _ClaimDestination(action)
+        ok = True
+        if needs_copy:
+            full_hash = VerifiedCopyFullHash(source, in_stat)
+            full_hash_known = full_hash is not None and full_hash.value is not None
+            with metrics.Time('copy'):
+                ok = CopyImage(source, os.path.dirname(claimed['dest']), claimed['filename'], action['hash'], in_stat, full_hash)
+            if ok:
+                metrics.AddBytes('copy', action['size'])
+                MemoizeCopyFullHash(source, action['hash'], full_hash, full_hash_known, in_stat)
+        if ok:
+            _RecordAction(claimed)
+            copied.append(action['dest'])
+    return copied
+
+
+def _CopyArchiveEntries(zip_path, actions):
+    """Extract the planned entries of one ZIP file, opening it once.
+
+    Returns:
+        list: Planned destinations of the copies that succeeded
+    """
+    metrics = GetMetrics()
+    by_source = {action['source']: action for action in actions}
+    copied = []
+
+    def extract(zfile, zipentry_info, entry_path):
+        action = by_source[entry_path]
+        if zipentry_info.file_size != action['size']:
+            CountStat('plan_changed')
+            LOG('WARNING', f"Skipping {entry_path} - changed since it was planned")
+            return
+        claimed, needs_copy = _ClaimDestination(action)
+        ok = True
+        if needs_copy:
+            full_hash = VerifiedCopyFullHash(entry_path)
+            full_hash_known = full_hash is not None and full_hash.value is not None
+            item = dict(fullpath=entry_path, dest_path=claimed['dest'], hash=action['hash'], timestamp=action['timestamp'],
+                        full_hash=full_hash)
+            with metrics.Time('copy'):
+                ok = CopyZipEntry(zfile, zipentry_info, item)
+            if ok:
+                metrics.AddBytes('copy', action['size'])
+                MemoizeCopyFullHash(entry_path, action['hash'], full_hash, full_hash_known)
+        if ok:
+            _RecordAction(claimed)
+            copied.append(action['dest'])
+
+    ExtractZipEntries(zip_path, sorted(by_source, key=lambda source: by_source[source]['dest']), extract)
+    return copied
+
+
+def _RunCopies(pending, workers):
+    """Create the output directories of copy actions, then run the copies in I/O order (see ApplyPlan).
+
+    Returns:
+        set: Planned destinations of the copies that succeeded
+    """
+    failed_directories = set()
+    for directory in sorted({os.path.dirname(action['dest']) for action in pending}):
+        try:
+            MakeOutputDirectory(directory)
+        except OSError as e:
+            LOG('ERROR', f"Cannot create output directory {directory}: {str(e)}")
+            failed_directories.add(directory)
+
+    # Group the copies; ContainingZip is asked once per archive directory
+    groups = {}
+    archives = {}
+    for action in pending:
+        if os.path.dirname(action['dest']) in failed_directories:
+            continue
+        if action['in_archive']:
+            parent = os.path.dirname(action['source'])
+            if parent not in archives:
+                archives[parent] = ContainingZip(action['source'])
+            if archives[parent] is None:
+                LOG('ERROR', f"Cannot copy {action['source']}: ZIP file not found")
+                continue
+            key = ('zip', archives[parent])
+        else:
+            key = (action.get('device'), os.path.dirname(action['dest']))
+        groups.setdefault(key, []).append(action)
+
+    groups_by_device = {}
+    for key in sorted(groups, key=lambda key: (str(key[0]), key[1])):
+        if key[0] == 'zip':
+            try:
+                device = os.stat(key[1]).st_dev
+            except OSError:
+                device = None
+        else:
+            device = key[0]
+        groups_by_device.setdefault(device, []).append(key)
+
+    LOG('INFO', f"Copying {len(pending)} files in {len(groups)} groups from {len(groups_by_device)} source devices "
+                f"on {workers} workers")
+    copied = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='plan-apply') as executor:
+        futures = [executor.submit(_CopyArchiveEntries, key[1], groups[key]) if key[0] == 'zip'
+                   else executor.submit(_CopyFiles, groups[key])
+                   for key in _InterleaveDevices(groups_by_device)]
+        for future in futures:
+            try:
+                copied.update(future.result())
+            except Exception as e:
+                LOG('ERROR', f"Error applying copies: {str(e)}", exc_info=True)
+    return copied
+
+
+def ApplyPlan(plan_path, node_id, workers=2):
+    """Execute the actions of a plan for one node.
+
+    Copies already recorded in the database (by source path) are skipped, so an interrupted
+    apply can be run again. The remaining copies run in I/O order:
+    1. Every output directory is created first, in one sorted pass (see MakeOutputDirectory).
+    2. Copies are grouped per destination directory and source device; all entries of a ZIP
+       file form one group, so the archive is opened once. Within a group files are copied
+       in source order, one after the other.
+    3. The groups go to workers threads round-robin over the source devices: concurrent
+       workers read from different devices, and each one writes into one directory at a time.
+
+    No copy replaces a different file already at its destination (see _ClaimDestination).
+    Every photo is recorded as soon as its copy succeeded. Confirm actions are checked once
+    the copies are made (see _ConfirmAction), and copied the same way if their content
+    differs; those whose original another node has not copied yet are left for the next
+    apply. Near-duplicates replaced by a copy are moved to the review folder after all
+    copies, and only if the replacing copy succeeded.
+
+    Args:
+        plan_path: Plan written by a crawl in plan mode or by Shard.MergeShards
+        node_id: Only actions of this node (or without a node) are executed
+        workers: Copy threads
+
+    Returns:
+        dict: Number of planned, skipped, copied and failed copies, records and removals,
+            and of confirmed duplicates and confirm actions left for the next apply
+
+    Raises:
+        ValueError: If the file is not a plan, or was planned for another output path
+    """
+    header, actions = ReadPlan(plan_path)
+    output = header.get('output')
+    if output and os.path.normpath(output) != os.path.normpath(settings.gOutputPath):
+        raise ValueError(f"{plan_path} was planned for output path {output}, not {settings.gOutputPath}")
+    if not header.get('complete', True):
+        LOG('WARNING', f"{plan_path} is the plan of an interrupted crawl; applying the part that was planned")
+
+    own = [action for action in actions if action.get('node', node_id) == node_id]
+    if len(own) < len(actions):
+        LOG('INFO', f"Leaving {len(actions) - len(own)} actions of other nodes to them")
+    copies = [action for action in own if action['action'] == 'copy']
+    confirms = [action for action in own if action['action'] == 'confirm']
+    records = [action for action in own if action['action'] == 'record']
+    removes = [action for action in own if action['action'] == 'remove']
+
+    # Sources recorded by an earlier apply are done; their destinations count as copied
+    metrics = GetMetrics()
+    with metrics.Time('db_lookup'):
+        applied = {action['dest'] for action in copies + confirms if settings.gDatabase.HasSourcePath(action['source'])}
+        records = [action for action in records if not settings.gDatabase.HasSourcePath(action['source'])]
+    pending = [action for action in copies if action['dest'] not in applied]
+    confirms = [action for action in confirms if action['dest'] not in applied]
+    CountStat('skipped_database', len(applied))
+
+    LOG('INFO', f"Applying {plan_path}: {len(pending)} copies, {len(confirms)} duplicates to confirm, "
+                f"{len(applied)} already applied")
+    copied = _RunCopies(pending, workers)
+
+    # Duplicates by quick hash, checked against their originals now that those are copied
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='plan-confirm') as executor:
+        confirmed = list(executor.map(_ConfirmAction, confirms))
+    differing = [action for action, duplicate in zip(confirms, confirmed) if duplicate is False]
+    duplicates = confirmed.count(True)
+    waiting = confirmed.count(None)
+    CountStat('plan_confirmed_duplicates', duplicates)
+    if waiting:
+        CountStat('plan_unconfirmed', waiting)
+        LOG('WARNING', f"{waiting} duplicates wait for the copy of their original by another node; "
+                       f"apply {plan_path} again once it is made")
+    if differing:
+        copied |= _RunCopies(differing, workers)
+
+    failed = len(pending) + len(differing) - len(copied)
+    if failed:
+        CountStat('plan_failed', failed)
+
+    for action in records:
+        _RecordAction(action)
+
+    removed = 0
+    for action in removes:
+        replaced_by = action['replaced_by']
+        if replaced_by is not None and replaced_by not in copied and replaced_by not in applied:
+            LOG('WARNING', f"Keeping {action['dest']} - the copy replacing it ({replaced_by}) was not made")
+            continue
+        RemoveReplacedCopy(action)
+        removed += 1
+
+    LOG('INFO', f"Applied {plan_path}: {len(copied)} copied, {failed} failed, {len(applied)} already applied, "
+                f"{duplicates} confirmed duplicates, {waiting} left to confirm, {len(records)} recorded, {removed} removed")
+    return dict(planned=len(copies), skipped=len(applied), copied=len(copied), failed=failed,
+                records=len(records), removed=removed, duplicates=duplicates, unconfirmed=waiting)
@@ -0,0 +1,120 @@
+import sys
+import time
+import threading
+import settings
+from Utils import *
+from Walker import WalkFolder
+from Classifier import KIND_IMAGE
+
+
+def _FormatDuration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _FormatBytes(amount):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if amount < 1024:
+            return f"{amount:.1f} {unit}"
+        amount /= 1024.0
+    return f"{amount:.1f} TB"
+
+
+class ProgressReporter:
+    """Prints a refreshing status line from its own thread.
+
+    The line is built from the run metrics (Utils.GetMetrics().Counters()), which the crawler
+    and pipeline threads update without locks; the reporter only reads them every interval
+    seconds, so the per-file path does no extra locking or console I/O.
+
+    With a pre-count, a second thread walks the scan path once, counting the image files the
+    crawl will look at (directories unchanged since the last run count as empty, like in the
+    crawl), which turns the status line into a percentage with an ETA. Images inside ZIP
+    files are not known up front and are left out of the ETA.
+    """
+
+    def __init__(self, interval=1.0, stream=None):
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        # Refresh one line in place on a terminal, print one line per update otherwise
+        self._refresh = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.total_files = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._count_thread = None
+        self._last_width = 0
+
+    def Start(self, scan_path=None):
+        """Start reporting; with scan_path, also pre-count the image files below it."""
+        if scan_path is not None:
+            self._count_thread = threading.Thread(target=self._PreCount, args=(scan_path,), name="progress-count", daemon=True)
+            self._count_thread.start()
+        self._thread = threading.Thread(target=self._Loop, name="progress", daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        """Print a final status line and stop the reporter thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._Write(self.StatusLine(), final=True)
+
+    def _PreCount(self, scan_path):
+        start = time.monotonic()
+        classifier = GetClassifier()
+        total = 0
+        try:
+            for listing in WalkFolder(scan_path, settings.gWalkWorkers, track_manifests=True, timed=False):
+                if self._stop.is_set():
+                    return
+                for entry in listing.files:
+                    if classifier.Kind(entry.name, entry.path) == KIND_IMAGE:
+                        total += 1
+        except Exception as e:
+            LOG('WARNING', f"Pre-count of {scan_path} failed, continuing without ETA: {str(e)}")
+            return
+        self.total_files = total
+        LOG('INFO', f"Pre-count: {total} image files below {scan_path} ({time.monotonic() - start:.1f}s)")
+
+    def StatusLine(self):
+        metrics = GetMetrics()
+        counters = metrics.Counters()
+        elapsed = metrics.Elapsed()
+        folder_files = counters.get('folder_images', 0)
+        files = folder_files + counters.get('zip_images', 0)
+        image_bytes = counters.get('image_bytes', 0)
+        skipped = counters.get('skipped_better', 0) + counters.get('skipped_photos_library', 0)
+        rate = files / elapsed if elapsed > 0 else 0.0
+        byte_rate = image_bytes / elapsed if elapsed > 0 else 0.0
+
+        if self.total_files is not None:
+            done = min(folder_files, self.total_files)
+            percent = 100.0 * done / self.total_files if self.total_files else 100.0
+            folder_rate = folder_files / elapsed if elapsed > 0 else 0.0
+            eta = _FormatDuration((self.total_files - done) / folder_rate) if folder_rate > 0 else '--:--:--'
+            position = f"{files} files ({done}/{self.total_files} in folders, {percent:.1f}%, ETA {eta})"
+        elif self._count_thread is not None:
+            position = f"{files} files (counting...)"
+        else:
+            position = f"{files} files"
+
+        return (f"[{_FormatDuration(elapsed)}] {position}  {counters.get('directories', 0)} dirs  "
+                f"{rate:.1f} files/s  {_FormatBytes(byte_rate)}/s  "
+                f"new {counters.get('imported', 0)}  dup {counters.get('skipped_database', 0)}  skipped {skipped}")
+
+    def _Loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._Write(self.StatusLine())
+            except Exception as e:
+                LOG('DEBUG', f"Progress update failed: {str(e)}")
+
+    def _Write(self, line, final=False):
+        if self._refresh:
+            padding = ' ' * max(0, self._last_width - len(line))
+            self._last_width = len(line)
+            self.stream.write('\r' + line + padding + ('\n' if final else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
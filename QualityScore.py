@@ -0,0 +1,289 @@
+"""Header-only quality score of a photo, to pick the best of several versions.
+
+Reads pixel dimensions, bit depth and camera EXIF (Make/Model) from the headers only:
+JPEG SOF and DQT segments, PNG IHDR, WebP VP8/VP8L/VP8X, TIFF IFDs (also TIFF-based RAW) and
+HEIF ispe/pixi properties. No pixels are decoded, so scoring costs about what reading the
+EXIF date does and usually reuses the same bytes.
+
+Every function takes read_at(offset, size) -> bytes, which returns fewer bytes than asked
+at the end of the data (see IsoBmff.py).
+"""
+import math
+from collections import namedtuple
+import IsoBmff
+
+
+# Extensions of camera RAW files; they rank above every processed format
+RAW_EXTENSIONS = ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.dng', '.orf', '.rw2', '.raf', '.pef', '.srw')
+
+# Format rank: RAW > HEIF and TIFF > JPEG, PNG and WebP
+FORMAT_RANKS = dict(raw=3, heif=2, tiff=2, jpeg=1, png=1, webp=1)
+
+# Score weights. A doubling of the pixel count outweighs a format step, so a full-size JPEG
+# beats a downscaled HEIC export; at equal size RAW beats HEIC beats JPEG, camera files beat
+# exports without camera EXIF, and a high JPEG quality beats a low one.
+PIXEL_WEIGHT = 10.0         # per doubling of the pixel count
+FORMAT_WEIGHT = 8.0         # per format rank
+CAMERA_EXIF_WEIGHT = 4.0    # EXIF names the camera (Make or Model)
+BIT_DEPTH_WEIGHT = 0.5      # per bit per channel above 8 (10-bit HEIC, 12/14-bit RAW)
+JPEG_QUALITY_WEIGHT = 5.0   # times the estimated quality / 100; lossless and unknown count as 100
+
+# IJG base luminance quantization table (JPEG standard, Annex K), for the quality estimate
+STD_LUMINANCE_TABLE = (16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+                       14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+                       18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+                       49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99)
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...); C4, C8 and CC are not frames
+JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+JPEG_MARKER_DQT = 0xDB
+JPEG_MARKER_APP1 = 0xE1
+JPEG_MARKER_SOS = 0xDA
+JPEG_MARKER_EOI = 0xD9
+
+# TIFF tags read for the score
+TIFF_TAG_NEW_SUBFILE_TYPE = 254
+TIFF_TAG_IMAGE_WIDTH = 256
+TIFF_TAG_IMAGE_LENGTH = 257
+TIFF_TAG_BITS_PER_SAMPLE = 258
+TIFF_TAG_MAKE = 271
+TIFF_TAG_MODEL = 272
+TIFF_TAG_SUB_IFDS = 330
+TIFF_TYPE_SHORT = 3
+TIFF_TYPE_LONG = 4
+
+# IFDs followed in a TIFF file (IFD chain plus SubIFDs), against loops in broken files
+MAX_TIFF_IFDS = 16
+
+
+ImageHeader = namedtuple('ImageHeader', 'format width height bit_depth jpeg_quality camera')
+
+
+def ReadImageHeader(read_at, file_size, image_format, filename):
+    """Read the quality-relevant header fields of an image.
+
+    Args:
+        read_at: Function (offset, size) -> bytes over the file's data
+        file_size: Size of the file
+        image_format: Utils.SniffImageFormat result of the file
+        filename: Name of the file; RAW files are recognized by extension
+
+    Returns:
+        ImageHeader, or None for formats this module does not read (movies, GIF, ...)
+    """
+    is_raw = filename.lower().endswith(RAW_EXTENSIONS)
+    if image_format == 'jpeg':
+        return _ReadJpegHeader(read_at)
+    if image_format == 'png':
+        return _ReadPngHeader(read_at)
+    if image_format == 'webp':
+        return _ReadWebpHeader(read_at)
+    if image_format == 'tiff':
+        width, height, bit_depth, camera = _ReadTiff(read_at, 0)
+        if width == 0:
+            return None
+        return ImageHeader('raw' if is_raw else 'tiff', width, height, bit_depth, None, camera)
+    if image_format == 'isobmff':
+        size = IsoBmff.FindHeifImageSize(read_at, file_size)
+        if size is None:
+            # A movie, or a RAW container (CR3) without image properties
+            return None
+        exif = IsoBmff.FindHeifExif(read_at, file_size)
+        camera = exif is not None and _ReadTiff(lambda offset, length: exif[offset:offset + length], 0)[3]
+        return ImageHeader('raw' if is_raw else 'heif', size[0], size[1], size[2], None, camera)
+    return None
+
+
+def Score(header):
+    """Return the quality score of an ImageHeader (higher is better), or None without a header."""
+    if header is None:
+        return None
+    score = PIXEL_WEIGHT * math.log2(max(1, header.width * header.height))
+    score += FORMAT_WEIGHT * FORMAT_RANKS.get(header.format, 0)
+    if header.camera:
+        score += CAMERA_EXIF_WEIGHT
+    score += BIT_DEPTH_WEIGHT * max(0, header.bit_depth - 8)
+    quality = header.jpeg_quality if header.jpeg_quality is not None else 100
+    score += JPEG_QUALITY_WEIGHT * quality / 100.0
+    return score
+
+
+def ScoreImage(read_at, file_size, image_format, filename):
+    """ReadImageHeader followed by Score; None when the header cannot be read."""
+    try:
+        return Score(ReadImageHeader(read_at, file_size, image_format, filename))
+    except (IndexError, ValueError):
+        # Truncated or malformed header
+        return None
+
+
+def EstimateJpegQuality(table):
+    """Estimate the IJG quality setting (1-100) that produced a luminance quantization table.
+
+    libjpeg scales the standard table by 5000 / quality (quality < 50) or 200 - 2 * quality;
+    the ratio of the table sums inverts that scaling.
+    """
+    scale = sum(table) * 100.0 / sum(STD_LUMINANCE_TABLE)
+    if scale <= 0:
+        return 100
+    quality = (200.0 - scale) / 2.0 if scale <= 100.0 else 5000.0 / scale
+    return max(1, min(100, int(round(quality))))
+
+
+def _ReadJpegHeader(read_at):
+    """Walk the JPEG segments up to the start of scan: SOF size and precision, DQT, EXIF camera."""
+    offset = 2
+    width = height = 0
+    bit_depth = 8
+    jpeg_quality = None
+    camera = False
+    while True:
+        marker = read_at(offset, 4)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        marker_type = marker[1]
+        if marker_type == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+        if marker_type in (JPEG_MARKER_SOS, JPEG_MARKER_EOI):
+            break
+        if 0xD0 <= marker_type <= 0xD7 or marker_type == 0x01:
+            # Standalone markers without a length
+            offset += 2
+            continue
+        if len(marker) < 4:
+            break
+        length = int.from_bytes(marker[2:4], 'big')
+        if marker_type in JPEG_SOF_MARKERS:
+            frame = read_at(offset + 4, 5)
+            if len(frame) == 5:
+                bit_depth = frame[0]
+                height = int.from_bytes(frame[1:3], 'big')
+                width = int.from_bytes(frame[3:5], 'big')
+        elif marker_type == JPEG_MARKER_DQT and jpeg_quality is None:
+            jpeg_quality = _LuminanceQuality(read_at(offset + 4, length - 2))
+        elif marker_type == JPEG_MARKER_APP1 and not camera and read_at(offset + 4, 6) == b'Exif\x00\x00':
+            exif = read_at(offset + 10, length - 8)
+            camera = _ReadTiff(lambda at, size: exif[at:at + size], 0)[3]
+        offset += 2 + length
+    if width == 0:
+        return None
+    return ImageHeader('jpeg', width, height, bit_depth, jpeg_quality, camera)
+
+
+def _LuminanceQuality(data):
+    """Quality estimate from the luminance table (ID 0) of a DQT segment, or None."""
+    position = 0
+    while position < len(data):
+        precision, table_id = data[position] >> 4, data[position] & 0x0F
+        entry_size = 2 if precision else 1
+        values = data[position + 1:position + 1 + 64 * entry_size]
+        if len(values) < 64 * entry_size:
+            return None
+        if table_id == 0:
+            if entry_size == 1:
+                return EstimateJpegQuality(list(values))
+            return EstimateJpegQuality([int.from_bytes(values[i:i + 2], 'big') for i in range(0, 128, 2)])
+        position += 1 + 64 * entry_size
+    return None
+
+
+def _ReadPngHeader(read_at):
+    # IHDR is the first chunk: width, height, bit depth, color type
+    ihdr = read_at(8, 8 + 13)
+    if len(ihdr) < 21 or ihdr[4:8] != b'IHDR':
+        return None
+    width = int.from_bytes(ihdr[8:12], 'big')
+    height = int.from_bytes(ihdr[12:16], 'big')
+    # Palette images (color type 3) have 8-bit color whatever their index depth
+    bit_depth = 8 if ihdr[17] == 3 else ihdr[16]
+    return ImageHeader('png', width, height, bit_depth, None, False)
+
+
+def _ReadWebpHeader(read_at):
+    chunk = read_at(12, 8 + 10)
+    if len(chunk) < 18:
+        return None
+    chunk_type = chunk[0:4]
+    if chunk_type == b'VP8X':
+        # Canvas size minus one, 24 bits each
+        width = 1 + int.from_bytes(chunk[12:15], 'little')
+        height = 1 + int.from_bytes(chunk[15:18], 'little')
+    elif chunk_type == b'VP8 ':
+        # Key frame header: 3 bytes frame tag, 3 bytes start code, then 14-bit sizes
+        width = int.from_bytes(chunk[14:16], 'little') & 0x3FFF
+        height = int.from_bytes(chunk[16:18], 'little') & 0x3FFF
+    elif chunk_type == b'VP8L':
+        # Signature byte, then 14-bit width - 1 and height - 1
+        bits = int.from_bytes(chunk[9:13], 'little')
+        width = 1 + (bits & 0x3FFF)
+        height = 1 + ((bits >> 14) & 0x3FFF)
+    else:
+        return None
+    return ImageHeader('webp', width, height, 8, None, False)
+
+
+def _ReadTiff(read_at, base):
+    """Return (width, height, bits per sample, camera) of the largest image of a TIFF structure.
+
+    Follows the IFD chain and SubIFDs (RAW files keep the full-size image in a SubIFD or a
+    later IFD, IFD0 often holds a preview). camera is True when IFD0 has a Make or Model tag.
+    Offsets are relative to base, the position of the TIFF header.
+    """
+    header = read_at(base, 8)
+    if len(header) < 8 or header[0:2] not in (b'II', b'MM'):
+        return 0, 0, 8, False
+    byte_order = 'little' if header[0:2] == b'II' else 'big'
+
+    def value(data, start, size):
+        return int.from_bytes(data[start:start + size], byte_order)
+
+    width = height = 0
+    bit_depth = 8
+    camera = False
+    pending = [value(header, 4, 4)]
+    seen = set()
+    while pending and len(seen) < MAX_TIFF_IFDS:
+        ifd_offset = pending.pop(0)
+        if ifd_offset == 0 or ifd_offset in seen:
+            continue
+        seen.add(ifd_offset)
+        count_bytes = read_at(base + ifd_offset, 2)
+        if len(count_bytes) < 2:
+            continue
+        entry_count = value(count_bytes, 0, 2)
+        entries = read_at(base + ifd_offset + 2, entry_count * 12 + 4)
+        if len(entries) < entry_count * 12:
+            continue
+        fields = {}
+        for i in range(entry_count):
+            entry = entries[i * 12:(i + 1) * 12]
+            tag, field_type, count = value(entry, 0, 2), value(entry, 2, 2), value(entry, 4, 4)
+            if len(seen) == 1 and tag in (TIFF_TAG_MAKE, TIFF_TAG_MODEL) and count > 1:
+                camera = True
+            if field_type == TIFF_TYPE_SHORT:
+                fields[tag] = (value(entry, 8, 2), count, value(entry, 8, 4))
+            elif field_type == TIFF_TYPE_LONG:
+                fields[tag] = (value(entry, 8, 4), count, value(entry, 8, 4))
+        if TIFF_TAG_SUB_IFDS in fields:
+            first, count, offset = fields[TIFF_TAG_SUB_IFDS]
+            if count == 1:
+                pending.append(first)
+            else:
+                offsets = read_at(base + offset, 4 * min(count, MAX_TIFF_IFDS))
+                pending.extend(value(offsets, i, 4) for i in range(0, len(offsets) - 3, 4))
+        if len(entries) >= entry_count * 12 + 4:
+            pending.append(value(entries, entry_count * 12, 4))
+
+        if TIFF_TAG_IMAGE_WIDTH in fields and TIFF_TAG_IMAGE_LENGTH in fields:
+            ifd_width, ifd_height = fields[TIFF_TAG_IMAGE_WIDTH][0], fields[TIFF_TAG_IMAGE_LENGTH][0]
+            if ifd_width * ifd_height > width * height:
+                width, height = ifd_width, ifd_height
+                if TIFF_TAG_BITS_PER_SAMPLE in fields:
+                    first, count, offset = fields[TIFF_TAG_BITS_PER_SAMPLE]
+                    if count > 2:
+                        # More than two SHORTs do not fit the entry: the value lives at offset
+                        first = value(read_at(base + offset, 2), 0, 2)
+                    bit_depth = first or 8
+    return width, height, bit_depth, camera
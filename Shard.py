@@ -0,0 +1,279 @@
+import os
+import gzip
+import json
+import socket
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import settings
+from Utils import *
+from Walker import WalkFolder
+from ZipCrawl import StreamZip, ZipEntryTimestamp, ZipEntryExifTimestamp
+from Classifier import KIND_IMAGE, KIND_ARCHIVE
+from Plan import WritePlan
+
+
+# File formats written by this module, checked when they are read back
+SHARD_FORMAT = 'photocrawler-shard'
+SHARD_VERSION = 1
+
+# Files hashed ahead of the walk per scan worker
+SCAN_QUEUE_PER_WORKER = 4
+
+
+# One scanned image. node comes from the shard header; exif_date is None without a metadata
+# date; in_archive is True for ZIP entries, whose path is <zip path>/<entry name>
+ShardEntry = namedtuple('ShardEntry', 'node path size mtime hash exif_date in_archive')
+
+
+def DefaultNodeId():
+    return socket.gethostname()
+
+
+class ShardWriter:
+    """Writes a shard manifest: a gzip-compressed JSON Lines file.
+
+    The first line is a header with the format, node id, scanned roots and creation time.
+    Every further line is one image as a compact list:
+        [path, size, mtime, quick hash, EXIF date or null, 1 for ZIP entries else 0]
+
+    Add is safe to call from several threads.
+    """
+
+    def __init__(self, path, node_id, roots):
+        self.path = path
+        self.node_id = node_id
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        header = dict(format=SHARD_FORMAT, version=SHARD_VERSION, node=node_id, roots=list(roots),
+                      created=datetime.now().isoformat(timespec='seconds'))
+        self._file.write(json.dumps(header) + '\n')
+
+    def Add(self, path, size, mtime, file_hash, exif_date, in_archive=False):
+        line = json.dumps([path, size, mtime, file_hash, exif_date, 1 if in_archive else 0]) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+
+    def Close(self):
+        with self._lock:
+            self._file.close()
+
+
+def ReadShard(path):
+    """Yield the ShardEntry records of a shard manifest.
+
+    Raises:
+        ValueError: If the file is not a shard manifest of a supported version
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('format') != SHARD_FORMAT:
+            raise ValueError(f"{path} is not a shard manifest")
+        if header.get('version') != SHARD_VERSION:
+            raise ValueError(f"{path} has unsupported shard version {header.get('version')}")
+        node = header['node']
+        for line in f:
+            path_, size, mtime, file_hash, exif_date, in_archive = json.loads(line)
+            yield ShardEntry(node, path_, size, mtime, file_hash, exif_date, bool(in_archive))
+
+
+def _ScanFile(writer, fullpath, filename, file_stat):
+    """Hash one image and read its EXIF date (the scan-only counterpart of Utils.CheckPhoto)."""
+    if IsFaceCrop(filename):
+        return
+    metrics = GetMetrics()
+    wants_exif = GetClassifier().WantsMetadataDate(filename)
+    probe = FileProbe(fullpath, file_stat.st_size, EXIF_PREFIX_SIZE if wants_exif else QUICK_HASH_CHUNK_SIZE)
+    with metrics.Time('hash'):
+        file_hash = probe.QuickHash()
+    if file_hash is None:
+        LOG('ERROR', f"Skipping {fullpath} (failed to compute hash)")
+        return
+
+    exif_date = None
+    if wants_exif:
+        with metrics.Time('exif'):
+            parsed, exif_date = probe.ExifTimestamp()
+            if not parsed:
+                exif_date = GetEarliestDateCreatedWithPillow(fullpath)
+    writer.Add(fullpath, file_stat.st_size, file_stat.st_mtime, file_hash, exif_date)
+
+
+def _ScanZipEntry(writer, zfile, zipentry_info, entry_path, entry_name):
+    """Hash one image entry of an open ZIP file; passed to ZipCrawl.StreamZip as add_entry."""
+    if IsFaceCrop(entry_name):
+        return
+    metrics = GetMetrics()
+    with metrics.Time('hash'), zfile.open(zipentry_info) as stream:
+        file_hash, head = ComputeQuickStreamHash(stream, zipentry_info.file_size)
+    if file_hash is None:
+        LOG('ERROR', f"Skipping {entry_path} (failed to compute hash)")
+        return
+
+    exif_date = None
+    if GetClassifier().WantsMetadataDate(entry_name):
+        with metrics.Time('exif'):
+            exif_date = ZipEntryExifTimestamp(zfile, zipentry_info, head, entry_name)
+    writer.Add(entry_path, zipentry_info.file_size, ZipEntryTimestamp(zipentry_info), file_hash, exif_date, in_archive=True)
+
+
+def _ScanZip(writer, zipname):
+    with GetMetrics().Time('zip'):
+        StreamZip(zipname, add_entry=lambda *entry: _ScanZipEntry(writer, *entry))
+
+
+def ScanShard(roots, shard_path, node_id=None, workers=4):
+    """Scan-only mode: record every image below roots in a shard manifest, copying nothing.
+
+    Needs no database: every image is hashed and its EXIF date read, so each shard is a
+    complete description of what a node holds. ZIP files are streamed like in the crawl.
+    Photos libraries are not scanned; run the normal crawl on the node that holds them.
+
+    Args:
+        roots: Directories to scan
+        shard_path: Shard manifest to write (see ShardWriter)
+        node_id: Identifies this node in the merge (default: the host name)
+        workers: Threads hashing files and ZIP files while the walk continues
+
+    Returns:
+        int: Number of images recorded
+    """
+    node_id = node_id or DefaultNodeId()
+    classifier = GetClassifier()
+    writer = ShardWriter(shard_path, node_id, roots)
+    LOG('INFO', f"Scanning {', '.join(roots)} into shard {shard_path} (node {node_id})")
+    # Bound the files waiting for a worker, so the walk does not run far ahead
+    slots = threading.BoundedSemaphore(max(1, workers) * SCAN_QUEUE_PER_WORKER)
+
+    def submit(executor, function, *args):
+        slots.acquire()
+        future = executor.submit(function, writer, *args)
+        future.add_done_callback(lambda done: slots.release())
+        return future
+
+    def report(future):
+        if future.exception() is not None:
+            LOG('ERROR', f"Error scanning into shard: {str(future.exception())}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='scan') as executor:
+            for root in roots:
+                for listing in WalkFolder(root, settings.gWalkWorkers, track_manifests=False):
+                    for library_path in listing.libraries:
+                        LOG('WARNING', f"Not scanning Photos library {library_path} in scan-only mode")
+                    for entry in listing.files:
+                        kind = classifier.Kind(entry.name, entry.path)
+                        if kind == KIND_IMAGE:
+                            CountStat('folder_images')
+                            entry_stat = entry.stat()
+                            CountStat('image_bytes', entry_stat.st_size)
+                            submit(executor, _ScanFile, entry.path, entry.name, entry_stat).add_done_callback(report)
+                        elif kind == KIND_ARCHIVE:
+                            submit(executor, _ScanZip, entry.path).add_done_callback(report)
+                        elif entry.is_file():
+                            CountStat('non_image_files')
+    finally:
+        writer.Close()
+    LOG('INFO', f"Shard {shard_path} written: {writer.count} images")
+    return writer.count
+
+
+def _PreferenceKey(entry):
+    """Sort key choosing the copy of a duplicate that is transferred: the lowest key wins.
+
+    Plain files beat ZIP entries (no archive to read), a known EXIF date beats none, and
+    node and path break ties so the result does not depend on the shard order.
+    """
+    return (entry.in_archive, entry.exif_date is None, entry.node, entry.path)
+
+
+def _UniqueDestination(dest_path, file_hash, taken):
+    """Make dest_path unique within the plan and the output by adding part of the hash to the name.
+
+    Plan.ApplyPlan checks the destination again, as the output may change before the plan is applied.
+    """
+    root, ext = os.path.splitext(dest_path)
+    attempt = 0
+    while dest_path in taken or os.path.lexists(dest_path):
+        attempt += 1
+        dest_path = f"{root}_{file_hash[:8]}{ext}" if attempt == 1 else f"{root}_{file_hash[:8]}_{attempt}{ext}"
+    return dest_path
+
+
+def MergeShards(shard_paths, plan_path):
+    """Merge shard manifests into a copy plan that transfers every unique image once.
+
+    All entries are grouped by quick hash; of every group one copy is chosen (see
+    _PreferenceKey), and hashes settings.gDatabase already holds are dropped with one batched
+    query. Destinations follow OrganizePath like in the crawl.
+
+    The plan (see Plan.WritePlan) holds one copy action per image, sorted by node and source
+    path so every node can read off its own transfers, and is executed by Plan.ApplyPlan on
+    each node. The other files of a group may differ from the chosen one past the parts the
+    quick hash reads, and no node sees the files of another, so each of them becomes a
+    confirm action: apply compares its full hash with that of the chosen copy in the output
+    and copies it only if they differ.
+
+    Args:
+        shard_paths: Shard manifests written by ScanShard
+        plan_path: Plan file to write
+
+    Returns:
+        dict: Number of entries, unique images, images already in the database, planned copies
+            and duplicates to confirm
+    """
+    groups = {}
+    entries = 0
+    for shard_path in shard_paths:
+        LOG('INFO', f"Reading shard {shard_path}")
+        for entry in ReadShard(shard_path):
+            entries += 1
+            # keyed by node and path: overlapping scan paths of a node list a file twice
+            groups.setdefault(entry.hash, {})[(entry.node, entry.path)] = entry
+    CountStat('shard_entries', entries)
+    CountStat('shard_duplicates', entries - len(groups))
+
+    known = settings.gDatabase.FindKnownHashes(groups.keys()) if settings.gDatabase is not None else set()
+    CountStat('skipped_database', len(known))
+
+    actions = []
+    taken = set()
+
+    def plan(action, entry, **fields):
+        filename = os.path.basename(entry.path)
+        organization_timestamp = entry.exif_date if entry.exif_date else entry.mtime
+        dest_path = _UniqueDestination(os.path.join(OrganizePath(entry.path, organization_timestamp), filename), entry.hash, taken)
+        taken.add(dest_path)
+        actions.append(dict(action=action, node=entry.node, source=entry.path, dest=dest_path,
+                            filename=os.path.basename(dest_path), hash=entry.hash, size=entry.size,
+                            timestamp=entry.mtime, in_archive=entry.in_archive, **fields))
+        return dest_path
+
+    # the chosen copies are planned first, so they keep their names when destinations clash
+    chosen = sorted((sorted(group.values(), key=_PreferenceKey) for file_hash, group in groups.items() if file_hash not in known),
+                    key=lambda members: (members[0].node, members[0].path))
+    originals = [plan('copy', members[0]) for members in chosen]
+    for members, original in zip(chosen, originals):
+        for entry in members[1:]:
+            plan('confirm', entry, original=original)
+    actions.sort(key=lambda action: (action['node'], action['source']))
+    copies = sum(1 for action in actions if action['action'] == 'copy')
+    CountStat('planned_copies', copies)
+    CountStat('planned_confirmations', len(actions) - copies)
+
+    WritePlan(plan_path, actions, output=settings.gOutputPath, shards=list(shard_paths))
+
+    per_node = {}
+    for action in actions:
+        if action['action'] == 'copy':
+            files, size = per_node.get(action['node'], (0, 0))
+            per_node[action['node']] = (files + 1, size + action['size'])
+    for node, (files, size) in sorted(per_node.items()):
+        LOG('INFO', f"Plan for node {node}: {files} files, {size / (1024 * 1024):.1f} MB")
+    LOG('INFO', f"Merged {entries} shard entries: {len(groups)} unique, {len(known)} already in the database, "
+                f"{copies} copies and {len(actions) - copies} duplicates to confirm planned in {plan_path}")
+    return dict(entries=entries, unique=len(groups), known=len(known), planned=copies,
+                confirm=len(actions) - copies)
@@ -0,0 +1,303 @@
+"""Generate reproducible synthetic photo trees for benchmarks.
+
+    python SyntheticTree.py OUTPUT [--photos 1000] [--depth 3] [--fanout 4] [--duplicate-rate 0.1]
+                            [--raw-rate 0.1] [--video-rate 0.05] [--zips 2] [--libraries 1] [--seed 1]
+
+The tree holds JPEGs with EXIF dates, TIFF/CR2/NEF-style RAW headers, MOV/MP4/HEIC files with
+capture dates, exact duplicates of earlier files, ZIP files with a nested ZIP inside, and
+.photoslibrary packages with a fixture Photos.sqlite (see MakePhotosDatabase). The same
+arguments always produce the same tree.
+"""
+import io
+import os
+import sys
+import json
+import random
+import sqlite3
+import plistlib
+import struct
+import zipfile
+import argparse
+from datetime import datetime
+
+# Seconds between the QuickTime/MP4 epoch (1904-01-01 UTC) and the Unix epoch
+MAC_EPOCH_OFFSET = 2082844800
+
+# Date range of the generated capture dates
+FIRST_DATE = datetime(2005, 1, 1).timestamp()
+LAST_DATE = datetime(2024, 12, 31).timestamp()
+
+
+def _Box(box_type, payload):
+    return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+
+def _FullBox(box_type, version, payload):
+    return _Box(box_type, bytes([version]) + b'\x00\x00\x00' + payload)
+
+
+def _ExifDate(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y:%m:%d %H:%M:%S')
+
+
+def _TiffExif(date, header=b'II*\x00\x08\x00\x00\x00'):
+    """Little-endian TIFF structure with DateTime in IFD0 and DateTimeOriginal in the EXIF IFD.
+
+    IFD0 starts right after header, which must be a TIFF header pointing there.
+    """
+    date_bytes = date.encode('ascii') + b'\x00'
+    # Header + IFD0 (2 + 2*12 + 4) + EXIF IFD (2 + 12 + 4) + two date values
+    ifd0_offset = len(header)
+    exif_ifd_offset = ifd0_offset + 2 + 2 * 12 + 4
+    date0_offset = exif_ifd_offset + 2 + 12 + 4
+    date1_offset = date0_offset + len(date_bytes)
+    data = header
+    data += struct.pack('<H', 2)
+    data += struct.pack('<HHII', 306, 2, len(date_bytes), date0_offset)
+    data += struct.pack('<HHII', 34665, 4, 1, exif_ifd_offset)
+    data += struct.pack('<I', 0)
+    data += struct.pack('<H', 1)
+    data += struct.pack('<HHII', 36867, 2, len(date_bytes), date1_offset)
+    data += struct.pack('<I', 0)
+    return data + date_bytes + date_bytes
+
+
+def MakeJpeg(rng, timestamp, size=(64, 48)):
+    """JPEG with an EXIF APP1 segment holding DateTime and DateTimeOriginal."""
+    from PIL import Image
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', exif=b'Exif\x00\x00' + _TiffExif(_ExifDate(timestamp)))
+    # Bytes after the end-of-image marker make every file unique without re-encoding
+    return buffer.getvalue() + rng.randbytes(16)
+
+
+def MakeRaw(rng, timestamp, kind='tif', size=256 * 1024):
+    """TIFF-based file: plain TIFF/NEF, or CR2 with its signature after the TIFF header, padded with noise."""
+    if kind == 'cr2':
+        # CR2: TIFF header pointing past the 'CR' signature, version and RAW IFD offset
+        header = _TiffExif(_ExifDate(timestamp), b'II*\x00\x10\x00\x00\x00CR\x02\x00\x00\x00\x00\x00')
+    else:
+        header = _TiffExif(_ExifDate(timestamp))
+    return header + rng.randbytes(max(0, size - len(header)))
+
+
+def MakeMovie(rng, timestamp, brand=b'qt  ', size=256 * 1024):
+    """MOV/MP4 with media data first, then moov holding mvhd and the QuickTime creationdate key."""
+    mvhd = _FullBox(b'mvhd', 0, struct.pack('>II', int(timestamp) + MAC_EPOCH_OFFSET, 0) + b'\x00' * 88)
+    key = b'com.apple.quicktime.creationdate'
+    hdlr = _FullBox(b'hdlr', 0, b'\x00' * 4 + b'mdta' + b'\x00' * 13)
+    keys = _FullBox(b'keys', 0, struct.pack('>I', 1) + struct.pack('>I', 8 + len(key)) + b'mdta' + key)
+    date = datetime.fromtimestamp(timestamp).astimezone().strftime('%Y-%m-%dT%H:%M:%S%z').encode('ascii')
+    ilst = _Box(b'ilst', _Box((1).to_bytes(4, 'big'), _Box(b'data', b'\x00\x00\x00\x01\x00\x00\x00\x00' + date)))
+    moov = _Box(b'moov', mvhd + _Box(b'meta', hdlr + keys + ilst))
+    ftyp = _Box(b'ftyp', brand + b'\x00\x00\x00\x00' + brand)
+    mdat = _Box(b'mdat', rng.randbytes(max(0, size - len(ftyp) - len(moov) - 8)))
+    return ftyp + mdat + moov
+
+
+def MakeHeic(rng, timestamp, size=64 * 1024, dimensions=(4032, 3024), bit_depth=8):
+    """HEIC with an Exif item located through iinf/iloc in the media data, and ispe/pixi properties."""
+    exif_payload = struct.pack('>I', 6) + b'Exif\x00\x00' + _TiffExif(_ExifDate(timestamp))
+    ftyp = _Box(b'ftyp', b'heic\x00\x00\x00\x00mif1heic')
+    hdlr = _FullBox(b'hdlr', 0, b'\x00' * 4 + b'pict' + b'\x00' * 13)
+    infe_image = _FullBox(b'infe', 2, struct.pack('>HH', 1, 0) + b'hvc1' + b'\x00')
+    infe_exif = _FullBox(b'infe', 2, struct.pack('>HH', 2, 0) + b'Exif' + b'\x00')
+    iinf = _FullBox(b'iinf', 0, struct.pack('>H', 2) + infe_image + infe_exif)
+    ispe = _FullBox(b'ispe', 0, struct.pack('>II', *dimensions))
+    pixi = _FullBox(b'pixi', 0, bytes([3, bit_depth, bit_depth, bit_depth]))
+    iprp = _Box(b'iprp', _Box(b'ipco', ispe + pixi))
+    image_size = max(16, size - len(exif_payload))
+
+    def iloc(data_offset):
+        items = struct.pack('>HHHII', 1, 0, 1, data_offset, image_size)
+        items += struct.pack('>HHHII', 2, 0, 1, data_offset + image_size, len(exif_payload))
+        return _FullBox(b'iloc', 0, bytes([0x44, 0x00]) + struct.pack('>H', 2) + items)
+
+    meta_size = len(_FullBox(b'meta', 0, hdlr + iinf + iprp + iloc(0)))
+    data_offset = len(ftyp) + meta_size + 8
+    meta = _FullBox(b'meta', 0, hdlr + iinf + iprp + iloc(data_offset))
+    return ftyp + meta + _Box(b'mdat', rng.randbytes(image_size) + exif_payload)
+
+
+# (extension, builder) of the media files written besides JPEGs
+RAW_KINDS = (('tif', lambda rng, ts: MakeRaw(rng, ts, 'tif')),
+             ('cr2', lambda rng, ts: MakeRaw(rng, ts, 'cr2')),
+             ('nef', lambda rng, ts: MakeRaw(rng, ts, 'nef')))
+VIDEO_KINDS = (('mov', lambda rng, ts: MakeMovie(rng, ts, b'qt  ')),
+               ('mp4', lambda rng, ts: MakeMovie(rng, ts, b'isom')),
+               ('heic', lambda rng, ts: MakeHeic(rng, ts)))
+
+
+# Core Data epoch (2001-01-01 UTC) used by the dates in Photos.sqlite
+CORE_DATA_EPOCH_OFFSET = 978307200
+
+# PLModelVersion written to fixture Photos.sqlite files (Photos 9, macOS 14)
+PHOTOS_MODEL_VERSION = 17000
+
+
+def MakePhotosDatabase(db_path, assets, model_version=PHOTOS_MODEL_VERSION):
+    """Write a fixture Photos.sqlite holding the tables and columns PhotosDatabase.py reads.
+
+    Args:
+        db_path: File to write
+        assets: dicts with uuid, directory, filename, original_filename, created (Unix
+            timestamp), size and optionally trashed, edited and video
+        model_version: PLModelVersion stored in Z_METADATA
+    """
+    connection = sqlite3.connect(db_path)
+    connection.execute('CREATE TABLE Z_METADATA (Z_VERSION INTEGER PRIMARY KEY, Z_UUID VARCHAR, Z_PLIST BLOB)')
+    connection.execute('INSERT INTO Z_METADATA VALUES (1, ?, ?)',
+                       ('00000000-0000-0000-0000-000000000000', plistlib.dumps(dict(PLModelVersion=model_version))))
+    connection.execute('CREATE TABLE ZASSET (Z_PK INTEGER PRIMARY KEY, ZUUID VARCHAR, ZDIRECTORY VARCHAR, ZFILENAME VARCHAR, '
+                       'ZDATECREATED TIMESTAMP, ZMODIFICATIONDATE TIMESTAMP, ZTRASHEDSTATE INTEGER, ZHASADJUSTMENTS INTEGER, '
+                       'ZKIND INTEGER)')
+    connection.execute('CREATE TABLE ZADDITIONALASSETATTRIBUTES (Z_PK INTEGER PRIMARY KEY, ZASSET INTEGER, '
+                       'ZORIGINALFILENAME VARCHAR, ZORIGINALFILESIZE INTEGER)')
+    for pk, asset in enumerate(assets, 1):
+        created = asset['created'] - CORE_DATA_EPOCH_OFFSET
+        connection.execute('INSERT INTO ZASSET VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (pk, asset['uuid'], asset['directory'], asset['filename'], created, created,
+                            int(asset.get('trashed', False)), int(asset.get('edited', False)), int(asset.get('video', False))))
+        connection.execute('INSERT INTO ZADDITIONALASSETATTRIBUTES VALUES (?, ?, ?, ?)',
+                           (pk, pk, asset['original_filename'], asset['size']))
+    connection.commit()
+    connection.close()
+
+
+def _Directories(root, depth, fanout):
+    """Return every directory of a tree with the given depth and fanout, root first."""
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"folder{i:02d}") for parent in level for i in range(fanout)]
+        directories.extend(level)
+    return directories
+
+
+def GenerateTree(root, photos=1000, depth=3, fanout=4, duplicate_rate=0.1, raw_rate=0.1,
+                 video_rate=0.05, zips=2, libraries=1, seed=1):
+    """Write a synthetic photo tree below root.
+
+    Args:
+        root: Output directory (created if needed)
+        photos: Number of media files spread over the directories (duplicates included)
+        depth, fanout: Shape of the directory tree
+        duplicate_rate: Fraction of files that are byte copies of an earlier file
+        raw_rate, video_rate: Fractions of TIFF/CR2/NEF and MOV/MP4/HEIC files; the rest are JPEGs
+        zips: Number of ZIP files; each holds JPEGs, a duplicate and a nested ZIP
+        libraries: Number of .photoslibrary packages with a fixture Photos.sqlite and originals/ tree
+        seed: Random seed; the same arguments always give the same tree
+
+    Returns:
+        dict: Counts of what was written
+    """
+    rng = random.Random(seed)
+    directories = _Directories(root, depth, fanout)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    summary = dict(directories=len(directories), jpeg=0, raw=0, video=0, duplicates=0,
+                   zips=0, zip_entries=0, libraries=0, bytes=0)
+    written = []
+
+    def write(path, data, timestamp):
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (timestamp, timestamp))
+        summary['bytes'] += len(data)
+
+    for i in range(photos):
+        directory = directories[rng.randrange(len(directories))]
+        timestamp = rng.uniform(FIRST_DATE, LAST_DATE)
+        roll = rng.random()
+        if written and roll < duplicate_rate:
+            source_path, extension, data = written[rng.randrange(len(written))]
+            path = os.path.join(directory, f"COPY_{i:07d}.{extension}")
+            summary['duplicates'] += 1
+        elif roll < duplicate_rate + raw_rate:
+            extension, builder = RAW_KINDS[rng.randrange(len(RAW_KINDS))]
+            data = builder(rng, timestamp)
+            path = os.path.join(directory, f"RAW_{i:07d}.{extension}")
+            summary['raw'] += 1
+        elif roll < duplicate_rate + raw_rate + video_rate:
+            extension, builder = VIDEO_KINDS[rng.randrange(len(VIDEO_KINDS))]
+            data = builder(rng, timestamp)
+            path = os.path.join(directory, f"VID_{i:07d}.{extension}")
+            summary['video'] += 1
+        else:
+            extension = 'jpg'
+            data = MakeJpeg(rng, timestamp)
+            path = os.path.join(directory, f"IMG_{i:07d}.jpg")
+            summary['jpeg'] += 1
+        write(path, data, timestamp)
+        if len(written) < 10000:
+            written.append((path, extension, data))
+
+    for z in range(zips):
+        directory = directories[rng.randrange(len(directories))]
+        path = os.path.join(directory, f"archive_{z:03d}.zip")
+        nested = io.BytesIO()
+        with zipfile.ZipFile(nested, 'w') as nested_zip:
+            for n in range(3):
+                nested_zip.writestr(f"nested/IMG_N{z:03d}_{n}.jpg", MakeJpeg(rng, rng.uniform(FIRST_DATE, LAST_DATE)))
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for n in range(5):
+                archive.writestr(f"photos/IMG_Z{z:03d}_{n}.jpg", MakeJpeg(rng, rng.uniform(FIRST_DATE, LAST_DATE)))
+            if written:
+                archive.writestr(f"photos/DUP_Z{z:03d}.jpg", written[rng.randrange(len(written))][2])
+            archive.writestr("nested.zip", nested.getvalue())
+        summary['zips'] += 1
+        summary['zip_entries'] += 9 if written else 8
+        summary['bytes'] += os.path.getsize(path)
+
+    for n in range(libraries):
+        library = os.path.join(root, f"Library {n}.photoslibrary")
+        os.makedirs(os.path.join(library, 'database'), exist_ok=True)
+        assets = []
+        for m in range(5):
+            originals = os.path.join(library, 'originals', f"{m:X}")
+            os.makedirs(originals, exist_ok=True)
+            uuid = f"{m:X}{rng.getrandbits(124):031X}"
+            timestamp = rng.uniform(FIRST_DATE, LAST_DATE)
+            data = MakeJpeg(rng, timestamp)
+            write(os.path.join(originals, f"{uuid}.jpeg"), data, LAST_DATE)
+            assets.append(dict(uuid=uuid, directory=f"{m:X}", filename=f"{uuid}.jpeg",
+                               original_filename=f"IMG_L{n:02d}{m:02d}.JPG", created=timestamp, size=len(data)))
+        # An original only in iCloud, one only present as its rendered edit, and a trashed photo
+        for kind in ('missing', 'edited', 'trashed'):
+            uuid = f"{rng.getrandbits(128):032X}"
+            timestamp = rng.uniform(FIRST_DATE, LAST_DATE)
+            asset = dict(uuid=uuid, directory=uuid[0], filename=f"{uuid}.heic", original_filename=f"IMG_{kind.upper()}{n:02d}.HEIC",
+                         created=timestamp, size=64 * 1024, edited=kind == 'edited', trashed=kind == 'trashed')
+            if kind == 'edited':
+                renders = os.path.join(library, 'resources', 'renders', uuid[0])
+                os.makedirs(renders, exist_ok=True)
+                write(os.path.join(renders, f"{uuid}_1_201_a.jpeg"), MakeJpeg(rng, timestamp), LAST_DATE)
+            assets.append(asset)
+        MakePhotosDatabase(os.path.join(library, 'database', 'Photos.sqlite'), assets)
+        summary['libraries'] += 1
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic photo tree for benchmarks')
+    parser.add_argument('output', help='Directory to write the tree to')
+    parser.add_argument('--photos', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--duplicate-rate', type=float, default=0.1)
+    parser.add_argument('--raw-rate', type=float, default=0.1)
+    parser.add_argument('--video-rate', type=float, default=0.05)
+    parser.add_argument('--zips', type=int, default=2)
+    parser.add_argument('--libraries', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    summary = GenerateTree(args.output, args.photos, args.depth, args.fanout, args.duplicate_rate,
+                           args.raw_rate, args.video_rate, args.zips, args.libraries, args.seed)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,27 @@
 
+import io
 import os
+import mmap
 import re
 import shutil
 import settings
 import time
+import threading
 import xxhash
 import logging
 from datetime import datetime, timezone
 from PIL import Image
 from PIL.ExifTags import TAGS
+import IsoBmff
+from PerceptualHash import ComputeDHash, IsSameShot, PERCEPTUAL_FORMATS
+from QualityScore import ScoreImage
 
 # Global logger instance for the entire application (initialized in main())
 gLogger = None
 
+# Guards settings.gIncompleteDirectories, which is updated from crawler and pipeline threads
+gCounterLock = threading.Lock()
+
 
 def LOG(level, message, exc_info=False):
     """Log message at specified level and print it with level prefix.
@@ -37,6 +46,36 @@ def LOG(level, message, exc_info=False):
     #print(f"{level_upper}: {message}")
 
 
+def GetMetrics():
+    """Return settings.gMetrics, creating it on first use (see Metrics.py)."""
+    if settings.gMetrics is None:
+        import Metrics
+        settings.gMetrics = Metrics.Metrics()
+    return settings.gMetrics
+
+
+def CountStat(counter_name, amount=1):
+    """Increment one of the run statistics counters; safe to call from any thread.
+    
+    Args:
+        counter_name: Name of the counter (e.g. 'skipped_database')
+        amount: Value to add to the counter (default 1)
+    """
+    GetMetrics().Count(counter_name, amount)
+
+
+def MarkIncomplete(in_source_path):
+    """Remember that a file could not be imported, so its directory is checked again next run.
+    
+    For ZIP entries (<zip path>/<entry name>) this is the directory holding the ZIP file.
+    """
+    directory = os.path.dirname(os.path.normpath(in_source_path))
+    while directory and directory != os.path.dirname(directory) and not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    with gCounterLock:
+        settings.gIncompleteDirectories.add(directory)
+
+
 def NormalizePath(path):
     """Normalize a path by expanding user directory and normalizing separators."""
     if path is None:
@@ -102,21 +141,69 @@ def MakeSurePathExists(path):
 def MakeDirectorySafe(path):
     MakeSurePathExists(path)
 
+
+# Output directories created (or found) during this run; nothing in the output is ever removed
+gOutputDirectories = set()
+
+
+def MakeOutputDirectory(path):
+    """MakeSurePathExists for a directory below settings.gOutputPath.
+    
+    Costs one mkdir per directory the first time and no system call afterwards; unlike
+    os.makedirs, the parents are not checked again for every new directory.
+    """
+    if path in gOutputDirectories:
+        return
+    parent = os.path.dirname(path)
+    if parent not in gOutputDirectories and os.path.normpath(parent) != os.path.normpath(settings.gOutputPath):
+        if parent == path:
+            return
+        MakeOutputDirectory(parent)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    gOutputDirectories.add(path)
+
+# Files from this size on are hashed through a memory map by ComputeFileHash
+FULL_HASH_MMAP_MIN_SIZE = 1024 * 1024
+
+# Read size of ComputeFileHash when a file cannot be memory mapped
+FULL_HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
 def ComputeFileHash(filepath):
     """Compute full xxHash (xxh64) of a file for duplicate detection.
     
     Uses xxHash which is 3-5x faster than MD5 while providing excellent
     hash distribution for duplicate detection purposes.
     
+    Files of FULL_HASH_MMAP_MIN_SIZE and up are memory mapped and hashed in one pass without
+    copying them into Python; smaller files, and files that cannot be mapped (some network
+    filesystems), are read in FULL_HASH_BLOCK_SIZE blocks into one reused buffer.
+    
     Note: For most use cases, prefer ComputeQuickFileHash() which is much faster
-    and provides excellent duplicate detection for photo files.
+    and provides excellent duplicate detection for photo files. IsKnownDuplicate uses this
+    only to confirm quick hash matches (settings.gVerifyDuplicates).
     """
     try:
         hasher = xxhash.xxh64()
-        with open(filepath, "rb") as f:
-            # Read file in chunks to handle large files efficiently
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
+        with open(filepath, "rb", buffering=0) as f:
+            mapped = None
+            if os.fstat(f.fileno()).st_size >= FULL_HASH_MMAP_MIN_SIZE:
+                try:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    mapped = None
+            if mapped is not None:
+                with mapped:
+                    if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mapped)
+            else:
+                buffer = memoryview(bytearray(FULL_HASH_BLOCK_SIZE))
+                for count in iter(lambda: f.readinto(buffer), 0):
+                    hasher.update(buffer[:count])
         return hasher.hexdigest()
     except Exception as e:
         LOG('ERROR', f"Error computing hash for {filepath}: {str(e)}", exc_info=True)
@@ -127,7 +214,7 @@ def ComputeFileHash(filepath):
 QUICK_HASH_CHUNK_SIZE = 65536
 
 
-def ComputeQuickFileHash(filepath, chunk_size=QUICK_HASH_CHUNK_SIZE):
+def ComputeQuickFileHash(filepath, chunk_size=QUICK_HASH_CHUNK_SIZE, file_size=None):
     """Compute a quick hash of a file for fast duplicate detection.
     
     Uses xxHash (xxh64) with file size plus first and last chunks for identification.
@@ -144,13 +231,14 @@ def ComputeQuickFileHash(filepath, chunk_size=QUICK_HASH_CHUNK_SIZE):
     Args:
         filepath: Path to the file
         chunk_size: Size of chunks to read from start and end (default 64KB)
+        file_size: Size of the file if the caller already has it from a stat (saves a stat call)
         
     Returns:
         Hash string or None on error
     """
     try:
-        file_stat = os.stat(filepath)
-        file_size = file_stat.st_size
+        if file_size is None:
+            file_size = os.stat(filepath).st_size
         
         hasher = xxhash.xxh64()
         
@@ -177,12 +265,57 @@ def ComputeQuickFileHash(filepath, chunk_size=QUICK_HASH_CHUNK_SIZE):
         LOG('ERROR', f"Error computing quick hash for {filepath}: {str(e)}", exc_info=True)
         return None
 
+# Bytes of the start of a stream kept by ComputeQuickStreamHash for the EXIF readers
+# (matches what GetTiffBasedExifPhotoTakenTime reads from a file)
+EXIF_HEAD_SIZE = 1024 * 1024
+
+# Read size used when streaming through data that is not kept
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+def ComputeQuickStreamHash(stream, file_size, chunk_size=QUICK_HASH_CHUNK_SIZE, head_size=EXIF_HEAD_SIZE):
+    """Compute the ComputeQuickFileHash value of a forward-only stream, such as a ZIP entry.
+    
+    The stream is read once. The first head_size bytes are kept and returned so the EXIF
+    readers can use them without reading the stream again.
+    
+    Args:
+        stream: Readable file object positioned at the start of the data
+        file_size: Size of the uncompressed data
+        chunk_size: Size of chunks to hash from start and end (default 64KB)
+        head_size: Number of leading bytes to return (default 1MB)
+        
+    Returns:
+        tuple[str, bytes]: (hash, head) - hash is None on error
+    """
+    try:
+        hasher = xxhash.xxh64()
+        hasher.update(f"quickhash:size={file_size}:".encode('utf-8'))
+        
+        head = stream.read(max(head_size, chunk_size))
+        if file_size <= chunk_size * 2:
+            hasher.update(head + stream.read())
+        else:
+            hasher.update(head[:chunk_size])
+            # Keep only the last chunk of what was read so far
+            tail = head[-chunk_size:]
+            for block in iter(lambda: stream.read(STREAM_BLOCK_SIZE), b""):
+                tail = (tail + block)[-chunk_size:]
+            hasher.update(tail)
+        return hasher.hexdigest(), head[:head_size]
+    except Exception as e:
+        LOG('ERROR', f"Error computing quick hash of stream: {str(e)}", exc_info=True)
+        return None, b""
+
 #from Pillow: https://pillow.readthedocs.io/en/stable/handbook/overview.html#image-archives
 def GetEarliestDateCreatedFromExif(image_path):
     """Get Content Created date from EXIF data by checking date/time tags and returning the earliest valid timestamp.
     
     Only checks known date/time EXIF tags: 306 (DateTime), 36867 (DateTimeOriginal), 36868 (DateTimeDigitized).
     For TIFF-based files (CR2, NEF, TIF, TIFF), uses custom binary parser first for reliable EXIF reading.
+    JPEG, PNG and WebP files are read with the header-only parser (see GetHeaderExifPhotoTakenTime),
+    HEIC/HEIF/MOV/MP4 with the box reader in IsoBmff.py; Pillow is the fallback for other
+    formats and for files the header-only parser cannot read.
     
     Args:
         image_path: Path to the image file
@@ -194,50 +327,111 @@ def GetEarliestDateCreatedFromExif(image_path):
     if image_path.lower().endswith(TIFF_BASED_EXIF_EXTENSIONS):
         return GetTiffBasedExifPhotoTakenTime(image_path)
 
+    try:
+        with open(image_path, 'rb') as f:
+            prefix = f.read(EXIF_PREFIX_SIZE)
+            if SniffImageFormat(prefix) == 'isobmff':
+                return GetIsoBmffPhotoTakenTime(_PrefixReader(prefix, f), os.fstat(f.fileno()).st_size)
+            parsed, timestamp = GetHeaderExifPhotoTakenTime(prefix, f)
+        if parsed:
+            return timestamp
+    except Exception as e:
+        LOG('DEBUG', f"Header EXIF parser failed for {image_path}, using Pillow: {str(e)}")
+
+    return GetEarliestDateCreatedWithPillow(image_path)
+
+
+def GetEarliestDateCreatedWithPillow(image_path):
+    """The Pillow part of GetEarliestDateCreatedFromExif, for formats the binary parsers do not handle."""
     try:
         with Image.open(image_path) as image:
-            exifdata = image._getexif()
-            
-            if not exifdata:
-                return None
-            
-            # Only check known date/time EXIF tags
-            date_tags = [
-                (306, 'DateTime'),
-                (36867, 'DateTimeOriginal'),
-                (36868, 'DateTimeDigitized')
-            ]
-            
-            # Collect all valid timestamps from date/time tags
-            valid_timestamps = []
-            
-            for tag_id, tag_name in date_tags:
-                if tag_id in exifdata:
-                    value = exifdata[tag_id]
-                    # Check if value is a string that looks like an EXIF date/time
-                    if isinstance(value, str):
-                        try:
-                            # Try to parse it as an EXIF date
-                            timestamp = ParseExifDateString(value)
-                            if timestamp is not None:
-                                valid_timestamps.append(timestamp)
-                                # LOG('DEBUG', f"Found valid EXIF date tag {tag_name} ({tag_id}): {value} -> {timestamp}")
-                        except Exception:
-                            # Not a valid date string, skip
-                            # LOG('DEBUG', f"Invalid date string in EXIF tag {tag_name} ({tag_id}): {value}")
-                            pass
-            
-            # Return the earliest (minimum) timestamp found
-            if valid_timestamps:
-                earliest = min(valid_timestamps)
-                # LOG('DEBUG', f"Earliest EXIF timestamp found: {earliest}")
-                return earliest
-            
+            return _GetEarliestDateFromPillowImage(image)
     except Exception as e:
         LOG('WARNING', f"No EXIF data in {image_path}: {str(e)}", exc_info=True)
     return None     
 
 
+def GetEarliestDateCreatedFromBytes(data, filename, f=None, file_size=None):
+    """Same as GetEarliestDateCreatedFromExif, but reads the leading bytes of the file from memory.
+    
+    Used for data that is not on disk, such as ZIP entries.
+    
+    Args:
+        data: Leading bytes of the file (EXIF_HEAD_SIZE is enough for all supported formats
+            except ISO-BMFF movies, whose metadata may follow the media data)
+        filename: Name of the file, used to pick the parser
+        f: Open, seekable binary stream over the whole file, for structures that lie past
+            data; None when only data is available
+        file_size: Size of the whole file; defaults to len(data)
+        
+    Returns:
+        Unix timestamp as float of the earliest valid date found, or None if no valid dates found
+    """
+    if filename.lower().endswith(TIFF_BASED_EXIF_EXTENSIONS):
+        return GetTiffBasedExifPhotoTakenTimeFromBytes(data)
+
+    if SniffImageFormat(data) == 'isobmff':
+        return GetIsoBmffPhotoTakenTime(_PrefixReader(data, f), file_size if file_size is not None else len(data))
+
+    try:
+        parsed, timestamp = GetHeaderExifPhotoTakenTime(data, f)
+        if parsed:
+            return timestamp
+    except Exception as e:
+        LOG('DEBUG', f"Header EXIF parser failed for {filename}, using Pillow: {str(e)}")
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return _GetEarliestDateFromPillowImage(image)
+    except Exception as e:
+        LOG('DEBUG', f"No EXIF data in {filename}: {str(e)}")
+    return None
+
+
+def _GetEarliestDateFromPillowImage(image):
+    """Return the earliest valid date/time EXIF tag of an opened Pillow image, or None."""
+    exifdata = image._getexif()
+    
+    if not exifdata:
+        return None
+    
+    # Only check known date/time EXIF tags
+    date_tags = [
+        (306, 'DateTime'),
+        (36867, 'DateTimeOriginal'),
+        (36868, 'DateTimeDigitized')
+    ]
+    
+    # Collect all valid timestamps from date/time tags
+    valid_timestamps = []
+    
+    for tag_id, tag_name in date_tags:
+        if tag_id in exifdata:
+            value = exifdata[tag_id]
+            # Check if value is a string that looks like an EXIF date/time
+            if isinstance(value, str):
+                try:
+                    # Try to parse it as an EXIF date
+                    timestamp = ParseExifDateString(value)
+                    if timestamp is not None:
+                        valid_timestamps.append(timestamp)
+                        # LOG('DEBUG', f"Found valid EXIF date tag {tag_name} ({tag_id}): {value} -> {timestamp}")
+                except Exception:
+                    # Not a valid date string, skip
+                    # LOG('DEBUG', f"Invalid date string in EXIF tag {tag_name} ({tag_id}): {value}")
+                    pass
+    
+    # Return the earliest (minimum) timestamp found
+    if valid_timestamps:
+        earliest = min(valid_timestamps)
+        # LOG('DEBUG', f"Earliest EXIF timestamp found: {earliest}")
+        return earliest
+    return None
+
+
+EXIF_DATE_PATTERN = re.compile(r'\d{4}:\d{2}:\d{2} \d{2}:\d{2}:\d{2}$')
+
+
 def ParseExifDateString(exif_date_string):
     """Parse EXIF date string to Unix timestamp.
     
@@ -247,8 +441,15 @@ def ParseExifDateString(exif_date_string):
     Returns:
         Unix timestamp as float, or None if parsing fails
     """
+    # Fast path for the canonical 19-character form; datetime() rejects out-of-range fields like strptime
+    if len(exif_date_string) == 19 and EXIF_DATE_PATTERN.match(exif_date_string):
+        try:
+            s = exif_date_string
+            dt = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+            return time.mktime(dt.timetuple())
+        except ValueError:
+            return None
     try:
-        from datetime import datetime
         # EXIF format uses colons in date: "YYYY:MM:DD HH:MM:SS"
         date_part, time_part = exif_date_string.split(' ', 1)
         date_part = date_part.replace(':', '-')  # Convert to "YYYY-MM-DD"
@@ -286,64 +487,91 @@ def GetTiffBasedExifPhotoTakenTime(file_path):
     Returns:
         Unix timestamp as float, or None if not found or on error
     """
-    date_tag_ids = [EXIF_TAG_DATETIME_ORIGINAL, EXIF_TAG_DATETIME_DIGITIZED, EXIF_TAG_DATETIME]
-    
     try:
         with open(file_path, 'rb') as f:
-            data = f.read(1024 * 1024)  # Read first 1MB; EXIF is near start
-        
-        if len(data) < 8:
-            return None
-        
-        # TIFF header: byte order (2), magic 42 (2), offset to first IFD (4)
-        if data[0:2] == b'II':
-            little_endian = True
-        elif data[0:2] == b'MM':
-            little_endian = False
-        else:
-            return None
-        
-        if little_endian:
-            def read16(offset):
-                return data[offset] | (data[offset + 1] << 8)
-            def read32(offset):
-                return (data[offset] | (data[offset + 1] << 8) |
-                        (data[offset + 2] << 16) | (data[offset + 3] << 24))
-        else:
-            def read16(offset):
-                return (data[offset] << 8) | data[offset + 1]
-            def read32(offset):
-                return ((data[offset] << 24) | (data[offset + 1] << 16) |
-                        (data[offset + 2] << 8) | data[offset + 3])
-        
-        if read16(2) != 42:
-            return None
-        
-        ifd0_offset = read32(4)
-        if ifd0_offset >= len(data):
-            return None
-        
-        # Get EXIF IFD offset from IFD0 (tag 34665)
-        exif_ifd_offset = _ReadIfdForTag(data, ifd0_offset, EXIF_IFD_POINTER_TAG, read16, read32, little_endian)
-        if exif_ifd_offset is None:
-            return None
+            data = f.read(EXIF_HEAD_SIZE)  # Read first 1MB; EXIF is near start
+        return GetTiffBasedExifPhotoTakenTimeFromBytes(data)
+    except Exception as e:
+        LOG('DEBUG', f"Error reading TIFF-based EXIF from {file_path}: {str(e)}")
+        return None
+
+
+def GetTiffBasedExifPhotoTakenTimeFromBytes(data):
+    """Parse the leading bytes of a TIFF-based file and return the time the photo was taken.
+    
+    Args:
+        data: Leading bytes of the file (the EXIF IFD must lie within them)
         
+    Returns:
+        Unix timestamp as float, or None if not found or on error
+    """
+    try:
+        return _GetEarliestDateFromTiff(data)
+    except Exception as e:
+        LOG('DEBUG', f"Error parsing TIFF-based EXIF: {str(e)}")
+        return None
+
+
+def _GetEarliestDateFromTiff(data, include_ifd0_datetime=False):
+    """Return the earliest date/time tag of a TIFF structure (a TIFF file or an EXIF block), or None.
+    
+    Args:
+        data: Bytes starting at the TIFF header; offsets in the IFDs are relative to it
+        include_ifd0_datetime: Also use DateTime (306) from IFD0, as Pillow's _getexif does
+    """
+    if len(data) < 8:
+        return None
+    
+    # TIFF header: byte order (2), magic 42 (2), offset to first IFD (4)
+    if data[0:2] == b'II':
+        little_endian = True
+    elif data[0:2] == b'MM':
+        little_endian = False
+    else:
+        return None
+    
+    if little_endian:
+        def read16(offset):
+            return data[offset] | (data[offset + 1] << 8)
+        def read32(offset):
+            return (data[offset] | (data[offset + 1] << 8) |
+                    (data[offset + 2] << 16) | (data[offset + 3] << 24))
+    else:
+        def read16(offset):
+            return (data[offset] << 8) | data[offset + 1]
+        def read32(offset):
+            return ((data[offset] << 24) | (data[offset + 1] << 16) |
+                    (data[offset + 2] << 8) | data[offset + 3])
+    
+    if read16(2) != 42:
+        return None
+    
+    ifd0_offset = read32(4)
+    if ifd0_offset >= len(data):
+        return None
+    
+    valid_timestamps = []
+    if include_ifd0_datetime:
+        value = _ReadAsciiTagFromIfd(data, ifd0_offset, EXIF_TAG_DATETIME, read16, read32, little_endian)
+        if value:
+            ts = ParseExifDateString(value)
+            if ts is not None:
+                valid_timestamps.append(ts)
+    
+    # Get EXIF IFD offset from IFD0 (tag 34665)
+    exif_ifd_offset = _ReadIfdForTag(data, ifd0_offset, EXIF_IFD_POINTER_TAG, read16, read32, little_endian)
+    if exif_ifd_offset is not None:
         # Read date/time tags from EXIF IFD (values may be inline or at offset)
-        valid_timestamps = []
-        for tag_id in date_tag_ids:
+        for tag_id in (EXIF_TAG_DATETIME_ORIGINAL, EXIF_TAG_DATETIME_DIGITIZED, EXIF_TAG_DATETIME):
             value = _ReadAsciiTagFromIfd(data, exif_ifd_offset, tag_id, read16, read32, little_endian)
             if value:
                 ts = ParseExifDateString(value)
                 if ts is not None:
                     valid_timestamps.append(ts)
-        
-        if valid_timestamps:
-            return min(valid_timestamps)
-        return None
-        
-    except Exception as e:
-        LOG('DEBUG', f"Error reading TIFF-based EXIF from {file_path}: {str(e)}")
-        return None
+    
+    if valid_timestamps:
+        return min(valid_timestamps)
+    return None
 
 
 def _ReadIfdForTag(data, ifd_offset, tag_id, read16, read32, little_endian):
@@ -384,14 +612,14 @@ def _ReadAsciiTagFromIfd(data, ifd_offset, tag_id, read16, read32, little_endian
             # Value stored in the 4-byte value field
             start = entry_offset + 8
             end = min(start + entry_count, len(data))
-            raw = data[start:end]
+            raw = bytes(data[start:end])
         else:
             # Value at offset
             start = entry_value_or_offset
             end = min(start + entry_count, len(data))
             if start >= len(data):
                 return None
-            raw = data[start:end]
+            raw = bytes(data[start:end])
         
         try:
             s = raw.decode('ascii', errors='ignore').strip('\x00').strip()
@@ -402,18 +630,380 @@ def _ReadAsciiTagFromIfd(data, ifd_offset, tag_id, read16, read32, little_endian
     return None
 
 
+# Header-only EXIF reading (JPEG, PNG, WebP) - find the EXIF block and parse it with the TIFF reader above
+# Bytes read up front; covers the EXIF segment of nearly every JPEG and the header chunks of PNG/WebP
+EXIF_PREFIX_SIZE = 128 * 1024
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_MARKER_SOS = 0xDA  # start of scan: image data follows, no more metadata segments
+JPEG_MARKER_EOI = 0xD9
+JPEG_MARKER_APP1 = 0xE1
+JPEG_EXIF_HEADER = b'Exif\x00\x00'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+WEBP_VP8X_EXIF_FLAG = 0x08
+
+
+class _HeaderTruncated(Exception):
+    """A structure extends past the bytes available to the header parser."""
+
+
+def GetHeaderExifPhotoTakenTime(prefix, f=None):
+    """Read the EXIF date of a JPEG, PNG or WebP file without decoding the image.
+    
+    Walks the JPEG APP1 segments, the PNG chunks before IDAT or the WebP RIFF chunks to find
+    the EXIF block, then reads it with the TIFF parser used for RAW files. Applies the same
+    tags as Pillow's _getexif: DateTime from IFD0 and DateTimeOriginal, DateTimeDigitized
+    and DateTime from the EXIF IFD.
+    
+    Args:
+        prefix: Leading bytes of the file (EXIF_PREFIX_SIZE from a file, or a ZIP entry head);
+            bytes or a memoryview
+        f: Open binary file the prefix was read from, for structures that lie past the prefix;
+            None when only the prefix is available
+        
+    Returns:
+        tuple[bool, float]: (parsed, timestamp) - parsed is False when the format is not one
+            of these or the file could not be parsed, so the caller should try Pillow;
+            timestamp is None when the file has no EXIF date
+    """
+    def read_at(offset, size):
+        end = offset + size
+        if end <= len(prefix):
+            return prefix[offset:end]
+        if f is None:
+            raise _HeaderTruncated()
+        f.seek(offset)
+        data = f.read(size)
+        if len(data) < size:
+            raise _HeaderTruncated()
+        return data
+    
+    try:
+        if prefix[0:2] == JPEG_SOI:
+            tiff = _FindJpegExif(read_at)
+        elif prefix[0:8] == PNG_SIGNATURE:
+            tiff = _FindPngExif(read_at)
+        elif prefix[0:4] == b'RIFF' and prefix[8:12] == b'WEBP':
+            tiff = _FindWebpExif(read_at)
+        else:
+            return False, None
+    except _HeaderTruncated:
+        return False, None
+    if tiff is None:
+        return True, None
+    return True, _GetEarliestDateFromTiff(tiff, include_ifd0_datetime=True)
+
+
+def _FindJpegExif(read_at):
+    """Return the TIFF block of a JPEG's EXIF APP1 segment, or None if there is none."""
+    offset = 2
+    while True:
+        marker = read_at(offset, 2)
+        if marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+        marker_type = marker[1]
+        if marker_type in (JPEG_MARKER_SOS, JPEG_MARKER_EOI):
+            return None
+        if 0xD0 <= marker_type <= 0xD7 or marker_type == 0x01:
+            # Standalone markers without a length
+            offset += 2
+            continue
+        length = int.from_bytes(read_at(offset + 2, 2), 'big')
+        if marker_type == JPEG_MARKER_APP1 and length >= 8 and read_at(offset + 4, 6) == JPEG_EXIF_HEADER:
+            return read_at(offset + 10, length - 8)
+        offset += 2 + length
+
+
+def _FindPngExif(read_at):
+    """Return the contents of a PNG's eXIf chunk, or None if there is none before the image data."""
+    offset = len(PNG_SIGNATURE)
+    while True:
+        header = read_at(offset, 8)
+        length = int.from_bytes(header[0:4], 'big')
+        chunk_type = header[4:8]
+        if chunk_type == b'eXIf':
+            return read_at(offset + 8, length)
+        if chunk_type in (b'IDAT', b'IEND'):
+            return None
+        # length, type, data, CRC
+        offset += 12 + length
+
+
+def _FindWebpExif(read_at):
+    """Return the contents of a WebP's EXIF chunk, or None if there is none."""
+    riff_end = 8 + int.from_bytes(read_at(4, 4), 'little')
+    offset = 12
+    while offset + 8 <= riff_end:
+        header = read_at(offset, 8)
+        chunk_type = header[0:4]
+        length = int.from_bytes(header[4:8], 'little')
+        if chunk_type == b'VP8X':
+            # Extended format header says whether an EXIF chunk follows at all
+            if not read_at(offset + 8, 1)[0] & WEBP_VP8X_EXIF_FLAG:
+                return None
+        elif chunk_type in (b'VP8 ', b'VP8L') and offset == 12:
+            # Simple format: a single image chunk, no metadata
+            return None
+        elif chunk_type == b'EXIF':
+            data = read_at(offset + 8, length)
+            # Some writers keep the JPEG APP1 prefix
+            return data[6:] if data[0:6] == JPEG_EXIF_HEADER else data
+        # Chunks are padded to an even size
+        offset += 8 + length + (length & 1)
+    return None
+
+
+class _PrefixReader:
+    """read_at(offset, size) for IsoBmff: serves the leading bytes from memory and the rest from the file.
+    
+    Returns fewer bytes than asked at the end of the data, or past the prefix when there is no file.
+    """
+    
+    def __init__(self, prefix, f=None, filepath=None):
+        self.prefix = prefix
+        self.f = f
+        self.filepath = filepath
+        self._opened = False
+    
+    def __call__(self, offset, size):
+        end = offset + size
+        if end <= len(self.prefix):
+            return self.prefix[offset:end]
+        if self.f is None and self.filepath is not None:
+            self.f = open(self.filepath, 'rb')
+            self._opened = True
+        if self.f is None:
+            return self.prefix[offset:end]
+        self.f.seek(offset)
+        return self.f.read(size)
+    
+    def Close(self):
+        if self._opened:
+            self.f.close()
+            self.f = None
+            self._opened = False
+
+
+def GetIsoBmffPhotoTakenTime(read_at, file_size):
+    """Return the capture time of a HEIC/HEIF image or MOV/MP4 movie, or None.
+    
+    HEIF images use the date tags of their Exif item, like JPEG; movies use their
+    QuickTime metadata or movie header (see IsoBmff.FindMovieCreationTime).
+    
+    Args:
+        read_at: Function (offset, size) -> bytes over the file's data
+        file_size: Size of the file (or of the data read_at can return)
+    """
+    tiff = IsoBmff.FindHeifExif(read_at, file_size)
+    if tiff is not None:
+        timestamp = _GetEarliestDateFromTiff(tiff, include_ifd0_datetime=True)
+        if timestamp is not None:
+            return timestamp
+    return IsoBmff.FindMovieCreationTime(read_at, file_size)
+
+
+# Format sniffing by magic bytes (first bytes of the file)
+# Boxes an ISO-BMFF file can start with ('ftyp' for MP4/HEIF, the others for older QuickTime movies)
+ISOBMFF_FIRST_BOXES = (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+
+def SniffImageFormat(head):
+    """Return the container format of a file from its leading bytes.
+    
+    Returns:
+        str: 'jpeg', 'png', 'webp', 'tiff' (also CR2/NEF and other TIFF-based RAW), 'gif',
+            'bmp', 'isobmff' (HEIC/HEIF/MOV/MP4), 'zip', or None if unknown
+    """
+    if head[0:2] == JPEG_SOI:
+        return 'jpeg'
+    if head[0:8] == PNG_SIGNATURE:
+        return 'png'
+    if head[0:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[0:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if head[0:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[0:2] == b'BM':
+        return 'bmp'
+    if head[4:8] in ISOBMFF_FIRST_BOXES:
+        return 'isobmff'
+    if head[0:4] == b'PK\x03\x04':
+        return 'zip'
+    return None
+
+
+def _ReadInto(f, view):
+    """Fill view from an unbuffered file until it is full or the file ends; return the filled part."""
+    filled = 0
+    while filled < len(view):
+        count = f.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return view[:filled]
+
+
+# Head and tail buffers reused by the FileProbe objects of each thread
+_probe_buffers = threading.local()
+
+
+class FileProbe:
+    """Answers the quick hash, format and EXIF date of a file from a single read.
+    
+    On first use the file is opened once: the first head_size bytes and, when the hash is
+    needed, the last QUICK_HASH_CHUNK_SIZE bytes are read into per-thread buffers and the
+    file is closed.
+    The quick hash (same value as ComputeQuickFileHash), the format and the EXIF date of
+    JPEG/PNG/WebP/TIFF-based/ISO-BMFF files are all computed from those buffers. The file is opened
+    again only when the EXIF data lies beyond the head.
+    
+    The buffers are shared by the probes of a thread, so a thread must finish with one
+    probe before it creates the next.
+    """
+    
+    def __init__(self, filepath, file_size, head_size=QUICK_HASH_CHUNK_SIZE):
+        """
+        Args:
+            filepath: Path to the file
+            file_size: Size of the file from the caller's stat
+            head_size: Bytes to read from the start (EXIF_PREFIX_SIZE when the EXIF date is needed)
+        """
+        self.filepath = filepath
+        self.file_size = file_size
+        self.head_size = max(head_size, QUICK_HASH_CHUNK_SIZE)
+        self._head = None
+        self._tail = None
+    
+    def _Buffers(self):
+        buffers = getattr(_probe_buffers, 'buffers', None)
+        if buffers is None or len(buffers[0]) < self.head_size:
+            # Files up to 2 chunks are hashed whole, so the head buffer holds at least that much
+            buffers = (bytearray(max(self.head_size, QUICK_HASH_CHUNK_SIZE * 2)), bytearray(QUICK_HASH_CHUNK_SIZE))
+            _probe_buffers.buffers = buffers
+        return buffers
+    
+    def _Load(self, with_tail=True):
+        whole_file = self.file_size <= QUICK_HASH_CHUNK_SIZE * 2
+        if self._head is not None and (self._tail is not None or whole_file or not with_tail):
+            return
+        head_buffer, tail_buffer = self._Buffers()
+        with open(self.filepath, 'rb', buffering=0) as f:
+            if self._head is None:
+                head_length = self.file_size if whole_file else min(self.file_size, self.head_size)
+                self._head = _ReadInto(f, memoryview(head_buffer)[:head_length])
+            if with_tail and not whole_file:
+                f.seek(-QUICK_HASH_CHUNK_SIZE, 2)  # 2 = SEEK_END
+                self._tail = _ReadInto(f, memoryview(tail_buffer))
+    
+    def QuickHash(self):
+        """Return the ComputeQuickFileHash value of the file, or None on error."""
+        try:
+            self._Load()
+            whole_file = self._tail is None
+            hasher = xxhash.xxh64()
+            hasher.update(f"quickhash:size={self.file_size}:".encode('utf-8'))
+            if whole_file:
+                hasher.update(self._head)
+            else:
+                hasher.update(self._head[:QUICK_HASH_CHUNK_SIZE])
+                hasher.update(self._tail)
+            return hasher.hexdigest()
+        except Exception as e:
+            LOG('ERROR', f"Error computing quick hash for {self.filepath}: {str(e)}", exc_info=True)
+            return None
+    
+    def Format(self):
+        """Return the SniffImageFormat result for the file, or None if it cannot be read."""
+        try:
+            self._Load(with_tail=False)
+        except OSError:
+            return None
+        return SniffImageFormat(self._head)
+    
+    def ExifTimestamp(self):
+        """Return the EXIF date of the file as (parsed, timestamp).
+        
+        parsed is False for formats only Pillow can read (see GetEarliestDateCreatedWithPillow).
+        """
+        try:
+            self._Load(with_tail=False)
+            image_format = SniffImageFormat(self._head)
+            if image_format == 'tiff':
+                timestamp = GetTiffBasedExifPhotoTakenTimeFromBytes(self._head)
+                if timestamp is None and len(self._head) < min(self.file_size, EXIF_HEAD_SIZE):
+                    # The EXIF IFD may lie beyond the head: read as much as GetTiffBasedExifPhotoTakenTime does
+                    timestamp = GetTiffBasedExifPhotoTakenTime(self.filepath)
+                return True, timestamp
+            if image_format == 'isobmff':
+                read_at = _PrefixReader(self._head, filepath=self.filepath)
+                try:
+                    return True, GetIsoBmffPhotoTakenTime(read_at, self.file_size)
+                finally:
+                    read_at.Close()
+            if image_format in ('jpeg', 'png', 'webp'):
+                parsed, timestamp = GetHeaderExifPhotoTakenTime(self._head)
+                if not parsed and len(self._head) < self.file_size:
+                    # Structure continues beyond the head: follow it in the file
+                    with open(self.filepath, 'rb') as f:
+                        parsed, timestamp = GetHeaderExifPhotoTakenTime(self._head, f)
+                return parsed, timestamp
+        except Exception as e:
+            LOG('DEBUG', f"Header EXIF parser failed for {self.filepath}, using Pillow: {str(e)}")
+        return False, None
+    
+    def Quality(self, filename):
+        """Return the QualityScore.ScoreImage value of the file, or None.
+        
+        Reads the headers from the head buffer, and from the file only when they lie beyond it
+        (e.g. a JPEG frame header after a large EXIF thumbnail).
+        """
+        try:
+            self._Load(with_tail=False)
+            read_at = _PrefixReader(self._head, filepath=self.filepath)
+            try:
+                return ScoreImage(read_at, self.file_size, SniffImageFormat(self._head), filename)
+            finally:
+                read_at.Close()
+        except OSError as e:
+            LOG('DEBUG', f"Cannot read the headers of {self.filepath} for a quality score: {str(e)}")
+            return None
+
+
+def ScoreFile(filepath):
+    """Return the QualityScore.ScoreImage value of a file (e.g. a photo already in the output), or None."""
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(EXIF_PREFIX_SIZE)
+            return ScoreImage(_PrefixReader(head, f), os.fstat(f.fileno()).st_size, SniffImageFormat(head),
+                              os.path.basename(filepath))
+    except OSError:
+        return None
+
+
 #copy image to new folder. retain timestamps and basename
-def CopyImage(filename, destinationpath, new_filename=None):
+def CopyImage(filename, destinationpath, new_filename=None, expected_hash=None, in_stat=None, full_hash=None):
     """Copy image file to destination path.
     
+    Uses settings.gCopyEngine when set (see CopyEngine.py), shutil.copy2 otherwise.
+    
     Args:
         filename: Source file path
         destinationpath: Destination directory path
         new_filename: Optional new filename to use (defaults to source basename)
+        expected_hash: Quick hash of the source, checked by the copy engine's verify mode
+        in_stat: os.stat_result of the source if the caller already has it
+        full_hash: LazyFullHash of the source for the verify mode (see VerifiedCopyFullHash)
     """
     if new_filename is None:
         new_filename = os.path.basename(filename)
     destname = os.path.join(destinationpath, new_filename)
+    if settings.gCopyEngine is not None:
+        return settings.gCopyEngine.CopyFile(filename, destname, expected_hash, in_stat, full_hash)
     try:
         shutil.copy2(filename, destname)
     except Exception as e:
@@ -421,25 +1011,26 @@ def CopyImage(filename, destinationpath, new_filename=None):
         return False
     return True
 
+def GetClassifier():
+    """Return settings.gClassifier, building it from the settings lists on first use (see Classifier.py)."""
+    if settings.gClassifier is None:
+        import Classifier
+        settings.gClassifier = Classifier.Classifier()
+    return settings.gClassifier
+
+
 def IsImageFile(filename):
-    lowered_filename = filename.lower()
-    for image_ext in settings.gImageExtensions:
-        if lowered_filename.endswith(image_ext):
-            return True
-    return False
+    return GetClassifier().IsImage(filename)
 
 #is this a zipfile    
 def IsZipFile(filename):
-    return filename.lower().endswith('zip')
+    return GetClassifier().IsArchive(filename)
 
 
 
 #see if we actually want to parse this folder, iphoto libraries have all kind of junk
 def IsValidSubDirectory(filename):
-    for ignorefolder in settings.gIgnoreFolders:
-        if ignorefolder in filename:
-            return False
-    return True
+    return not GetClassifier().IsExcludedDirectory(filename)
 
 
 
@@ -457,109 +1048,639 @@ def OrganizePath(path, timestamp_float):
     return newpath
 
 
-def AddPhoto(in_fullpath, in_filename, in_timestamp_float):
-    """Add a photo to the library.
+def IsFaceCrop(in_filename):
+    """Check whether a file is a face crop exported by iPhoto/Photos (regex only, no I/O)."""
+    if re.search(r'_face\d+', in_filename, re.IGNORECASE):
+        LOG('DEBUG', f"Skipping face crop image: {in_filename}")
+        return True
+    return False
+
+
+def SourceExists(in_source_path):
+    """os.path.exists that also understands the virtual source paths of ZIP entries.
+    
+    Streamed ZIP entries are recorded as <zip path>/<entry name>; such a path exists when
+    the ZIP file containing it exists.
+    """
+    return os.path.exists(in_source_path) or ContainingZip(in_source_path) is not None
+
+
+def ContainingZip(in_source_path):
+    """Return the ZIP file holding the virtual source path of a streamed ZIP entry, or None."""
+    parent = os.path.dirname(in_source_path)
+    while parent and parent != os.path.dirname(parent):
+        if os.path.isfile(parent):
+            return parent if IsZipFile(parent) else None
+        if os.path.isdir(parent):
+            return None
+        parent = os.path.dirname(parent)
+    return None
+
+
+def StatFingerprint(in_stat):
+    """Return the (st_dev, st_ino, size, mtime_ns) tuple that identifies an unchanged file."""
+    return (in_stat.st_dev, in_stat.st_ino, in_stat.st_size, in_stat.st_mtime_ns)
+
+
+class LazyFullHash:
+    """Full-content hash of a source file, computed the first time a quick hash match needs it.
+    
+    Work items carry one as item['full_hash'], so the check in the hash worker and the
+    re-check in the pipeline writer compute it at most once.
+    """
+    
+    def __init__(self, compute, value=None):
+        """
+        Args:
+            compute: Callable returning the full hash (or None if the file cannot be read)
+            value: The full hash, if it is already known (e.g. hashed while streaming)
+        """
+        self._compute = compute
+        self.value = value
+        self.collisions = set()
+    
+    def Get(self):
+        if self.value is None and self._compute is not None:
+            self.value = self._compute()
+            self._compute = None
+        return self.value
+
+
+def FullHashOfSource(in_source_path, in_file_hash, in_stat=None):
+    """Return the full-content hash of a source file or ZIP entry, memoized in the database.
+    
+    The hash is stored with the size and mtime of the file (see DataBase.SetFullHash), so
+    every file is read in full at most once for as long as it does not change.
+    
+    Args:
+        in_source_path: Full source path, or virtual source path of a streamed ZIP entry
+        in_file_hash: Quick hash the file is expected to have. Without in_stat the file is
+            checked against it first, so a source that changed since it was imported is not
+            taken for the photo it once held.
+        in_stat: os.stat_result of the file, when the caller just computed its quick hash
+        
+    Returns:
+        str: ComputeFileHash value, or None if the file is gone, changed or unreadable
+    """
+    zip_path = None
+    try:
+        file_stat = in_stat if in_stat is not None else os.stat(in_source_path)
+    except OSError:
+        # No such file: a ZIP entry recorded under its virtual path, memoized by the archive's stat
+        zip_path = ContainingZip(in_source_path)
+        if zip_path is None:
+            return None
+        try:
+            file_stat = os.stat(zip_path)
+        except OSError:
+            return None
+
+    full_hash = settings.gDatabase.GetFullHash(in_source_path, file_stat.st_size, file_stat.st_mtime_ns)
+    if full_hash is not None:
+        return full_hash
+    metrics = GetMetrics()
+    if zip_path is not None:
+        from ZipCrawl import ComputeZipEntryHashes
+        with metrics.Time('full_hash'):
+            hashes = ComputeZipEntryHashes(zip_path, in_source_path)
+        if hashes is None or hashes[0] != in_file_hash:
+            return None
+        full_hash = hashes[1]
+    else:
+        if in_stat is None and ComputeQuickFileHash(in_source_path, file_size=file_stat.st_size) != in_file_hash:
+            return None
+        with metrics.Time('full_hash'):
+            full_hash = ComputeFileHash(in_source_path)
+        if full_hash is None:
+            return None
+        metrics.AddBytes('full_hash', file_stat.st_size)
+    CountStat('full_hashes')
+    settings.gDatabase.SetFullHash(in_source_path, file_stat.st_size, file_stat.st_mtime_ns, in_file_hash, full_hash)
+    return full_hash
+
+
+def _FullHashStat(in_source_path, in_stat=None):
+    """Return the stat a full hash of a source is memoized with: its own, or its ZIP file's."""
+    if in_stat is not None:
+        return in_stat
+    zip_path = ContainingZip(in_source_path)
+    try:
+        return os.stat(zip_path) if zip_path is not None else None
+    except OSError:
+        return None
+
+
+def VerifiedCopyFullHash(in_source_path, in_stat=None, in_full_hash=None):
+    """Return the full hash a verified copy (see CopyEngine) checks a source against.
+    
+    That is the source's own LazyFullHash when its value is known, else the hash memoized
+    by FullHashOfSource. Without either, the copy fills in the hash of the data it streamed,
+    which MemoizeCopyFullHash then stores. The source is never read just for this.
+    
+    Args:
+        in_source_path: Full source path, or virtual source path of a streamed ZIP entry
+        in_stat: os.stat_result of the source file (None for ZIP entries)
+        in_full_hash: The work item's LazyFullHash, if it has one
+    
+    Returns:
+        LazyFullHash, or None when copies are not verified
+    """
+    if settings.gCopyEngine is None or not settings.gCopyEngine.verify:
+        return None
+    if in_full_hash is not None and in_full_hash.value is not None:
+        return in_full_hash
+    file_stat = _FullHashStat(in_source_path, in_stat)
+    value = None
+    if file_stat is not None:
+        value = settings.gDatabase.GetFullHash(in_source_path, file_stat.st_size, file_stat.st_mtime_ns)
+    if in_full_hash is not None:
+        in_full_hash.value = value
+        return in_full_hash
+    return LazyFullHash(None, value)
+
+
+def MemoizeCopyFullHash(in_source_path, in_file_hash, in_full_hash, in_known, in_stat=None):
+    """Store the full hash a verified copy streamed (see VerifiedCopyFullHash).
+    
+    Args:
+        in_known: Whether the hash was known before the copy (it is then not stored again)
+    """
+    if in_full_hash is None or in_known or in_full_hash.value is None:
+        return
+    file_stat = _FullHashStat(in_source_path, in_stat)
+    if file_stat is not None:
+        settings.gDatabase.SetFullHash(in_source_path, file_stat.st_size, file_stat.st_mtime_ns, in_file_hash,
+                                       in_full_hash.value)
+
+
+def _IsSameContent(in_fullpath, in_full_hash, photo_attributes):
+    """Confirm a quick hash match by the full-content hashes of both files.
+    
+    When either file cannot be hashed in full the quick hash decides, as without
+    settings.gVerifyDuplicates.
+    """
+    photo_full_hash = FullHashOfSource(photo_attributes['filename'], photo_attributes['hash'])
+    if photo_full_hash is None:
+        LOG('DEBUG', f"Cannot verify {in_fullpath} against {photo_attributes['filename']} by full hash, using the quick hash")
+        return True
+    full_hash = in_full_hash.Get() if in_full_hash is not None else None
+    if full_hash is None or full_hash == photo_full_hash:
+        return True
+    # Logged once per file: the pipeline writer checks every file a second time
+    if photo_attributes['filename'] not in in_full_hash.collisions:
+        in_full_hash.collisions.add(photo_attributes['filename'])
+        CountStat('quick_hash_collisions')
+        LOG('WARNING', f"{in_fullpath} has the quick hash of {photo_attributes['filename']} but different content")
+    return False
+
+
+def IsKnownDuplicate(in_fullpath, in_file_hash, in_full_hash=None):
+    """Check whether content with the given hash is already in the database.
+    
+    With settings.gVerifyDuplicates a quick hash match only counts once the full-content
+    hashes of both files agree (see FullHashOfSource). Files with a unique quick hash, nearly
+    all of them, are never read in full.
+    
+    Args:
+        in_fullpath: Full path to the source image file (used for logging)
+        in_file_hash: Quick hash of the source file
+        in_full_hash: LazyFullHash of the source file; needed with settings.gVerifyDuplicates
+        
+    Returns:
+        tuple[bool, dict|None]: (is_duplicate, photo_attributes). photo_attributes is the
+            matching database row, which is returned even when its file no longer exists
+    """
+    photo_attributes = settings.gDatabase.GetPhotoAttributesByHash(in_file_hash)
+
+    if photo_attributes is not None:
+        candidates = settings.gDatabase.FindPhotosByHash(in_file_hash) if settings.gVerifyDuplicates else [photo_attributes]
+        for candidate in candidates:
+            # Photo with same hash exists - check if destination file exists
+            if not SourceExists(candidate['filename']):
+                continue
+            if settings.gVerifyDuplicates and not _IsSameContent(in_fullpath, in_full_hash, candidate):
+                continue
+            CountStat('skipped_database')
+            LOG('WARNING', f"Skipping {in_fullpath} (duplicate content already in database)")
+            return True, candidate
+    return False, photo_attributes
+
+
+def CheckPhoto(in_fullpath, in_filename, in_timestamp_float, in_exif_executor=None, in_stat=None):
+    """Run the checks of AddPhoto that only depend on the file itself.
+    
+    Covers the face crop filter, the stat fingerprint and source path lookups, the quick hash,
+    the hash lookup and the EXIF read. These steps are safe to run on several files at once,
+    which is what the ingest pipeline does with them.
     
     Args:
         in_fullpath: Full path to the source image file
-        infilename: Filename to use when copying (may be original filename from database)
+        in_filename: Filename to use when copying (may be original filename from database)
         in_timestamp_float: Timestamp to use for organization
+        in_exif_executor: Optional concurrent.futures executor used to read EXIF data
+        in_stat: os.stat_result of the file if the caller already has one (e.g. DirEntry.stat())
         
-    Performance optimization: This function orders operations from cheapest to most expensive:
-    1. Regex check for face crops (no I/O)
-    2. Quick database lookup by source path (fast indexed query)
-    3. File hash computation (only if needed - reads entire file)
-    4. EXIF reading (only if file will be processed)
+    Returns:
+        dict: Work item with the file hash and organization timestamp, or None if the file is skipped
     """
-    # LOG('DEBUG', f"AddPhoto: {fullpath} (new filename: {new_filename})")
-
     # === CHEAP CHECK 1: Skip face crop images (regex only, no I/O) ===
-    if re.search(r'_face\d+', in_filename, re.IGNORECASE):
-        LOG('DEBUG', f"Skipping face crop image: {in_filename}")
-        return
+    if IsFaceCrop(in_filename):
+        return None
+
+    try:
+        file_stat = in_stat if in_stat is not None else os.stat(in_fullpath)
+    except OSError as e:
+        LOG('ERROR', f"Skipping {in_fullpath} (cannot stat file): {str(e)}")
+        MarkIncomplete(in_fullpath)
+        return None
+
+    # === CHEAP CHECK 2: Stat fingerprint and source path lookups (indexed DB queries) ===
+    # These avoid computing the file hash for files already seen at the same source
+    # location (common when re-running crawler). Files extracted to the temp path get
+    # a new path every run, so they are not fingerprinted.
+    fingerprint = StatFingerprint(file_stat)
+    wants_exif = GetClassifier().WantsMetadataDate(in_filename)
+    # One read of the head (and tail) serves both the quick hash and the EXIF date
+    probe = FileProbe(in_fullpath, file_stat.st_size, EXIF_PREFIX_SIZE if wants_exif else QUICK_HASH_CHUNK_SIZE)
+    track_fingerprint = not in_fullpath.startswith(settings.gTempPath)
+    metrics = GetMetrics()
+    with metrics.Time('db_lookup'):
+        known_fingerprint = settings.gDatabase.GetFingerprint(in_fullpath) if track_fingerprint else None
+        file_hash = None
 
-    # === CHEAP CHECK 2: Quick lookup by source path (indexed DB query) ===
-    # This avoids computing the expensive file hash for files already processed
-    # from the same source location (common when re-running crawler)
-    existing_by_path = settings.gDatabase.FindPhotoBySourcePath(in_fullpath)
-    if existing_by_path is not None:
-        # File was already imported from this exact source path
-        # Check if the destination file still exists
-        if os.path.exists(existing_by_path['filename']):
-            settings.gSkippedDatabaseCount += 1
+        if known_fingerprint is not None:
+            if (known_fingerprint['dev'], known_fingerprint['ino'], known_fingerprint['size'], known_fingerprint['mtime_ns']) == fingerprint:
+                # Unchanged since the last run: never hash it again
+                if settings.gDatabase.HasSourcePath(in_fullpath):
+                    CountStat('skipped_database')
+                    LOG('DEBUG', f"Skipping {in_fullpath} (unchanged since it was imported)")
+                    return None
+                file_hash = known_fingerprint['hash']
+            else:
+                # Touched or replaced since the last run: hash it and check it again
+                LOG('DEBUG', f"Re-checking {in_fullpath} (changed since last run)")
+        elif settings.gDatabase.HasSourcePath(in_fullpath):
+            # File was already imported from this exact source path, before fingerprints were recorded
+            if track_fingerprint:
+                settings.gDatabase.SetFingerprint(in_fullpath, fingerprint, None)
+            CountStat('skipped_database')
             LOG('DEBUG', f"Skipping {in_fullpath} (already imported from same source)")
-            return
+            return None
+        elif track_fingerprint and file_stat.st_ino:
+            # Same unchanged file seen under another path (renamed mount point, moved folder)
+            same_file = settings.gDatabase.FindFingerprintByInode(fingerprint)
+            if same_file is not None:
+                file_hash = same_file['hash']
+                settings.gDatabase.SetFingerprint(in_fullpath, fingerprint, file_hash)
 
     # === FAST OPERATION: Compute quick file hash for duplicate detection ===
     # Uses partial hashing (first+last 64KB + size) instead of reading entire file
     # This reduces I/O by ~400x for large RAW files while maintaining excellent accuracy
-    file_hash = ComputeQuickFileHash(in_fullpath)
     if file_hash is None:
-        LOG('ERROR', f"Skipping {in_fullpath} (failed to compute hash)")
-        return
+        with metrics.Time('hash'):
+            file_hash = probe.QuickHash()
+        if file_hash is None:
+            LOG('ERROR', f"Skipping {in_fullpath} (failed to compute hash)")
+            MarkIncomplete(in_fullpath)
+            return None
+        if track_fingerprint:
+            settings.gDatabase.SetFingerprint(in_fullpath, fingerprint, file_hash)
 
     # === Check if photo with same content exists (different source path, same file) ===
-    photo_attributes = settings.gDatabase.GetPhotoAttributesByHash(file_hash)
-
-    if photo_attributes is not None:
-        # Photo with same hash exists - check if destination file exists
-        if os.path.exists(photo_attributes['filename']):
-            settings.gSkippedDatabaseCount += 1
-            LOG('WARNING', f"Skipping {in_fullpath} (duplicate content already in database)")
-            return
+    full_hash = None
+    if settings.gVerifyDuplicates:
+        full_hash = LazyFullHash(lambda: FullHashOfSource(in_fullpath, file_hash, file_stat))
+    with metrics.Time('db_lookup'):
+        is_duplicate, photo_attributes = IsKnownDuplicate(in_fullpath, file_hash, full_hash)
+    if is_duplicate:
+        return None
 
     # === EXPENSIVE OPERATION: Read EXIF for organization timestamp ===
     # Only performed after confirming file needs to be processed
     organization_timestamp = in_timestamp_float  # Default to file mtime
+    exif_timestamp = None
 
-    file_ext = os.path.splitext(in_filename)[1].lstrip('.').lower()
-    if file_ext in settings.gExifImageExtensions:
-        exif_timestamp = GetEarliestDateCreatedFromExif(in_fullpath)
+    if wants_exif:
+        with metrics.Time('exif'):
+            parsed, exif_timestamp = probe.ExifTimestamp()
+            if not parsed:
+                # Format the binary parsers do not handle: Pillow, optionally in the process pool
+                if in_exif_executor is not None:
+                    exif_timestamp = in_exif_executor.submit(GetEarliestDateCreatedWithPillow, in_fullpath).result()
+                else:
+                    exif_timestamp = GetEarliestDateCreatedWithPillow(in_fullpath)
         if exif_timestamp:
             organization_timestamp = exif_timestamp
             # LOG('DEBUG', f"Using EXIF date for organization: {exif_timestamp}")
 
-    # organize pictures into nicer paths based on date
-    structured_path = OrganizePath(in_fullpath, organization_timestamp)
+    # === CHEAP OPERATION: Header-only quality score, to pick the best version of a photo ===
+    with metrics.Time('quality'):
+        quality = probe.Quality(in_filename)
+
+    # === EXPENSIVE OPERATION: Perceptual hash for near-duplicate detection (opt-in) ===
+    phash = pixels = aspect = None
+    if settings.gNearDuplicateIndex is not None and probe.Format() in PERCEPTUAL_FORMATS:
+        phash, pixels, aspect = PerceptualFields(in_fullpath)
+
+    return dict(fullpath=in_fullpath, filename=in_filename, timestamp=in_timestamp_float,
+                hash=file_hash, full_hash=full_hash, attributes=photo_attributes, stat=file_stat,
+                size=file_stat.st_size, mtime=file_stat.st_mtime,
+                organization_timestamp=organization_timestamp, quality=quality, phash=phash, pixels=pixels,
+                aspect=aspect, taken=exif_timestamp or None)
+
 
-    MakeSurePathExists(structured_path)
+def PerceptualFields(source):
+    """Return the (phash, pixels, aspect) fields of a work item, timed as the 'phash' stage.
+    
+    Args:
+        source: Path or seekable binary file object of an image in PERCEPTUAL_FORMATS
+        
+    Returns:
+        tuple: (dHash, width * height, width / height), or (None, None, None) if the image
+            cannot be decoded
+    """
+    with GetMetrics().Time('phash'):
+        result = ComputeDHash(source)
+    if result is None:
+        return None, None, None
+    phash, width, height = result
+    return phash, width * height, width / height
+
+
+def ResolvePhoto(item):
+    """Decide where a checked photo goes and whether it should be copied there.
+    
+    Sets item['structured_path'] and item['dest_path'].
+    
+    Args:
+        item: Work item returned by CheckPhoto
+        
+    Returns:
+        bool: True if the photo should be copied
+    """
+    in_fullpath = item['fullpath']
+
+    # organize pictures into nicer paths based on date
+    structured_path = OrganizePath(in_fullpath, item['organization_timestamp'])
+    dest_path = os.path.join(structured_path, item['filename'])
+    item['structured_path'] = structured_path
+    item['dest_path'] = dest_path
 
     # Check for filename conflict and compare files
-    dest_path = os.path.join(structured_path, in_filename)
     should_copy = True
     
-    if photo_attributes is not None: # this case it should be copied for sure
-        if os.path.exists(dest_path): #if there's a file already there, check if the new file is better
+    if item['attributes'] is not None: # this case it should be copied for sure
+        # in plan mode the file there may only be planned so far
+        planned = settings.gPlan.PlannedCopy(dest_path) if settings.gPlan is not None else None
+        if planned is not None or os.path.exists(dest_path): #if there's a file already there, check if the new file is better
             try:
             
-                # Get file stats for comparison
-                source_stat = os.stat(in_fullpath)
-                dest_stat = os.stat(dest_path)
-                
-                source_mtime = source_stat.st_mtime
-                dest_mtime = dest_stat.st_mtime
-                source_size = source_stat.st_size
-                dest_size = dest_stat.st_size
-                
-                # Compare: newer file wins, if same time then larger file wins
-                if dest_mtime > source_mtime:
+                # Compare: the higher quality score wins (see QualityScore.py), then the larger
+                # file; without a score on both sides only the size counts
+                if planned is not None:
+                    dest_size, dest_quality = planned['size'], planned.get('quality')
+                else:
+                    dest_size = os.stat(dest_path).st_size
+                    dest_quality = ScoreFile(dest_path)
+                if not _IsBetterVersion(item.get('quality'), item['size'], dest_quality, dest_size):
                     should_copy = False
-                    settings.gSkippedBetterCount += 1
-                    LOG('WARNING', f"Skipping {in_fullpath} - existing file {dest_path} is newer")
-                if dest_size >= source_size:
-                    should_copy = False
-                    settings.gSkippedBetterCount += 1
-                    LOG('WARNING', f"Skipping {in_fullpath} - existing file {dest_path} is larger or equal size")
+                    CountStat('skipped_better')
+                    LOG('WARNING', f"Skipping {in_fullpath} - existing file {dest_path} is as good or better")
             except OSError as e:
                 LOG('ERROR', f"Error comparing files {in_fullpath} and {dest_path}: {str(e)}", exc_info=True)
                 # On error, proceed with copy to be safe
                 should_copy = True
+
+    if should_copy and not ResolveNearDuplicate(item):
+        should_copy = False
+
+    return should_copy
+
+
+def _IsBetterVersion(quality, size, other_quality, other_size):
+    """Return True if a version of a photo beats another: by quality score, then by size.
+    
+    Versions without a score (formats QualityScore does not read) are compared by size only.
+    """
+    if quality is not None and other_quality is not None and quality != other_quality:
+        return quality > other_quality
+    return size > other_size
+
+
+def _NearDuplicateQuality(entry):
+    """Return the quality score of a near-duplicate, scoring its output file for rows stored without one."""
+    if entry.get('quality') is None and entry['recorded']:
+        entry['quality'] = ScoreFile(entry['dest'])
+    return entry.get('quality')
+
+
+def _NearDuplicateShape(entry):
+    """Return a near-duplicate with its aspect ratio and capture date, reading them from its
+    output file for rows stored without them (an aspect of 0 if the file cannot be read)."""
+    if entry.get('aspect') is None and entry['recorded']:
+        result = ComputeDHash(entry['dest'])
+        entry['aspect'] = result[1] / result[2] if result is not None else 0
+        entry['taken'] = GetEarliestDateCreatedFromExif(entry['dest']) if result is not None else None
+    return entry
+
+
+def ResolveNearDuplicate(item):
+    """Check a resolved photo against the near-duplicates already in the output.
     
+    Of every group of near-duplicates (see PerceptualHash.NearDuplicateIndex) only the best
+    version is kept. Only photos with the same aspect ratio and capture date count as
+    versions (see PerceptualHash.IsSameShot). A photo that is no better than a member of its
+    group is not copied; a better one is copied and replaces the members, whose files
+    RecordNearDuplicate moves to the review folder.
+    The photo is added to the index right away, so photos decided while it is being copied
+    are compared with it.
+    
+    Args:
+        item: Work item with its dest_path set by ResolvePhoto
+        
+    Returns:
+        bool: False if a better near-duplicate is already in the output
+    """
+    index = settings.gNearDuplicateIndex
+    if index is None or item.get('phash') is None:
+        return True
+
+    entry = dict(dest=item['dest_path'], hash=item['hash'], phash=item['phash'], pixels=item['pixels'],
+                 size=item['size'], quality=item.get('quality'), aspect=item.get('aspect'), taken=item.get('taken'),
+                 recorded=False)
+    # A file at the same destination is overwritten anyway (see ResolvePhoto)
+    matches = [match for match in index.Find(item['phash'])
+               if match['dest'] != entry['dest'] and IsSameShot(entry, _NearDuplicateShape(match))]
+    for match in matches:
+        if not _IsBetterVersion(entry['quality'], entry['size'], _NearDuplicateQuality(match), match['size']):
+            CountStat('skipped_near_duplicate')
+            LOG('WARNING', f"Skipping {item['fullpath']} - near-duplicate {match['dest']} is as good or better")
+            return False
+
+    for match in matches:
+        index.Remove(match)
+    index.Add(entry)
+    item['near_duplicate'] = entry
+    item['replaces'] = matches
+    return True
+
+
+def RemoveReplacedCopy(entry, replaced_by=None):
+    """Move the output file of a near-duplicate replaced by a better version to the review folder.
+    
+    The file keeps its path below settings.gOutputPath inside the review folder
+    (settings.gNearDuplicateReviewPath), so a wrongly replaced photo can be moved back.
+    In plan mode (settings.gPlan) the move is only planned.
+    
+    Args:
+        entry: Near-duplicate entry (see ResolveNearDuplicate), or a plan's remove action
+        replaced_by: Destination of the version replacing it, if known
+    """
+    settings.gDatabase.RemovePerceptualHash(entry['dest'])
+    if settings.gPlan is not None:
+        settings.gPlan.AddRemove(entry, replaced_by)
+        return
+    review_path = settings.gNearDuplicateReviewPath or os.path.join(settings.gOutputPath, 'NearDuplicates')
+    relative_path = os.path.relpath(entry['dest'], settings.gOutputPath)
+    if relative_path.startswith(os.pardir):
+        relative_path = os.path.basename(entry['dest'])
+    target = os.path.join(review_path, relative_path)
+    root, ext = os.path.splitext(target)
+    attempt = 0
+    while os.path.lexists(target):
+        attempt += 1
+        target = f"{root}_{attempt}{ext}"
+    try:
+        # Only if it is still the file that was copied there
+        if os.stat(entry['dest']).st_size == entry['size']:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(entry['dest'], target)
+            CountStat('replaced_near_duplicates')
+            LOG('WARNING', f"Moved {entry['dest']} to {target} - replaced by a better near-duplicate"
+                           + (f" {replaced_by}" if replaced_by else ""))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        LOG('ERROR', f"Error moving replaced near-duplicate {entry['dest']} to {target}: {str(e)}")
+
+
+def RecordNearDuplicate(item):
+    """Store the perceptual hash of a copied photo and set aside the versions it replaced."""
+    entry = item.get('near_duplicate')
+    if entry is None:
+        return
+    entry['recorded'] = True
+    if not settings.gNearDuplicateIndex.IsLive(entry):
+        # Replaced by a better version while it was being copied
+        RemoveReplacedCopy(entry)
+        return
+    settings.gDatabase.SetPerceptualHash(entry['dest'], entry['hash'], entry['phash'], entry['pixels'], entry['size'],
+                                       entry['quality'], entry['aspect'], entry['taken'])
+    for replaced in item['replaces']:
+        # Versions still being copied remove themselves once they are recorded
+        if replaced['recorded']:
+            RemoveReplacedCopy(replaced, entry['dest'])
+
+
+def ForgetNearDuplicate(item):
+    """Undo ResolveNearDuplicate for a photo whose copy failed."""
+    entry = item.get('near_duplicate')
+    if entry is None:
+        return
+    index = settings.gNearDuplicateIndex
+    index.Remove(entry)
+    for replaced in item['replaces']:
+        index.Add(replaced)
+
+
+def CopyResolvedPhoto(item):
+    """Copy a resolved photo into its structured location.
+    
+    In plan mode (settings.gPlan) the copy is added to the plan instead and nothing is written.
+    
+    Args:
+        item: Work item that went through ResolvePhoto. Items for data that is not a plain
+            file (e.g. ZIP entries) carry their own 'copy_func' taking the item.
+        
+    Returns:
+        bool: True if the copy succeeded
+    """
+    if settings.gPlan is not None:
+        settings.gPlan.AddCopy(item)
+        return True
+    metrics = GetMetrics()
+    MakeOutputDirectory(item['structured_path'])
+    # verified copies check the full hash too (ZIP entries through item['full_hash'])
+    full_hash = VerifiedCopyFullHash(item['fullpath'], item.get('stat'), item.get('full_hash'))
+    if full_hash is not None:
+        item['full_hash'] = full_hash
+    full_hash_known = full_hash is not None and full_hash.value is not None
+    with metrics.Time('copy'):
+        if item.get('copy_func') is not None:
+            copied = item['copy_func'](item)
+        else:
+            copied = CopyImage(item['fullpath'], item['structured_path'], item['filename'], item['hash'], item.get('stat'),
+                               full_hash)
+    if copied:
+        metrics.AddBytes('copy', item['size'])
+        MemoizeCopyFullHash(item['fullpath'], item['hash'], full_hash, full_hash_known, item.get('stat'))
+    return copied
+
+
+def RecordPhoto(item):
+    """Add a copied photo to the database."""
+    # add to database with hash (in plan mode only for the lookups of this run)
+    if settings.gDatabase.AddPhoto(item['filename'], item['fullpath'], item['timestamp'], item['hash']) and settings.gPlan is None:
+        CountStat('imported')
+        LOG('DEBUG', f"Added {item['fullpath']} to {item['structured_path']}")
+    RecordNearDuplicate(item)
+
+
+def AddPhoto(in_fullpath, in_filename, in_timestamp_float, in_stat=None):
+    """Add a photo to the library.
+    
+    Args:
+        in_fullpath: Full path to the source image file
+        infilename: Filename to use when copying (may be original filename from database)
+        in_timestamp_float: Timestamp to use for organization
+        in_stat: os.stat_result of the file if the caller already has one (e.g. DirEntry.stat())
+        
+    When the ingest pipeline is running (settings.gPipeline), the photo is queued to it
+    and this returns immediately. Otherwise the same stages run inline.
+    
+    Performance optimization: This function orders operations from cheapest to most expensive:
+    1. Regex check for face crops (no I/O)
+    2. Quick database lookup by stat fingerprint and source path (fast indexed queries)
+    3. File hash computation (only if needed - reads first and last 64KB)
+    4. EXIF reading (only if file will be processed)
+    """
+    # LOG('DEBUG', f"AddPhoto: {fullpath} (new filename: {new_filename})")
+
+    if settings.gPipeline is not None:
+        settings.gPipeline.Submit(in_fullpath, in_filename, in_timestamp_float, in_stat)
+        return
+
+    item = CheckPhoto(in_fullpath, in_filename, in_timestamp_float, in_stat=in_stat)
+    if item is None:
+        return
+    ProcessCheckedPhoto(item)
+
+
+def ProcessCheckedPhoto(item):
+    """Resolve, copy and record a work item that passed CheckPhoto (or an equivalent check).
+    
+    Hands the item to the ingest pipeline writer when the pipeline is running.
+    """
+    if settings.gPipeline is not None:
+        settings.gPipeline.SubmitChecked(item)
+        return
+
     # copy image in a structured location (only if should_copy is True)
-    if should_copy:
-        if CopyImage(in_fullpath, structured_path, in_filename):
-            # add to database with hash
-            if settings.gDatabase.AddPhoto(in_filename, in_fullpath, in_timestamp_float, file_hash):
-                LOG('DEBUG', f"Added {in_fullpath} to {structured_path}")
+    if ResolvePhoto(item):
+        if CopyResolvedPhoto(item):
+            RecordPhoto(item)
+        else:
+            ForgetNearDuplicate(item)
+            MarkIncomplete(item['fullpath'])
     else:
-        LOG('DEBUG', f"Not copying {in_fullpath} - existing file is better")
\ No newline at end of file
+        LOG('DEBUG', f"Not copying {item['fullpath']} - existing file is better")
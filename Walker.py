@@ -0,0 +1,198 @@
+import os
+import json
+import settings
+import xxhash
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from Utils import *
+import IPhotoLibrary
+
+
+class DirectoryListing:
+    """Result of visiting one directory during the walk."""
+    def __init__(self, path):
+        self.path = path
+        self.files = []       # DirEntry objects of the non-directory entries to import
+        self.subdirs = []     # Paths of the subdirectories to walk
+        self.libraries = []   # Paths of the Photos libraries found in the directory
+        self.manifest = None  # (mtime_ns, entry_count, digest, subdir names) to record once the files are imported
+
+
+def DirectoryDigest(entries):
+    """Compute the order-independent digest of a directory listing.
+
+    Sums the xxh64 of every entry's name, size and mtime (names only for subdirectories),
+    so the result does not depend on the order in which the filesystem returns entries.
+
+    Args:
+        entries: List of os.DirEntry objects
+
+    Returns:
+        str: Hex digest
+    """
+    total = 0
+    for entry in entries:
+        if entry.is_dir():
+            key = f"{entry.name}/"
+        else:
+            entry_stat = entry.stat()
+            key = f"{entry.name}\0{entry_stat.st_size}\0{entry_stat.st_mtime_ns}"
+        total = (total + xxhash.xxh64_intdigest(key.encode('utf-8', 'surrogateescape'))) & 0xFFFFFFFFFFFFFFFF
+    return f"{total:016x}"
+
+
+def _ClassifySubDirectories(listing, directory, names):
+    """Sort subdirectories into Photos libraries and folders to walk; drop ignored folders.
+
+    Works from the names in the parent's listing alone, so a subdirectory costs no system
+    call until it is listed itself.
+    """
+    for name in names:
+        path = os.path.join(directory, name)
+        if IPhotoLibrary.IsPhotosLibraryName(name):
+            listing.libraries.append(path)
+        elif IsValidSubDirectory(path):
+            listing.subdirs.append(path)
+
+
+def VisitDirectory(directory, track_manifest=True):
+    """List one directory and classify its entries.
+
+    Directories whose manifest (see DataBase.QueueDirectoryManifest) is unchanged since an
+    earlier run are not checked again: with the same entry count and listing digest their
+    files are skipped. Their subdirectories are still returned, because a directory's
+    listing does not change when something deeper in the tree does. settings.gFullRescan
+    disables this.
+
+    The directory is listed every time, because a file rewritten in place changes its
+    size or mtime (and so the digest) but not the directory's mtime. Only with
+    settings.gTrustDirectoryMtime is a directory with an unchanged mtime skipped without
+    being listed, which misses such in-place edits.
+
+    Safe to call from several threads at once.
+
+    Args:
+        directory: Directory path, as joined by the walk (manifests are keyed by its normalized form)
+        track_manifest: Compare with and produce a directory manifest (needs settings.gDatabase)
+
+    Returns:
+        DirectoryListing
+    """
+    listing = DirectoryListing(directory)
+    try:
+        manifest = None
+        if track_manifest:
+            # Stat before listing, so a change made while listing shows up next run
+            dir_mtime_ns = os.stat(directory).st_mtime_ns
+            if not settings.gFullRescan:
+                manifest = settings.gDatabase.GetDirectoryManifest(os.path.normpath(directory))
+            if settings.gTrustDirectoryMtime and manifest is not None and manifest['mtime_ns'] == dir_mtime_ns:
+                LOG('DEBUG', f"Skipping directory with unchanged mtime: {directory}")
+                _ClassifySubDirectories(listing, directory, json.loads(manifest['subdirs']))
+                return listing
+
+        entries = list(os.scandir(directory))
+        subdir_names = [entry.name for entry in entries if entry.is_dir()]
+
+        if track_manifest:
+            digest = DirectoryDigest(entries)
+            new_manifest = (dir_mtime_ns, len(entries), digest, subdir_names)
+            if manifest is not None and (manifest['entry_count'], manifest['digest']) == (len(entries), digest):
+                # Same entries, sizes and mtimes: record the manifest again and skip the files
+                LOG('DEBUG', f"Skipping directory with unchanged contents: {directory}")
+                _ClassifySubDirectories(listing, directory, subdir_names)
+                listing.manifest = new_manifest
+                return listing
+
+        listing.files = [entry for entry in entries if not entry.is_dir()]
+        _ClassifySubDirectories(listing, directory, subdir_names)
+        if track_manifest:
+            listing.manifest = new_manifest
+    except Exception as e:
+        LOG('ERROR', f"Error scanning {directory}: {str(e)}", exc_info=True)
+        listing.manifest = None
+    return listing
+
+
+class WalkState:
+    """Directories a walk has not handed to its caller yet; lets a walk be checkpointed and resumed.
+
+    Attributes:
+        frontier: Stack of directories still to visit, subtrees included
+        files_only: Directories whose files are imported again on resume but whose
+            subdirectories are already in the frontier (or done)
+        listing: Directories being listed right now, or listed but not yielded yet
+    """
+    def __init__(self, frontier, files_only=()):
+        self.frontier = list(frontier)
+        self.files_only = set(files_only)
+        self.listing = set()
+
+    def Pending(self):
+        """Return (directories to walk, directories whose files alone are still to import)."""
+        full = [path for path in self.frontier + list(self.listing) if path not in self.files_only]
+        return full, sorted(self.files_only)
+
+    def _Pop(self):
+        directory = self.frontier.pop()
+        self.listing.add(directory)
+        return directory
+
+    def _Listed(self, listing):
+        self.listing.discard(listing.path)
+        if listing.path in self.files_only:
+            self.files_only.discard(listing.path)
+        else:
+            self.frontier.extend(reversed(listing.subdirs))
+
+
+def _TimedVisit(directory, track_manifest):
+    """VisitDirectory, counted and timed as the 'walk' stage of the run metrics."""
+    metrics = GetMetrics()
+    metrics.Count('directories')
+    with metrics.Time('walk'):
+        return VisitDirectory(directory, track_manifest)
+
+
+def WalkFolder(root, workers=1, track_manifests=True, timed=True, state=None):
+    """Walk a directory tree iteratively, yielding a DirectoryListing per directory.
+
+    Up to workers directories are listed at once on a thread pool, which hides the
+    per-listing round-trip of network filesystems. The frontier of directories still to
+    visit is an explicit stack rather than the call stack, so tree depth is not limited
+    by the recursion limit, and at most 2 * workers listings are held at any time.
+
+    Args:
+        root: Directory to walk
+        workers: Number of concurrent directory listings (1 = list in the calling thread)
+        track_manifests: Use and produce directory manifests (False for extracted ZIPs)
+        timed: Count and time the visits in the run metrics (False for walks that import nothing)
+        state: WalkState to walk instead of the tree below root (see Checkpoint.py);
+            its Pending() is up to date whenever a listing is yielded
+
+    Yields:
+        DirectoryListing for every visited directory, as soon as it is listed
+    """
+    track_manifests = track_manifests and settings.gDatabase is not None
+    visit = _TimedVisit if timed else VisitDirectory
+    if state is None:
+        state = WalkState([root])
+    frontier = state.frontier
+
+    if workers <= 1:
+        while frontier:
+            listing = visit(state._Pop(), track_manifests)
+            state._Listed(listing)
+            yield listing
+        return
+
+    max_in_flight = workers * 2
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walk') as executor:
+        in_flight = set()
+        while frontier or in_flight:
+            while frontier and len(in_flight) < max_in_flight:
+                in_flight.add(executor.submit(visit, state._Pop(), track_manifests))
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                state._Listed(listing)
+                yield listing
@@ -1,4 +1,8 @@
+import io
+import threading
 import zipfile
+import xxhash
+from concurrent.futures import ThreadPoolExecutor, wait
 from Utils import *
 import os
 import pathlib
@@ -12,9 +16,438 @@ def ZipTimeConvert(z):
     return datetime.datetime(z.date_time[0],z.date_time[1],z.date_time[2],z.date_time[3],z.date_time[4],z.date_time[5])
 
 
+def ZipEntryTimestamp(zipentry_info):
+    """Return the timestamp stored for a ZIP entry as a Unix timestamp."""
+    orgdatetime = ZipTimeConvert(zipentry_info)
+    return time.mktime(orgdatetime.timetuple())
+
+
+def ZipEntryExifTimestamp(zfile, zipentry_info, head, entry_name):
+    """Return the EXIF date of a ZIP entry from its head, reading further in the entry when needed.
+    
+    Movies often store their metadata after the media data, far beyond the head; like
+    FileProbe.ExifTimestamp for files, the parsers then seek in the entry (decompressing
+    it again from the start when it is compressed).
+    """
+    if len(head) >= zipentry_info.file_size:
+        return GetEarliestDateCreatedFromBytes(head, entry_name)
+    with zfile.open(zipentry_info) as stream:
+        return GetEarliestDateCreatedFromBytes(head, entry_name, stream, zipentry_info.file_size)
+
+
+# Marks ZipPool worker threads, which process nested archives inline instead of queueing them
+_zip_worker = threading.local()
+
+
+class ZipPool:
+    """Processes ZIP files on worker threads while the directory walk continues.
+    
+    Each worker runs AnalyzeZip, so entries flow into the same dedup and database path
+    (the ingest pipeline) as files found by the walk.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip')
+        # Queued and running ZIP files, for WaitIdle
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+        LOG('INFO', f"ZIP pool started: {workers} workers")
+
+    def Submit(self, zipname, on_done=None):
+        """Queue a ZIP file; ZIPs found from inside a worker are processed right away.
+        
+        Args:
+            zipname: Path to the ZIP file
+            on_done: Optional callable taking zipname, called once the archive is fully processed
+        """
+        if getattr(_zip_worker, 'active', False):
+            self._Run(zipname, on_done)
+        else:
+            future = self._executor.submit(self._Run, zipname, on_done)
+            with self._futures_lock:
+                self._futures.add(future)
+            future.add_done_callback(self._Discard)
+
+    def _Discard(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def _Run(self, zipname, on_done=None):
+        _zip_worker.active = True
+        try:
+            AnalyzeZip(zipname)
+        except Exception as e:
+            LOG('ERROR', f"Zip analyze - error handling zipfile {zipname}: {str(e)}", exc_info=True)
+        finally:
+            if on_done is not None:
+                on_done(zipname)
+
+    def WaitIdle(self, timeout=None):
+        """Wait until the ZIP files queued so far are processed. Returns False on timeout."""
+        with self._futures_lock:
+            futures = list(self._futures)
+        return not wait(futures, timeout).not_done
+
+    def Close(self):
+        """Wait for all queued ZIP files to be processed."""
+        self._executor.shutdown(wait=True)
+        LOG('DEBUG', "ZIP pool stopped")
+
+
+def SubmitZip(zipname, on_done=None):
+    """Hand a ZIP file to the ZIP pool, or process it right away when there is none.
+    
+    on_done, if given, is called with zipname once the archive is fully processed.
+    """
+    if settings.gZipPool is not None:
+        settings.gZipPool.Submit(zipname, on_done)
+    else:
+        try:
+            AnalyzeZip(zipname)
+        finally:
+            if on_done is not None:
+                on_done(zipname)
+
+
+def _BeginZipGroup():
+    """Start tracking the pipeline work submitted for one archive (None without pipeline)."""
+    if settings.gPipeline is not None:
+        return settings.gPipeline.BeginGroup()
+    return None
+
+
+def _EndZipGroup(group):
+    """Wait until the pipeline is done with the archive; its entries still read from it."""
+    if group is not None:
+        settings.gPipeline.EndGroup(group)
+
+
 def AnalyzeZip(zipname):
+    """Import the photos in a ZIP file, using the mode selected by settings.gZipMode.
+    
+    The whole archive is timed as the 'zip' stage of the run metrics; in extract mode that
+    includes importing the extracted files.
+    """
+    metrics = GetMetrics()
+    with metrics.Time('zip'):
+        if settings.gZipMode == 'extract':
+            ExtractAndAnalyzeZip(zipname)
+        else:
+            StreamZip(zipname)
+    try:
+        metrics.AddBytes('zip', os.path.getsize(zipname))
+    except OSError:
+        pass
+
+
+def StreamZip(zipname, add_entry=None):
+    """Import the photos in a ZIP file without extracting it to the temp path.
+    
+    Every image entry is hashed straight from the decompressed stream and checked against the
+    database; only new images are decompressed a second time, directly into their final
+    OrganizePath destination. Entries are recorded under the virtual source path
+    <zipname>/<entry name>, so re-runs skip them without reading the archive data.
+    
+    Args:
+        zipname: Path to the ZIP file
+        add_entry: Called as add_entry(zfile, zipentry_info, entry_path, entry_name) for every
+            image entry instead of AddZipPhoto (Shard.py records entries this way)
+    """
+    zfile = None
+    open_archives = []
+    spilled_paths = []
+    group = _BeginZipGroup()
+
+    try:
+        LOG('INFO', f"Streaming Zip file {zipname}")
+        zfile = zipfile.ZipFile(zipname)
+        _StreamZipEntries(zfile, zipname, open_archives, spilled_paths, add_entry or AddZipPhoto)
+    except Exception as e:
+        LOG('ERROR', f"Zip analyze - error handling zipfile {zipname}: {str(e)}", exc_info=True)
+        MarkIncomplete(zipname)
+    finally:
+        # Entries queued to the ingest pipeline still read from the archives
+        _EndZipGroup(group)
+        _CloseArchives(zipname, [zfile] + open_archives, spilled_paths)
+
+
+def _CloseArchives(zipname, archives, spilled_paths):
+    """Close the archives opened for a ZIP file and remove its spilled nested ZIPs."""
+    for archive in archives:
+        if archive is not None:
+            try:
+                archive.close()
+            except Exception as e:
+                LOG('WARNING', f"Error closing ZIP file {zipname}: {str(e)}")
+
+    for spilled_path in spilled_paths:
+        try:
+            os.remove(spilled_path)
+            LOG('DEBUG', f"Removed spilled nested ZIP file: {spilled_path}")
+        except OSError as e:
+            LOG('WARNING', f"Failed to remove spilled nested ZIP file {spilled_path}: {str(e)}")
+
+
+def IsExcludedZipEntry(zip_path, entry_filename, excluded_dirs=None):
+    """Apply the classifier exclude rules to a ZIP entry as if the archive were a directory.
+    
+    Like the directory walk, each directory of the entry's virtual path (<zip path>/<dir>...)
+    is matched against the exclude rules, and the whole path against the exclude_files rules.
+    
+    Args:
+        zip_path: Path (or virtual path, for nested archives) of the ZIP file
+        entry_filename: Archive-relative name of the entry
+        excluded_dirs: Optional dict caching the verdict per directory across the entries of an archive
+    """
+    classifier = GetClassifier()
+    if excluded_dirs is None:
+        excluded_dirs = {}
+    directory = zip_path
+    for part in entry_filename.split('/')[:-1]:
+        directory = os.path.join(directory, part)
+        if directory not in excluded_dirs:
+            excluded_dirs[directory] = classifier.IsExcludedDirectory(directory)
+        if excluded_dirs[directory]:
+            return True
+    return classifier.IsExcludedFile(os.path.join(zip_path, entry_filename))
+
+
+def _StreamZipEntries(zfile, zip_path, open_archives, spilled_paths, add_entry):
+    """Classify and import every entry of an open ZIP file, recursing into nested ZIPs."""
+    excluded_dirs = {}
+    for zipentry_info in zfile.infolist():
+        if zipentry_info.is_dir() or IsExcludedZipEntry(zip_path, zipentry_info.filename, excluded_dirs):
+            continue
+
+        entry_path = os.path.join(zip_path, zipentry_info.filename)
+        entry_name = os.path.basename(zipentry_info.filename)
+
+        if IsZipFile(entry_name):
+            try:
+                nested = _OpenNestedZip(zfile, zipentry_info, open_archives, spilled_paths)
+                _StreamZipEntries(nested, entry_path, open_archives, spilled_paths, add_entry)
+            except Exception as e:
+                LOG('ERROR', f"Zip analyze - error handling nested zipfile {entry_path}: {str(e)}", exc_info=True)
+                MarkIncomplete(entry_path)
+        elif IsImageFile(entry_name):
+            CountStat('zip_images')
+            CountStat('image_bytes', zipentry_info.file_size)
+            try:
+                add_entry(zfile, zipentry_info, entry_path, entry_name)
+            except Exception as e:
+                LOG('ERROR', f"Zip analyze - error importing {entry_path}: {str(e)}", exc_info=True)
+                MarkIncomplete(entry_path)
+        else:
+            CountStat('non_image_files')
+            LOG('DEBUG', f"Skipping non-image file: {entry_path}")
+
+
+def _OpenNestedZip(zfile, zipentry_info, open_archives, spilled_paths):
+    """Open a ZIP stored inside another ZIP.
+    
+    Archives up to settings.gNestedZipMemoryLimit bytes are read into memory; larger ones are
+    spilled to a file in settings.gTempPath, which the caller removes when done.
+    """
+    if zipentry_info.file_size <= settings.gNestedZipMemoryLimit:
+        nested = zipfile.ZipFile(io.BytesIO(zfile.read(zipentry_info)))
+    else:
+        spilled_path = os.path.join(settings.gTempPath, f"nested_{uuid.uuid4().hex[:8]}.zip")
+        spilled_paths.append(spilled_path)
+        with zfile.open(zipentry_info) as source, open(spilled_path, 'wb') as dest:
+            shutil.copyfileobj(source, dest, STREAM_BLOCK_SIZE)
+        LOG('DEBUG', f"Spilled nested ZIP {zipentry_info.filename} ({zipentry_info.file_size} bytes) to {spilled_path}")
+        nested = zipfile.ZipFile(spilled_path)
+    open_archives.append(nested)
+    return nested
+
+
+def AddZipPhoto(zfile, zipentry_info, entry_path, entry_name):
+    """Import one image entry of an open ZIP file (the ZIP counterpart of Utils.AddPhoto).
+    
+    Args:
+        zfile: Open ZipFile containing the entry
+        zipentry_info: ZipInfo of the entry
+        entry_path: Virtual source path of the entry (<zip path>/<entry name>)
+        entry_name: Filename to use when copying
+    """
+    if IsFaceCrop(entry_name):
+        return
+
+    metrics = GetMetrics()
+    with metrics.Time('db_lookup'):
+        known_source = settings.gDatabase.HasSourcePath(entry_path)
+    if known_source:
+        CountStat('skipped_database')
+        LOG('DEBUG', f"Skipping {entry_path} (already imported from same source)")
+        return
+
+    # Hash from the decompressed stream, keeping the head for the EXIF readers. The quick hash
+    # reads the whole stream, so the full hash for settings.gVerifyDuplicates comes for free.
+    full_hash = None
+    with metrics.Time('hash'), zfile.open(zipentry_info) as stream:
+        if settings.gVerifyDuplicates:
+            stream = _HashingReader(stream)
+        file_hash, head = ComputeQuickStreamHash(stream, zipentry_info.file_size)
+        if settings.gVerifyDuplicates:
+            full_hash = LazyFullHash(None, stream.hasher.hexdigest())
+    if file_hash is None:
+        LOG('ERROR', f"Skipping {entry_path} (failed to compute hash)")
+        MarkIncomplete(entry_path)
+        return
+
+    with metrics.Time('db_lookup'):
+        is_duplicate, photo_attributes = IsKnownDuplicate(entry_path, file_hash, full_hash)
+    if is_duplicate:
+        return
+
+    # Preserve the timestamp stored in the ZIP; EXIF dates still win for organization
+    zip_timestamp = ZipEntryTimestamp(zipentry_info)
+    organization_timestamp = zip_timestamp
+    exif_timestamp = None
+    if GetClassifier().WantsMetadataDate(entry_name):
+        with metrics.Time('exif'):
+            exif_timestamp = ZipEntryExifTimestamp(zfile, zipentry_info, head, entry_name)
+        if exif_timestamp:
+            organization_timestamp = exif_timestamp
+
+    # Scored from the head only: headers beyond it count as unreadable
+    with metrics.Time('quality'):
+        quality = ScoreImage(lambda offset, size: head[offset:offset + size], zipentry_info.file_size, SniffImageFormat(head), entry_name)
+
+    phash = pixels = aspect = None
+    if settings.gNearDuplicateIndex is not None and SniffImageFormat(head) in PERCEPTUAL_FORMATS:
+        with zfile.open(zipentry_info) as stream:
+            phash, pixels, aspect = PerceptualFields(stream)
+
+    def copy_func(item):
+        return CopyZipEntry(zfile, zipentry_info, item)
+
+    item = dict(fullpath=entry_path, filename=entry_name, timestamp=zip_timestamp,
+                hash=file_hash, full_hash=full_hash, attributes=photo_attributes, stat=None,
+                size=zipentry_info.file_size, mtime=zip_timestamp,
+                organization_timestamp=organization_timestamp, quality=quality, phash=phash, pixels=pixels,
+                aspect=aspect, taken=exif_timestamp or None, copy_func=copy_func)
+    ProcessCheckedPhoto(item)
+
+
+class _HashingReader:
+    """Wraps a stream and computes the full hash (Utils.ComputeFileHash value) of all data read from it."""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = xxhash.xxh64()
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hasher.update(data)
+        return data
+
+
+def ComputeZipEntryHashes(zip_path, entry_path):
+    """Return (quick hash, full hash) of a ZIP entry recorded under its virtual source path.
+    
+    Used by Utils.FullHashOfSource to confirm a quick hash match against a photo imported from
+    a ZIP file. Entries of nested ZIP files are not opened.
+    
+    Args:
+        zip_path: The ZIP file (see Utils.ContainingZip)
+        entry_path: Virtual source path of the entry (<zip path>/<entry name>)
+    
+    Returns:
+        tuple[str, str]: The hashes, or None if the entry cannot be read
+    """
+    entry_name = os.path.relpath(entry_path, zip_path).replace(os.sep, '/')
+    try:
+        with zipfile.ZipFile(zip_path) as zfile:
+            zipentry_info = zfile.getinfo(entry_name)
+            with zfile.open(zipentry_info) as stream:
+                reader = _HashingReader(stream)
+                file_hash, _ = ComputeQuickStreamHash(reader, zipentry_info.file_size)
+        return file_hash, reader.hasher.hexdigest()
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        LOG('DEBUG', f"Cannot hash ZIP entry {entry_path}: {str(e)}")
+        return None
+
+
+def CopyZipEntry(zfile, zipentry_info, item):
+    """Decompress a ZIP entry to item['dest_path'] and give it the timestamp stored in the ZIP.
+    
+    Returns:
+        bool: True if the entry was written
+    """
+    destname = item['dest_path']
+    if settings.gCopyEngine is not None:
+        with zfile.open(zipentry_info) as source:
+            return settings.gCopyEngine.CopyStream(source, destname, zipentry_info.file_size, item['hash'], item['timestamp'],
+                                                   item.get('full_hash'))
+    try:
+        with zfile.open(zipentry_info) as source, open(destname, 'wb') as dest:
+            shutil.copyfileobj(source, dest, STREAM_BLOCK_SIZE)
+        os.utime(destname, (item['timestamp'], item['timestamp']))
+    except Exception as e:
+        LOG('ERROR', f"Error extracting {item['fullpath']} to {destname}: {str(e)}", exc_info=True)
+        return False
+    return True
+
+
+def ExtractZipEntries(zipname, entry_paths, extract):
+    """Open a ZIP file once and hand the given entries to extract (see Plan.ApplyPlan).
+    
+    Nested ZIPs holding some of the entries are opened once each, like in StreamZip.
+    
+    Args:
+        zipname: Path to the ZIP file
+        entry_paths: Virtual source paths of entries (<zipname>/<entry name>, with the nested
+            ZIP names in between for entries of nested ZIPs)
+        extract: Called as extract(zfile, zipentry_info, entry_path) for every entry found
+    """
+    zfile = None
+    open_archives = []
+    spilled_paths = []
+    nested_archives = {}
+
+    def find_info(archive, name):
+        try:
+            return archive.getinfo(name)
+        except KeyError:
+            return None
+
+    def locate(archive, archive_path, entry_path):
+        entry_name = os.path.relpath(entry_path, archive_path).replace(os.sep, '/')
+        zipentry_info = find_info(archive, entry_name)
+        if zipentry_info is not None:
+            return archive, zipentry_info
+        parts = entry_name.split('/')
+        for count in range(1, len(parts)):
+            nested_name = '/'.join(parts[:count])
+            nested_info = find_info(archive, nested_name) if IsZipFile(nested_name) else None
+            if nested_info is not None:
+                nested_path = os.path.join(archive_path, nested_name)
+                nested = nested_archives.get(nested_path)
+                if nested is None:
+                    nested = nested_archives[nested_path] = _OpenNestedZip(archive, nested_info, open_archives, spilled_paths)
+                return locate(nested, nested_path, entry_path)
+        return None
+
+    try:
+        zfile = zipfile.ZipFile(zipname)
+        for entry_path in entry_paths:
+            located = locate(zfile, zipname, entry_path)
+            if located is None:
+                LOG('ERROR', f"Entry {entry_path} not found in {zipname}")
+                continue
+            extract(*located, entry_path)
+    except Exception as e:
+        LOG('ERROR', f"Zip extract - error handling zipfile {zipname}: {str(e)}", exc_info=True)
+    finally:
+        _CloseArchives(zipname, [zfile] + open_archives, spilled_paths)
+
+
+def ExtractAndAnalyzeZip(zipname):
+    """Extract a ZIP file to the temp path and import it with AnalyzeFolder (legacy mode)."""
     zfile = None
     extracted_dir = None
+    group = _BeginZipGroup()
     
     try:
         LOG('INFO', f"Extracting Zip file {zipname}")
@@ -26,34 +459,34 @@ def AnalyzeZip(zipname):
         os.makedirs(extracted_dir, exist_ok=True)
         
         # Extract all entries and preserve timestamps
+        excluded_dirs = {}
         for zipentry in zfile.namelist():
             if not zipentry.endswith('/'):  # Skip directory entries
-                if IsValidSubDirectory(zipentry):
+                if not IsExcludedZipEntry(zipname, zipentry, excluded_dirs):
                     zfile.extract(zipentry, extracted_dir)
                     # Preserve original timestamp from ZIP
                     zipentry_info = zfile.getinfo(zipentry)
-                    orgdatetime = ZipTimeConvert(zipentry_info)
-                    orgtime = time.mktime(orgdatetime.timetuple())
+                    orgtime = ZipEntryTimestamp(zipentry_info)
                     extracted_path = os.path.join(extracted_dir, zipentry)
                     if os.path.exists(extracted_path):
                         os.utime(extracted_path, (orgtime, orgtime))
         
-        # Track image count before processing
-        initial_folder_count = settings.gFolderImageCount
-        
-        # Process extracted directory using standard folder analysis
+        # Process extracted directory using standard folder analysis; images are counted as ZIP images
         # Import here to avoid circular import with Crawl.py
         from Crawl import AnalyzeFolder
-        AnalyzeFolder(extracted_dir)
-        
-        # Calculate images found in ZIP and update counters
-        images_found = settings.gFolderImageCount - initial_folder_count
-        settings.gZipImageCount += images_found
-        settings.gFolderImageCount -= images_found
+        AnalyzeFolder(extracted_dir, in_zip=True)
         
     except Exception as e:
         LOG('ERROR', f"Zip analyze - error handling zipfile {zipname}: {str(e)}", exc_info=True)
+        MarkIncomplete(zipname)
     finally:
+        # Photos queued to the ingest pipeline still read from the extracted directory
+        _EndZipGroup(group)
+
+        # A failed import below the extracted directory means the ZIP itself needs another look
+        if extracted_dir and any(d.startswith(extracted_dir) for d in list(settings.gIncompleteDirectories)):
+            MarkIncomplete(zipname)
+
         # Ensure ZIP file is closed
         if zfile is not None:
             try:
@@ -68,4 +501,3 @@ def AnalyzeZip(zipname):
                 LOG('DEBUG', f"Removed extracted ZIP directory: {extracted_dir}")
             except Exception as e:
                 LOG('WARNING', f"Failed to remove extracted ZIP directory {extracted_dir}: {str(e)}")
-
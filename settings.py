@@ -3,15 +3,46 @@
 gOutputPath = "/path/to/output"
 gTempPath = "/path/to/temp"
 gDatabasePath = None  # Database directory path (defaults to gOutputPath if not set)
-gImageExtensions = ["jpg", "jpeg", "png", "tif", "tiff", "gif", "bmp", "heic", "heif", "mov", "mp4", "m4v", "m4a", "m4b", "m4p", "m4v", "m4a", "m4b", "m4p", "cr2", "nef", "webp"]
-gExifImageExtensions = ["jpg", "jpeg", "tif", "tiff", "mp4", "m4v", "m4a", "m4b", "m4p", "m4v", "m4a", "m4b", "m4p", "cr2", "nef"]
+gImageExtensions = ["jpg", "jpeg", "png", "tif", "tiff", "gif", "bmp", "heic", "heif", "mov", "mp4", "m4v", "m4a", "m4b", "m4p", "cr2", "nef", "webp"]
+gExifImageExtensions = ["jpg", "jpeg", "png", "webp", "heic", "heif", "mov", "tif", "tiff", "mp4", "m4v", "m4a", "m4b", "m4p", "cr2", "nef"]
 gIgnoreFolders = ["__MACOSX", "Data.noindex", ".Trash", "Caches", "Thumbnails", "com.apple.AddressBook.", "Library/Containers", "Application Support"]
+gClassifierConfig = None  # JSON file overriding the lists above (see Classifier.py); None uses them as they are
+gClassifier = None  # Classifier.Classifier compiled at startup
 gDatabase = None
+gDatabaseFlushRows = 500        # Write-behind batch size for database inserts (0 = write every row immediately)
+gDatabaseFlushIntervalMs = 1000  # Maximum time a buffered insert waits before it is written
+gZipMode = 'stream'  # 'stream' hashes ZIP entries in place, 'extract' unpacks whole archives to gTempPath first
+gNestedZipMemoryLimit = 64 * 1024 * 1024  # Nested ZIPs up to this size are opened in memory, larger ones spill to gTempPath
+gZipWorkers = 2  # ZIP files processed concurrently with the directory walk (needs the ingest pipeline; 0 = inline)
+gZipPool = None
+gWalkWorkers = 8  # Directories listed concurrently during the walk (1 = list one directory at a time)
+gCopyEngine = None  # CopyEngine.CopyEngine used for copies to gOutputPath (None = shutil.copy2)
+gCopyMode = 'copy'  # 'copy', 'reflink' or 'hardlink' (links and clones only when source and output share a device)
+gCopyVerify = False  # Hash copied data while streaming and reject copies that do not match the deduplicated hash
+gCopyBytesPerSecond = 0  # Combined copy rate limit of all copy workers (0 = unlimited)
+gFullRescan = False  # Ignore the directory manifests of earlier runs and list/check every directory
+gTrustDirectoryMtime = False  # Skip directories whose mtime matches their manifest without listing them (misses files rewritten in place)
+gIncompleteDirectories = set()  # Directories with a failed import; their manifests are not recorded
+gPreloadIndex = False  # Load all known hashes and source paths into memory at startup (see DataBase.PhotoIndex)
+gVerifyDuplicates = False  # Confirm quick hash matches by full-content hashes before skipping a file as a duplicate
+gNearDuplicateDistance = 4  # dHash bits two photos may differ in to count as versions of the same photo (of 64)
+gNearDuplicateIndex = None  # PerceptualHash.NearDuplicateIndex of the output (None = near-duplicate detection off)
+gNearDuplicateReviewPath = None  # Replaced near-duplicates are moved here instead of deleted (None = gOutputPath/NearDuplicates/)
+gCheckpointInterval = 60  # Seconds between crawl checkpoints in the database (0 = only when a crawl is interrupted; see Checkpoint.py)
+gResume = False  # Continue the interrupted crawl of the scan path from its checkpoint instead of starting over
+gNodeId = None  # Name of this node in scan-only shard manifests and plans (None = host name; see Shard.py)
+gPlan = None  # Plan.PlanWriter collecting the copies of a plan-mode crawl (None = copy while crawling)
 
-# Statistics counters
-gFolderImageCount = 0  # Number of images scanned in folders
-gZipImageCount = 0     # Number of images scanned in ZIP files
-gSkippedBetterCount = 0  # Number of files skipped because better versions exist
-gSkippedDatabaseCount = 0  # Number of files skipped because already in database
-gNonImageFileCount = 0  # Number of non-image files encountered
-gSkippedPhotosLibraryCount = 0  # Number of photos skipped in Photos library because file not available (e.g., iCloud not downloaded)
+# Ingest pipeline (see Pipeline.py); gHashWorkers = 0 runs AddPhoto inline in the crawler thread
+gPipeline = None
+gHashWorkers = 4        # Threads computing hashes and reading metadata
+gCopyWorkers = 2        # Threads copying files to the output path
+gExifProcesses = 0      # Optional process pool for Pillow-bound EXIF reads (0 = read in hash threads)
+gPipelineQueueSize = 256  # Maximum number of files waiting between two pipeline stages
+
+# Run statistics: counters (images found, files skipped, ...) and per-stage timings (see Metrics.py)
+gMetrics = None  # Metrics.Metrics of the current run, created on first use by Utils.GetMetrics
+gMetricsOut = None  # JSON file the final metrics snapshot is written to (None = not written)
+gProgress = 'auto'  # Status line on stderr: 'on', 'off', or 'auto' (only when stderr is a terminal)
+gProgressInterval = 1.0  # Seconds between status line updates
+gPreCount = False  # Count the image files of the scan path first (on a separate thread) for an ETA
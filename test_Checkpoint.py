@@ -0,0 +1,82 @@
+"""Tests of resuming a crawl that was interrupted while its queued photos were being copied.
+
+    python -m pytest -q test_Checkpoint.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+from SyntheticTree import GenerateTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CRAWLER = os.path.join(HERE, 'PhotoCrawler.py')
+
+# Runs the crawler with the copies of Photos library files slowed down, and interrupts it
+# shortly after the walk, while those copies are still queued
+INTERRUPTED_CRAWL = f"""
+import os, sys, time, signal, threading
+sys.path.insert(0, {HERE!r})
+import Crawl, Pipeline, PhotoCrawler
+
+copy = Pipeline.CopyResolvedPhoto
+def SlowCopy(item):
+    if '.photoslibrary' in item['fullpath']:
+        time.sleep(0.5)
+    return copy(item)
+Pipeline.CopyResolvedPhoto = SlowCopy
+
+walk = Crawl.AnalyzeFolder
+def AnalyzeFolder(*args, **kwargs):
+    walk(*args, **kwargs)
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGINT)).start()
+Crawl.AnalyzeFolder = AnalyzeFolder
+
+sys.argv = ['PhotoCrawler.py'] + sys.argv[1:]
+PhotoCrawler.Main()
+"""
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source')
+        self.output = os.path.join(self.root, 'output')
+        GenerateTree(self.source, photos=20, depth=1, fanout=2, zips=0, libraries=1, seed=1)
+        self.env = dict(os.environ, HOME=self.root)
+        self.arguments = ['--progress', 'off', '--scan-path', self.source, '--output-path', self.output,
+                          '--checkpoint-interval', '0.1']
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _Contents(self, below, suffix=''):
+        contents = set()
+        for directory, _, names in os.walk(below):
+            for name in names:
+                if name.endswith(suffix):
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        contents.add(f.read())
+        return contents
+
+    def testLibraryInterruptedWhileDrainingIsImportedOnResume(self):
+        result = subprocess.run([sys.executable, '-c', INTERRUPTED_CRAWL, *self.arguments], env=self.env,
+                                capture_output=True, text=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('Interrupted while finishing the queued work', result.stderr)
+
+        result = subprocess.run([sys.executable, CRAWLER, *self.arguments, '--resume'], env=self.env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        library = os.path.join(self.source, 'Library 0.photoslibrary')
+        # the five originals on disk and the rendered edit
+        photos = self._Contents(library, '.jpeg')
+        self.assertEqual(len(photos), 6)
+        self.assertLessEqual(photos, self._Contents(self.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
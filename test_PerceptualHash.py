@@ -0,0 +1,120 @@
+"""Tests of near-duplicate detection: the hash index and what a crawl replaces.
+
+    python -m pytest -q test_PerceptualHash.py
+"""
+import io
+import os
+import sys
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+from PIL import Image
+from SyntheticTree import _TiffExif, _ExifDate, FIRST_DATE
+from PerceptualHash import ComputeDHash, HammingDistance, MultiIndexHash, NearDuplicateIndex
+
+CRAWLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PhotoCrawler.py')
+
+
+def MakePattern(rng):
+    """A coarse random grayscale pattern, the structure a dHash sees."""
+    return Image.frombytes('L', (12, 9), rng.randbytes(12 * 9)).convert('RGB')
+
+
+def MakeVersion(pattern, size, timestamp):
+    """JPEG of pattern scaled to size, with the EXIF capture date timestamp."""
+    buffer = io.BytesIO()
+    pattern.resize(size, Image.BILINEAR).save(buffer, 'JPEG', quality=90,
+                                              exif=b'Exif\x00\x00' + _TiffExif(_ExifDate(timestamp)))
+    return buffer.getvalue()
+
+
+class IndexTest(unittest.TestCase):
+
+    def testRemoveEmptiesTables(self):
+        rng = random.Random(1)
+        index = NearDuplicateIndex(4)
+        for round_ in range(3):
+            entries = [dict(dest=f"/out/{n}.jpg", phash=rng.getrandbits(64)) for n in range(200)]
+            for entry in entries:
+                index.Add(entry)
+            self.assertEqual(len(index._hashes), 200)
+            for entry in entries:
+                index.Remove(entry)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index._hashes), 0)
+        self.assertEqual([table for table in index._hashes._tables if table], [])
+
+    def testAddReplacesEntryOfSameDestination(self):
+        index = NearDuplicateIndex(4)
+        old = dict(dest='/out/a.jpg', phash=0x0F0F0F0F0F0F0F0F)
+        new = dict(dest='/out/a.jpg', phash=0x0F0F0F0F0F0F0F0F)
+        index.Add(old)
+        index.Add(new)
+        self.assertEqual(len(index._hashes), 1)
+        self.assertEqual(index.Find(new['phash']), [new])
+
+    def testRemoveKeepsOthersWithSameHash(self):
+        hashes = MultiIndexHash(4)
+        a, b = object(), object()
+        hashes.Add(0x1234, a)
+        hashes.Add(0x1234, b)
+        hashes.Remove(0x1234, a)
+        self.assertEqual(hashes.Query(0x1234), [(0, b)])
+
+
+class CrawlTest(unittest.TestCase):
+    """A thumbnail is replaced by its full-size photo; a burst shot by a better frame is not."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source')
+        self.output = os.path.join(self.root, 'output')
+        os.makedirs(self.source)
+        rng = random.Random(1)
+        self.photo, self.burst = MakePattern(rng), MakePattern(rng)
+        self.taken = FIRST_DATE + 86400 * 1000 + 12 * 3600
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _Write(self, name, data):
+        with open(os.path.join(self.source, name), 'wb') as f:
+            f.write(data)
+        return data
+
+    def _Crawl(self):
+        env = dict(os.environ, HOME=self.root)
+        result = subprocess.run([sys.executable, CRAWLER, '--progress', 'off', '--scan-path', self.source,
+                                 '--output-path', self.output, '--near-duplicates'], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def _Files(self, below):
+        found = {}
+        for directory, _, names in os.walk(below):
+            for name in names:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    found[name] = f.read()
+        return found
+
+    def testReplacesOnlyVersionsOfTheSameShot(self):
+        thumbnail = self._Write('THUMB_0001.jpg', MakeVersion(self.photo, (160, 120), self.taken))
+        frame = self._Write('BURST_0001.jpg', MakeVersion(self.burst, (320, 240), self.taken + 3600))
+        self._Crawl()
+
+        photo = self._Write('IMG_0001.jpg', MakeVersion(self.photo, (1280, 960), self.taken))
+        # the next frame of the burst: a near-identical picture, two seconds later and larger
+        next_frame = self._Write('BURST_0002.jpg', MakeVersion(self.burst, (1280, 960), self.taken + 3602))
+        self.assertLessEqual(HammingDistance(ComputeDHash(io.BytesIO(frame))[0], ComputeDHash(io.BytesIO(next_frame))[0]), 4)
+        self._Crawl()
+
+        review = os.path.join(self.output, 'NearDuplicates')
+        self.assertEqual(self._Files(review), {'THUMB_0001.jpg': thumbnail})
+        kept = {name: data for name, data in self._Files(self.output).items() if name.endswith('.jpg')}
+        kept.pop('THUMB_0001.jpg')
+        self.assertEqual(kept, {'IMG_0001.jpg': photo, 'BURST_0001.jpg': frame, 'BURST_0002.jpg': next_frame})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Tests of the direct Photos.sqlite reader against a synthetic library.
+
+    python -m pytest -q test_PhotosDatabase.py
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import xxhash
+from SyntheticTree import MakeJpeg, MakePhotosDatabase, FIRST_DATE, LAST_DATE
+from PhotosDatabase import OpenPhotosDatabase
+
+
+class PhotosDatabaseTest(unittest.TestCase):
+    """Builds a library with originals on disk, an asset only present as its rendered edit, an
+    asset only in iCloud and a trashed asset, then reads it through PhotosDatabase."""
+
+    def setUp(self):
+        self.library = tempfile.mkdtemp(suffix='.photoslibrary')
+        os.makedirs(os.path.join(self.library, 'database'))
+        rng = random.Random(1)
+        self.assets = []
+        self.originals = {}
+        for m in range(4):
+            uuid = f"{m:X}{rng.getrandbits(124):031X}"
+            timestamp = rng.uniform(FIRST_DATE, LAST_DATE)
+            data = MakeJpeg(rng, timestamp)
+            directory = os.path.join(self.library, 'originals', uuid[0])
+            os.makedirs(directory, exist_ok=True)
+            self.originals[uuid] = os.path.join(directory, f"{uuid}.jpeg")
+            with open(self.originals[uuid], 'wb') as f:
+                f.write(data)
+            self.assets.append(dict(uuid=uuid, directory=uuid[0], filename=f"{uuid}.jpeg",
+                                    original_filename=f"IMG_{m:04d}.JPG", created=timestamp, size=len(data)))
+        self.special = {}
+        for kind in ('missing', 'edited', 'trashed'):
+            uuid = f"{rng.getrandbits(128):032X}"
+            self.special[kind] = uuid
+            self.assets.append(dict(uuid=uuid, directory=uuid[0], filename=f"{uuid}.heic",
+                                    original_filename=f"IMG_{kind.upper()}.HEIC", created=rng.uniform(FIRST_DATE, LAST_DATE),
+                                    size=64 * 1024, edited=kind == 'edited', trashed=kind == 'trashed'))
+        renders = os.path.join(self.library, 'resources', 'renders', self.special['edited'][0])
+        os.makedirs(renders)
+        self.render = os.path.join(renders, f"{self.special['edited']}_1_201_a.jpeg")
+        with open(self.render, 'wb') as f:
+            f.write(MakeJpeg(rng, FIRST_DATE))
+        self.db_path = os.path.join(self.library, 'database', 'Photos.sqlite')
+        MakePhotosDatabase(self.db_path, self.assets)
+
+    def tearDown(self):
+        shutil.rmtree(self.library, ignore_errors=True)
+
+    def _Open(self):
+        database = OpenPhotosDatabase(self.library)
+        self.assertIsNotNone(database)
+        self.addCleanup(database.Close)
+        return database
+
+    def testFiles(self):
+        files = {asset.uuid: (asset, entry) for asset, entry in self._Open().Files()}
+
+        self.assertNotIn(self.special['trashed'], files)
+        self.assertEqual(len(files), len(self.assets) - 1)
+        for uuid, path in self.originals.items():
+            asset, entry = files[uuid]
+            self.assertEqual(entry.path, path)
+            self.assertEqual(asset.size, os.path.getsize(path))
+            self.assertFalse(asset.edited)
+        asset, entry = files[self.special['edited']]
+        self.assertTrue(asset.edited)
+        self.assertEqual(entry.path, self.render)
+        asset, entry = files[self.special['missing']]
+        self.assertIsNone(entry)
+        self.assertEqual(asset.filename, 'IMG_MISSING.HEIC')
+
+    def testFilesSkipsAssets(self):
+        skipped = set(self.originals)
+        files = [asset.uuid for asset, entry in self._Open().Files(skip_assets=lambda batch: skipped)]
+        self.assertEqual(sorted(files), sorted([self.special['missing'], self.special['edited']]))
+
+    def testFingerprint(self):
+        fingerprint = self._Open().Fingerprint()
+
+        listed = sorted((asset for asset in self.assets if not asset.get('trashed')), key=lambda asset: asset['uuid'])
+        digest = xxhash.xxh64()
+        for asset in listed:
+            digest.update(f"{asset['uuid']}:{asset['size']}\n".encode('utf-8'))
+        self.assertEqual(fingerprint.asset_count, len(listed))
+        self.assertEqual(fingerprint.digest, digest.hexdigest())
+        # MakePhotosDatabase stores the creation date as the modification date
+        self.assertAlmostEqual(fingerprint.max_modified, max(asset['created'] for asset in listed), places=3)
+        self.assertEqual(self._Open().Fingerprint(), fingerprint)
+
+    def testFingerprintChangesWithLibrary(self):
+        fingerprint = self._Open().Fingerprint()
+        os.remove(self.db_path)
+        self.assets[0]['size'] += 1
+        MakePhotosDatabase(self.db_path, self.assets)
+        self.assertNotEqual(self._Open().Fingerprint().digest, fingerprint.digest)
+
+    def testUnsupportedModelVersion(self):
+        os.remove(self.db_path)
+        MakePhotosDatabase(self.db_path, self.assets, model_version=99000)
+        self.assertIsNone(OpenPhotosDatabase(self.library))
+
+
+if __name__ == '__main__':
+    unittest.main()
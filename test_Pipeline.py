@@ -0,0 +1,117 @@
+"""Tests of the ingest pipeline writer's parking of files whose hash or destination is in flight.
+
+    python -m pytest -q test_Pipeline.py
+"""
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import settings
+import Pipeline
+from DataBase import DataBase
+from Pipeline import IngestPipeline
+from SyntheticTree import MakeJpeg, FIRST_DATE
+
+
+class PipelineParkingTest(unittest.TestCase):
+    """Submits files that resolve to the same hash or the same destination all at once, with
+    copies slowed down so they are still in flight when the others reach the writer."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source')
+        output = os.path.join(self.root, 'output')
+        os.makedirs(os.path.join(output, 'Temp'))
+        self.saved_settings = {name: getattr(settings, name) for name in dir(settings) if name.startswith('g')}
+        self.addCleanup(self._RestoreSettings)
+        settings.gOutputPath = output
+        settings.gTempPath = os.path.join(output, 'Temp')
+        settings.gIncompleteDirectories = set()
+        settings.gMetrics = None
+        settings.gDatabase = DataBase(output, 0)
+        self.addCleanup(settings.gDatabase.Close)
+        self.rng = random.Random(1)
+        self.timestamp = FIRST_DATE + 86400 * 100
+
+        # Records every copy and whether two copies to one destination ever overlapped
+        self.copies = []
+        self.active = set()
+        self.overlapped = False
+        self.lock = threading.Lock()
+        copy = Pipeline.CopyResolvedPhoto
+
+        def SlowCopy(item):
+            with self.lock:
+                self.overlapped = self.overlapped or item['dest_path'] in self.active
+                self.active.add(item['dest_path'])
+                self.copies.append(item['fullpath'])
+            time.sleep(0.05)
+            try:
+                return copy(item)
+            finally:
+                with self.lock:
+                    self.active.discard(item['dest_path'])
+
+        patcher = mock.patch.object(Pipeline, 'CopyResolvedPhoto', SlowCopy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _RestoreSettings(self):
+        for name, value in self.saved_settings.items():
+            setattr(settings, name, value)
+
+    def _Write(self, relative_path, data):
+        path = os.path.join(self.source, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _Ingest(self, paths):
+        pipeline = IngestPipeline(hash_workers=len(paths), copy_workers=len(paths))
+        for path in paths:
+            pipeline.Submit(path, os.path.basename(path), os.path.getmtime(path))
+        pipeline.Close()
+
+    def _OutputFiles(self):
+        return [os.path.join(directory, name) for directory, _, names in os.walk(settings.gOutputPath)
+                for name in names if name != 'myphotos.db' and not name.startswith('myphotos.db-')]
+
+    def testIdenticalFilesAreCopiedOnce(self):
+        data = MakeJpeg(self.rng, self.timestamp)
+        paths = [self._Write(relative_path, data)
+                 for relative_path in ('a/IMG_0001.jpg', 'b/IMG_0001.jpg', 'c/COPY_0001.jpg', 'd/IMG_0001 (1).jpg')]
+
+        self._Ingest(paths)
+
+        self.assertEqual(len(self.copies), 1)
+        self.assertEqual(settings.gDatabase.GetPhotoCount(), 1)
+        outputs = self._OutputFiles()
+        self.assertEqual(len(outputs), 1)
+        with open(outputs[0], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def testSameNameFilesAreNeverCopiedAtOnce(self):
+        contents = [MakeJpeg(self.rng, self.timestamp) for _ in range(4)]
+        paths = [self._Write(f"{directory}/IMG_0001.jpg", data) for directory, data in zip('abcd', contents)]
+
+        self._Ingest(paths)
+
+        self.assertFalse(self.overlapped)
+        self.assertEqual(sorted(self.copies), sorted(paths))
+        self.assertEqual(settings.gDatabase.GetPhotoCount(), len(paths))
+        outputs = self._OutputFiles()
+        self.assertEqual(len(outputs), 1)
+        with open(outputs[0], 'rb') as f:
+            self.assertIn(f.read(), contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
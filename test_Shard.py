@@ -0,0 +1,133 @@
+"""End-to-end test of distributed scans: scan-only nodes, the merge and applying the plan.
+
+    python -m pytest -q test_Shard.py
+"""
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import random
+import unittest
+from SyntheticTree import GenerateTree, MakeRaw, FIRST_DATE
+from Shard import ReadShard
+
+CRAWLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PhotoCrawler.py')
+
+
+class DistributedScanTest(unittest.TestCase):
+    """Two nodes scan separate trees sharing some photos; one merge host plans the copies."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.output = os.path.join(self.root, 'output')
+        self.trees = dict(a=os.path.join(self.root, 'node-a'), b=os.path.join(self.root, 'node-b'))
+        GenerateTree(self.trees['a'], photos=40, depth=2, fanout=2, zips=1, libraries=0, seed=1)
+        GenerateTree(self.trees['b'], photos=40, depth=2, fanout=2, zips=1, libraries=0, seed=2)
+        # Photos both nodes hold, under other names
+        shared = os.path.join(self.trees['b'], 'shared')
+        os.makedirs(shared)
+        for directory, _, names in os.walk(self.trees['a']):
+            for name in sorted(names)[:2]:
+                if name.endswith('.jpg'):
+                    shutil.copy2(os.path.join(directory, name), os.path.join(shared, f"from_a_{name}"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _Run(self, *arguments):
+        # No ~/Pictures: the merge and apply hosts must not need a scan path
+        env = dict(os.environ, HOME=self.root)
+        result = subprocess.run([sys.executable, CRAWLER, '--progress', 'off', *arguments], env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def _Scan(self, node):
+        shard = os.path.join(self.root, f"{node}.jsonl.gz")
+        self._Run('--scan-only', shard, '--scan-path', self.trees[node], '--node-id', node)
+        return shard
+
+    def _Apply(self, plan, node):
+        self._Run('--apply', plan, '--output-path', self.output, '--node-id', node)
+
+    def _Snapshot(self):
+        files = {}
+        for directory, _, names in os.walk(self.output):
+            for name in names:
+                path = os.path.join(directory, name)
+                # photos only: the database files sit in the output, the logs below Logs/
+                if directory != self.output and not os.path.relpath(path, self.output).startswith('Logs'):
+                    file_stat = os.stat(path)
+                    files[path] = (file_stat.st_size, file_stat.st_mtime_ns)
+        with sqlite3.connect(os.path.join(self.output, 'myphotos.db')) as db:
+            rows = db.execute('SELECT COUNT(*) FROM photos').fetchone()[0]
+        return files, rows
+
+    def testScanMergeApply(self):
+        shards = [self._Scan('a'), self._Scan('b')]
+        plan = os.path.join(self.root, 'plan.jsonl')
+        self._Run('--merge', *shards, '--plan-out', plan, '--output-path', self.output)
+
+        entries = [entry for shard in shards for entry in ReadShard(shard)]
+        self.assertEqual({entry.node for entry in entries}, {'a', 'b'})
+        with open(plan, encoding='utf-8') as f:
+            actions = [json.loads(line) for line in f.readlines()[1:]]
+        copies = [action for action in actions if action['action'] == 'copy']
+        self.assertEqual(sorted(action['hash'] for action in copies), sorted({entry.hash for entry in entries}))
+        self.assertLess(len(copies), len(entries))
+        self.assertEqual(len({action['dest'] for action in copies}), len(copies))
+
+        self._Apply(plan, 'a')
+        self._Apply(plan, 'b')
+        files, rows = self._Snapshot()
+        self.assertEqual(len(files), len(copies))
+        self.assertEqual(rows, len(copies))
+
+        self._Apply(plan, 'a')
+        self._Apply(plan, 'b')
+        self.assertEqual(self._Snapshot(), (files, rows))
+
+    def testQuickHashCollision(self):
+        # Same size, head and tail, different middle: one quick hash, two photos
+        data = bytearray(MakeRaw(random.Random(3), FIRST_DATE, size=1024 * 1024))
+        variant = bytearray(data)
+        variant[len(data) // 2] ^= 0xFF
+        for node, content in (('a', data), ('b', variant)):
+            os.makedirs(os.path.join(self.trees[node], 'collision'))
+            with open(os.path.join(self.trees[node], 'collision', 'RAW_COLLISION.tif'), 'wb') as f:
+                f.write(content)
+        shards = [self._Scan('a'), self._Scan('b')]
+        plan = os.path.join(self.root, 'plan.jsonl')
+        self._Run('--merge', *shards, '--plan-out', plan, '--output-path', self.output)
+
+        with open(plan, encoding='utf-8') as f:
+            actions = [json.loads(line) for line in f.readlines()[1:]]
+        confirms = [action for action in actions if action['action'] == 'confirm']
+        self.assertIn(os.path.join(self.trees['b'], 'collision', 'RAW_COLLISION.tif'),
+                      [action['source'] for action in confirms])
+
+        # b waits for the original of a, and copies its own version once it is there
+        self._Apply(plan, 'b')
+        self._Apply(plan, 'a')
+        self._Apply(plan, 'b')
+        files, rows = self._Snapshot()
+        contents = []
+        for path in files:
+            if 'RAW_COLLISION' in path:
+                with open(path, 'rb') as f:
+                    contents.append(f.read())
+        self.assertEqual(sorted(contents), sorted([bytes(data), bytes(variant)]))
+        # every other duplicate was confirmed and dropped
+        copies = [action for action in actions if action['action'] == 'copy']
+        self.assertEqual(len(files), len(copies) + 1)
+        self.assertEqual(rows, len(copies) + 1)
+
+        self._Apply(plan, 'a')
+        self._Apply(plan, 'b')
+        self.assertEqual(self._Snapshot(), (files, rows))
+
+
+if __name__ == '__main__':
+    unittest.main()